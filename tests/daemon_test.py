@@ -0,0 +1,131 @@
+"""Test daemon.py.
+
+Copyright © 2016-2018 Garrett Powell <garrett@gpowell.net>
+
+This file is part of zielen.
+
+zielen is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+zielen is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with zielen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import sqlite3
+
+import pytest
+
+from zielen.daemon import AccessAggregator, ChangeTrigger
+from zielen.profile import PathData
+
+
+class FakeProfile:
+    """A profile which records increments instead of writing them."""
+    def __init__(self, known_paths, locked=False):
+        self.known_paths = known_paths
+        self.locked = locked
+        self.increments = {}
+
+    def lookup_paths(self, paths):
+        return {
+            path: PathData(False, 0.0, True)
+            for path in paths if path in self.known_paths}
+
+    def increment(self, paths, increment):
+        if self.locked:
+            raise sqlite3.OperationalError("database is locked")
+        for path in paths:
+            self.increments[path] = self.increments.get(path, 0) + increment
+
+
+class TestAccessAggregator:
+    @pytest.fixture
+    def aggregator(self):
+        return AccessAggregator(cooldown_period=1, increment_amount=1)
+
+    def test_accesses_are_counted(self, aggregator):
+        """Accesses outside of the cooldown period are counted."""
+        aggregator.record("letters/a.txt", 0)
+        aggregator.record("letters/a.txt", 0.5)
+        aggregator.record("letters/a.txt", 2)
+        aggregator.record("numbers/1.txt", 2)
+
+        assert aggregator.stats.pending_paths == 2
+        assert aggregator.stats.pending_accesses == 3
+
+    def test_flush(self, aggregator):
+        """Accesses of files in the database are flushed in a batch."""
+        profile = FakeProfile({"letters/a.txt", "numbers/1.txt"})
+        aggregator.record("letters/a.txt", 0)
+        aggregator.record("letters/a.txt", 2)
+        aggregator.record("numbers/1.txt", 2)
+        aggregator.record("new.txt", 2)
+
+        assert aggregator.flush(profile) == 3
+        assert profile.increments == {"letters/a.txt": 2, "numbers/1.txt": 1}
+        assert aggregator.stats.pending_accesses == 0
+        assert aggregator.stats.flushed_accesses == 3
+
+    def test_failed_flush_keeps_counts(self, aggregator):
+        """Accesses are kept for the next flush if the database is locked."""
+        aggregator.record("letters/a.txt", 0)
+
+        with pytest.raises(sqlite3.OperationalError):
+            aggregator.flush(FakeProfile({"letters/a.txt"}, locked=True))
+        assert aggregator.stats.pending_accesses == 1
+
+
+class TestChangeTrigger:
+    @pytest.fixture
+    def trigger(self):
+        return ChangeTrigger(delay=5, max_delay=20)
+
+    def test_no_sync_without_changes(self, trigger):
+        """A sync isn't due if nothing has changed."""
+        assert trigger.deadline is None
+
+    def test_sync_is_delayed_by_changes(self, trigger):
+        """A sync is due once files stop changing for the delay period."""
+        trigger.add_change(0)
+        trigger.add_change(3)
+
+        assert trigger.deadline == 8
+
+    def test_sync_is_not_delayed_past_max_delay(self, trigger):
+        """A sync is due after the maximum delay if files keep changing."""
+        for timestamp in range(0, 30, 2):
+            trigger.add_change(timestamp)
+
+        assert trigger.deadline == 20
+
+    def test_changes_are_reset(self, trigger):
+        """Changes are forgotten once a sync starts."""
+        trigger.add_change(0)
+        trigger.reset()
+        trigger.add_change(30)
+
+        assert trigger.deadline == 35
+
+    def test_changes_during_sync_are_synced_after(self, trigger):
+        """Changes made while a sync is running trigger one more sync."""
+        trigger.add_change(0)
+        trigger.pause()
+        trigger.add_change(3)
+        trigger.add_change(4)
+        trigger.resume(10)
+
+        assert trigger.deadline == 15
+
+    def test_no_sync_after_sync_without_changes(self, trigger):
+        """A sync isn't due after a sync if nothing changed while it ran."""
+        trigger.add_change(0)
+        trigger.pause()
+        trigger.resume(10)
+
+        assert trigger.deadline is None
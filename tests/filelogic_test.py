@@ -54,3 +54,22 @@ class TestPathsDiff:
         assert diff.init_paths == {"file_a", "file_b"}
         assert diff.res_paths == {"file_a", "file_d"}
         assert diff.mod_paths == {("file_b", "file_d")}
+
+    def test_rm_renamed_paths(self, diff):
+        """Renamed paths can be removed by their new name."""
+        diff.rename([("file_b", "file_d")])
+        diff.rm(["file_d"])
+        assert diff.init_paths == {"file_a", "file_b"}
+        assert diff.res_paths == {"file_a"}
+        assert diff.mod_paths == set()
+
+    def test_union(self, diff):
+        """The union of two objects contains the paths of both."""
+        diff.rename([("file_b", "file_d")])
+        other_diff = PathsDiff({"file_c"})
+        other_diff.add(["file_e"])
+        union_diff = diff | other_diff
+        assert union_diff.init_paths == {"file_a", "file_b", "file_c"}
+        assert union_diff.res_paths == {
+            "file_a", "file_c", "file_d", "file_e"}
+        assert union_diff.mod_paths == {("file_b", "file_d")}
@@ -19,12 +19,15 @@ along with zielen.  If not, see <http://www.gnu.org/licenses/>.
 """
 import os
 import time
+import errno
 import tempfile
 
 import pytest
 
+from zielen import fstools
 from zielen.fstools import (
-    is_unsafe_symlink, scan_tree, symlink_tree, transfer_tree)
+    is_unsafe_symlink, scan_tree, symlink_tree, transfer_tree,
+    get_temp_path, TransferJournal, DELTA_BLOCK_SIZE)
 
 TEST_FILE_PATHS = {
     "src/report.odt": "apple",
@@ -81,6 +84,194 @@ def test_transfer_tree_with_rm_source(files):
     assert not os.path.exists("src/scans/receipt.pdf")
 
 
+def test_transfer_tree_with_transfer_threads(files):
+    """Files can be copied concurrently."""
+    transfer_tree("src", "dest", rm_source=True, transfer_threads=4)
+
+    assert os.path.isfile("dest/report.odt")
+    assert os.path.isfile("dest/scans/receipt.pdf")
+    assert not os.path.exists("src/scans")
+
+
+def test_transfer_tree_replaces_symlinks(files):
+    """Symlinks to source files in the destination are replaced."""
+    os.makedirs("dest")
+    os.symlink(os.path.abspath("src/report.odt"), "dest/report.odt")
+    transfer_tree("src", "dest")
+
+    assert not os.path.islink("dest/report.odt")
+    with open("dest/report.odt") as file:
+        assert file.read() == "apple"
+    with open("src/report.odt") as file:
+        assert file.read() == "apple"
+
+
+def test_transfer_tree_skips_unchanged_files(files):
+    """Files that are unchanged copies of the source are not copied again."""
+    transfer_tree("src", "dest")
+    inode = os.stat("dest/report.odt").st_ino
+    with open("src/scans/receipt.pdf", "w") as file:
+        file.write("banana")
+    transfer_tree("src", "dest", skip_unchanged=True)
+
+    assert os.stat("dest/report.odt").st_ino == inode
+    with open("dest/scans/receipt.pdf") as file:
+        assert file.read() == "banana"
+
+
+def test_transfer_tree_with_delta_threshold(files):
+    """Existing files are updated by reusing the blocks that didn't change."""
+    contents = os.urandom(DELTA_BLOCK_SIZE * 3 + 10)
+    modified_contents = (
+        contents[:DELTA_BLOCK_SIZE] + b"pear" + contents[DELTA_BLOCK_SIZE:])
+    os.makedirs("dest")
+    with open("dest/report.odt", "wb") as file:
+        file.write(contents)
+    with open("src/report.odt", "wb") as file:
+        file.write(modified_contents)
+    transfer_tree("src", "dest", delta_threshold=0)
+
+    with open("dest/report.odt", "rb") as file:
+        assert file.read() == modified_contents
+    assert set(os.listdir("dest")) == {"report.odt", "scans"}
+
+
+def test_delta_transfers_handle_short_writes(files, monkeypatch):
+    """Blocks are written in full even if writes are cut short."""
+    contents = os.urandom(DELTA_BLOCK_SIZE * 3 + 10)
+    modified_contents = (
+        contents[:DELTA_BLOCK_SIZE] + b"pear" + contents[DELTA_BLOCK_SIZE:])
+    os.makedirs("dest")
+    with open("dest/report.odt", "wb") as file:
+        file.write(contents)
+    with open("src/report.odt", "wb") as file:
+        file.write(modified_contents)
+    write = os.write
+    monkeypatch.setattr(os, "write", lambda fd, data: write(fd, data[:1000]))
+    transfer_tree("src", "dest", delta_threshold=0)
+
+    with open("dest/report.odt", "rb") as file:
+        assert file.read() == modified_contents
+
+
+def test_delta_transfers_need_block_sharing(files, monkeypatch):
+    """Files are copied in full if blocks can't be shared on the device."""
+    os.makedirs("dest")
+    with open("dest/report.odt", "w") as file:
+        file.write("lemon")
+    device = os.stat("dest").st_dev
+    monkeypatch.setattr(
+        fstools, "_unsupported_backends",
+        {("copy_file_range", (device, device))})
+    monkeypatch.setattr(fstools, "_delta_copy", None)
+    transfer_tree("src", "dest", delta_threshold=0)
+
+    with open("dest/report.odt") as file:
+        assert file.read() == "apple"
+
+
+def test_transfer_tree_with_journal(files):
+    """Files recorded in the journal are skipped when resuming a transfer."""
+    transfer_tree("src", "dest")
+    source_stat = os.lstat("src/report.odt")
+    with open("dest/report.odt", "w") as file:
+        file.write("lemon")
+    os.utime("dest/report.odt", ns=(
+        source_stat.st_atime_ns, source_stat.st_mtime_ns))
+    journal = TransferJournal("journal", "src", "dest")
+    journal.record([("report.odt", source_stat)])
+    journal.close()
+    transfer_tree("src", "dest", journal_path="journal")
+
+    with open("dest/report.odt") as file:
+        assert file.read() == "lemon"
+    assert not os.path.exists("journal")
+
+
+def test_transfer_tree_ignores_temp_files(files):
+    """Temporary files left behind by a transfer are not copied."""
+    open(get_temp_path("src/report.odt", "0" * 16), "w").close()
+    open("src/notes.zielen-part", "w").close()
+    transfer_tree("src", "dest")
+
+    assert set(os.listdir("dest")) == {
+        "report.odt", "notes.zielen-part", "scans"}
+
+
+def test_transfer_tree_removes_stale_temp_files(files):
+    """Temporary files left by an interrupted transfer are removed."""
+    journal = TransferJournal("journal", "src", "dest")
+    os.makedirs("dest/old")
+    journal.record_temp_dirs(["dest/old"])
+    journal.close()
+    stale_path = get_temp_path("dest/old/a.txt", journal.temp_token)
+    other_path = get_temp_path("dest/old/b.txt", "0" * 16)
+    for path in [stale_path, other_path]:
+        open(path, "w").close()
+    transfer_tree("src", "dest", journal_path="journal")
+
+    assert os.listdir("dest/old") == [os.path.basename(other_path)]
+
+
+def test_journal_tokens_are_unique(files):
+    """Journals with the same path only share a token when resuming."""
+    journal = TransferJournal("journal", "src", "dest")
+    journal.record_temp_dirs(["dest"])
+    journal.close()
+    resumed_journal = TransferJournal("journal", "src", "dest")
+    os.remove("journal")
+    other_journal = TransferJournal("journal", "src", "dest")
+
+    assert resumed_journal.temp_token == journal.temp_token
+    assert other_journal.temp_token != journal.temp_token
+
+
+def test_per_file_copy_errors_are_not_cached(files, monkeypatch):
+    """A backend that fails for one file is still tried for the next."""
+    attempts = []
+
+    def fail_once(source_fd, dest_fd, size):
+        attempts.append(size)
+        if len(attempts) == 1:
+            raise OSError(errno.ETXTBSY, "text file busy")
+        os.sendfile(dest_fd, source_fd, 0, size)
+
+    monkeypatch.setattr(fstools, "_unsupported_backends", set())
+    monkeypatch.setattr(
+        fstools, "_COPY_BACKENDS", [("sendfile", fail_once)])
+    transfer_tree("src", "dest")
+
+    assert len(attempts) == 2
+    with open("dest/report.odt") as file:
+        assert file.read() == "apple"
+
+
+def test_truncated_files_are_not_cached(files, monkeypatch):
+    """A file that shrinks while it's copied doesn't disable the backend."""
+    real_sendfile = os.sendfile
+    truncated = []
+
+    def sendfile_and_truncate(out_fd, in_fd, offset, count):
+        # Copy one byte at a time and truncate the source after the first.
+        sent = real_sendfile(out_fd, in_fd, offset, 1)
+        if not truncated:
+            os.truncate("src/report.odt", 1)
+            truncated.append(True)
+        return sent
+
+    monkeypatch.setattr(fstools, "_unsupported_backends", set())
+    monkeypatch.setattr(
+        fstools, "_COPY_BACKENDS", [("sendfile", fstools._sendfile)])
+    monkeypatch.setattr(os, "sendfile", sendfile_and_truncate)
+    transfer_tree("src", "dest")
+
+    assert fstools._unsupported_backends == set()
+    with open("dest/report.odt") as file:
+        assert file.read() == "a"
+    with open("dest/scans/receipt.pdf") as file:
+        assert file.read() == "orange"
+
+
 def test_transfer_tree_copies_stats(files):
     """File metadata is copied."""
     original_mtime = os.stat("src/report.odt").st_mtime
@@ -123,6 +314,19 @@ def test_rec_scan(files):
     assert {entry.path for entry in scan_tree("src")} == expected_output
 
 
+def test_rec_scan_with_threads(files):
+    """Scanning with multiple threads yields files in the same order."""
+    for path in ["src/scans/old", "src/music/albums", "src/music/singles"]:
+        os.makedirs(path)
+        with open(os.path.join(path, "file"), "w") as file:
+            file.write("lemon")
+
+    expected_output = [entry.path for entry in scan_tree("src")]
+
+    assert [entry.path for entry in scan_tree(
+        "src", threads=4)] == expected_output
+
+
 def test_is_unsafe_symlink(fs):
     """Relative symlinks are not considered unsafe."""
     fs.CreateFile("parent/target")
@@ -19,12 +19,15 @@ along with zielen.  If not, see <http://www.gnu.org/licenses/>.
 """
 import os
 import re
+import tempfile
 
 import pytest
 
 from zielen.paths import get_program_dir
 from zielen.exceptions import FileParseError
-from zielen.profile import ProfileDBFile, PathData, ProfileConfigFile
+from zielen.profile import (
+    ProfileDBFile, PathData, ProfileConfigFile, ProfileExcludeFile,
+    ProfileExcludeCacheFile)
 
 
 class TestProfileDBFile:
@@ -79,6 +82,19 @@ class TestProfileDBFile:
         """Querying with nonexistent root directory returns an empty dict."""
         assert db.get_paths(root="foobar") == {}
 
+    def test_iter_paths(self, db):
+        """File paths and data can be iterated over lazily."""
+        assert dict(db.iter_paths()) == db.get_paths()
+        assert dict(db.iter_paths(root="documents/scans")) == {
+            "documents/scans": PathData(True, 10.0, False),
+            "documents/scans/receipt.pdf": PathData(False, 10.0, False)}
+
+    def test_iter_paths_ordered(self, db):
+        """File paths can be iterated over in sorted order."""
+        paths = [path for path, data in db.iter_paths(ordered=True)]
+
+        assert paths == sorted(db.get_paths().keys())
+
     def test_get_path_info(self, db):
         """Data about a specific path can be retrieved."""
         assert db.get_path_info(
@@ -88,6 +104,14 @@ class TestProfileDBFile:
         """Querying for a nonexistent path returns None."""
         assert db.get_path_info("foobar") is None
 
+    def test_lookup_paths(self, db):
+        """Data for many paths can be retrieved at once."""
+        expected_output = {
+            "empty": PathData(True, 0.0, True),
+            "documents/report.odt": PathData(False, 0.0, True)}
+        assert db.lookup_paths(
+            ["empty", "documents/report.odt", "nonexistent"]) == expected_output
+
     def test_add_inflated_paths(self, db):
         """Paths can be added to the database with an inflated priority."""
         db.add_inflated(["documents/essay.odt"], [])
@@ -122,6 +146,18 @@ class TestProfileDBFile:
             "documents/report.odt": PathData(False, 0.0, True)}
         assert db.get_paths() == expected_output
 
+    def test_hash_collision(self, db):
+        """Cached path IDs are regenerated when a hash collision occurs."""
+        colliding_id = db._get_path_id("music")
+        db._cur.execute("""\
+            INSERT INTO nodes (id, path, directory, priority, local)
+            VALUES (?, 'colliding', 0, 0, 1);
+            """, (colliding_id,))
+        db.add_paths(["music"], [])
+
+        assert db._get_path_id("music") != colliding_id
+        assert db.get_path_info("music") == PathData(False, 0.0, True)
+
     def test_increment(self, db):
         """Path priorities can be incremented."""
         db.increment(["documents/scans/receipt.pdf"], 1)
@@ -145,6 +181,119 @@ class TestProfileDBFile:
         assert db.get_paths() == expected_output
 
 
+class TestProfileExcludeFile:
+    @pytest.fixture
+    def exclude_file(self):
+        tmp_dir = tempfile.TemporaryDirectory(prefix="zielen-")
+        os.chdir(tmp_dir.name)
+
+        test_dirs = ["local/documents/scans", "local/.config/scans"]
+        test_files = [
+            "local/notes.txt", "local/.hidden.txt",
+            "local/documents/report.odt", "local/documents/scans/receipt.pdf",
+            "local/.config/settings.txt"]
+        for path in test_dirs:
+            os.makedirs(path)
+        for path in test_files:
+            open(path, "w").close()
+        os.symlink("documents/scans", "local/scans-link")
+
+        yield ProfileExcludeFile("exclude")
+
+        tmp_dir.cleanup()
+
+    @pytest.mark.parametrize("pattern,expected_output", [
+        ("*.txt", {"notes.txt"}),
+        (".*.txt", {".hidden.txt"}),
+        ("/scans", set()),
+        ("scans", {"documents/scans"}),
+        ("report.odt/", set()),
+        ("/documents/*/", {"documents/scans"}),
+        ("/documents/**", {
+            "documents", "documents/report.odt", "documents/scans",
+            "documents/scans/receipt.pdf"}),
+        ("**/scans/*.pdf", {"documents/scans/receipt.pdf"}),
+        ("/.config/scans", {".config/scans"}),
+        ("[!n]*.txt", set()),
+        ("notes.tx?", {"notes.txt"}),
+        ("scans-link/", {"scans-link"}),
+        ("./documents/./report.odt", {"documents/report.odt"}),
+        ("/./notes.txt", {"notes.txt"}),
+        ])
+    def test_matches(self, exclude_file, pattern, expected_output):
+        """Globbing patterns match the same files as the glob module."""
+        with open(exclude_file.path, "w") as file:
+            file.write("# comment\n  {0}\n".format(pattern))
+        assert exclude_file.matches("local") == expected_output
+
+    def test_all_matches(self, exclude_file):
+        """Files under matching directories are included."""
+        with open(exclude_file.path, "w") as file:
+            file.write("scans/\nnotes.txt\n")
+        assert exclude_file.all_matches("local") == {
+            "notes.txt", "documents/scans", "documents/scans/receipt.pdf"}
+
+    def test_matches_given_paths(self, exclude_file):
+        """Paths that are passed in are matched instead of scanning."""
+        with open(exclude_file.path, "w") as file:
+            file.write("*.flac\n")
+        paths = {
+            "music": os.stat("local/documents"),
+            "music/song.flac": os.stat("local/notes.txt")}
+        assert exclude_file.all_matches("local", paths) == {"music/song.flac"}
+
+    def test_no_patterns(self, exclude_file):
+        """An empty pattern file matches nothing."""
+        exclude_file.generate()
+        assert exclude_file.all_matches("local") == set()
+
+
+class TestProfileExcludeCacheFile:
+    @pytest.fixture
+    def cache_file(self):
+        tmp_dir = tempfile.TemporaryDirectory(prefix="zielen-")
+        os.chdir(tmp_dir.name)
+        for path, patterns in [("client1", "*.txt\n"), ("client2", "")]:
+            with open(path, "w") as file:
+                file.write(patterns)
+
+        yield ProfileExcludeCacheFile("cache.json")
+
+        tmp_dir.cleanup()
+
+    def test_get_regexes(self, cache_file):
+        """Each file is compiled, and files without patterns give None."""
+        regex, empty_regex = cache_file.get_regexes(["client1", "client2"])
+        assert ProfileExcludeFile.is_match(regex, "notes.txt", False)
+        assert empty_regex is None
+
+    def test_unchanged_files_are_not_parsed(self, monkeypatch, cache_file):
+        """Files whose mtime and size haven't changed are not read again."""
+        cache_file.get_regexes(["client1"])
+        monkeypatch.setattr(ProfileExcludeFile, "compile", None)
+        regex, = ProfileExcludeCacheFile("cache.json").get_regexes(["client1"])
+        assert ProfileExcludeFile.is_match(regex, "notes.txt", False)
+
+    def test_removed_files_are_dropped(self, cache_file):
+        """Files that are no longer given are removed from the cache."""
+        cache_file.get_regexes(["client1", "client2"])
+        cache_file.get_regexes(["client1"])
+        assert list(cache_file.vals["Files"]) == ["client1"]
+
+    def test_missing_files_are_skipped(self, cache_file):
+        """Files that are removed before they are read are skipped."""
+        assert len(cache_file.get_regexes(["client1", "client3"])) == 1
+
+    def test_old_formats_are_discarded(self, monkeypatch, cache_file):
+        """Regexes cached in a different format are compiled again."""
+        cache_file.get_regexes(["client1"])
+        monkeypatch.setattr(ProfileExcludeCacheFile, "FORMAT_VERSION", 2)
+        monkeypatch.setattr(
+            ProfileExcludeFile, "compile", lambda self: re.compile("/new"))
+        regex, = ProfileExcludeCacheFile("cache.json").get_regexes(["client1"])
+        assert regex.pattern == "/new"
+
+
 class TestProfileConfigFile:
     @pytest.fixture
     def cfg_file(self, fs):
@@ -164,7 +313,14 @@ class TestProfileConfigFile:
             ("RemoteDir", ["", "rel/path"]),
             ("StorageLimit", ["", "abc", "123", "3.14", "123QiB"]),
             ("SyncInterval", ["", "abc", "3.14"]),
-            ("PriorityHalfLife", ["", "abc"])
+            ("PriorityHalfLife", ["", "abc"]),
+            ("SelectionStrategy", ["", "random"]),
+            ("FlushInterval", ["", "0", "abc"]),
+            ("WatchBackend", ["", "poll"]),
+            ("SyncMode", ["", "thread"]),
+            ("RescanInterval", ["", "0", "abc"]),
+            ("SyncDelay", ["", "abc"]),
+            ("MaxSyncDelay", ["", "0", "-1"])
             ])
     def test_incorrect_syntax(self, cfg_file, key, values):
         """Incorrect config values return an error string."""
@@ -177,7 +333,14 @@ class TestProfileConfigFile:
             ("RemoteDir", ["/empty"]),
             ("StorageLimit", ["50MiB", "20 GB", "10kib"]),
             ("SyncInterval", ["20"]),
-            ("PriorityHalfLife", ["120"])
+            ("PriorityHalfLife", ["120"]),
+            ("SelectionStrategy", ["greedy", "knapsack"]),
+            ("FlushInterval", ["3"]),
+            ("WatchBackend", ["auto", "inotify", "fanotify"]),
+            ("SyncMode", ["subprocess", "inprocess", "forkserver"]),
+            ("RescanInterval", ["24"]),
+            ("SyncDelay", ["-1", "0", "5"]),
+            ("MaxSyncDelay", ["60"])
             ])
     def test_correct_syntax(self, cfg_file, key, values):
         """Correct config values return None."""
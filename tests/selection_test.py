@@ -0,0 +1,60 @@
+"""Test selection.py.
+
+Copyright © 2016-2018 Garrett Powell <garrett@gpowell.net>
+
+This file is part of zielen.
+
+zielen is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+zielen is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with zielen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import pytest
+
+from zielen.selection import FileSelector
+
+
+class TestFileSelector:
+    @pytest.fixture
+    def selector(self):
+        selector = FileSelector(
+            exclude=["documents/scans/"], account_for_size=False)
+        selector.add("documents/report.odt", 5.0, 400)
+        selector.add("documents/scans/receipt.pdf", 10.0, 100)
+        selector.add("music/song.flac", 4.0, 300)
+        selector.add("music/playlist.m3u", 4.0, 300)
+        selector.add("notes.txt", 2.0, 300)
+        return selector
+
+    def test_excluded_paths_are_skipped(self, selector):
+        """Files under excluded directories are not added."""
+        assert len(selector) == 4
+        assert selector.is_excluded("documents/scans/receipt.pdf")
+        assert not selector.is_excluded("documents/report.odt")
+
+    def test_greedy_selection(self, selector):
+        """Files are selected in order of priority, then by path."""
+        remaining_space, selected = selector.select(701, 0)
+        assert selected == {"documents/report.odt", "music/playlist.m3u"}
+        assert remaining_space == 1
+
+    def test_knapsack_selection(self, selector):
+        """The knapsack strategy makes better use of the available space."""
+        remaining_space, selected = selector.select(
+            901, 0, strategy="knapsack")
+        assert selected == {
+            "music/song.flac", "music/playlist.m3u", "notes.txt"}
+        assert remaining_space == 1
+
+    def test_unrecognized_strategy(self, selector):
+        """An unrecognized strategy raises an exception."""
+        with pytest.raises(ValueError):
+            selector.select(100, 0, strategy="nonexistent")
@@ -20,6 +20,7 @@ along with zielen.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import time
 import shutil
+import asyncio
 import tempfile
 import textwrap
 
@@ -27,8 +28,11 @@ import pytest
 
 from zielen.commands.sync import SyncCommand
 from zielen.commands.init import InitCommand
-from zielen.profile import PathData as LocalPathData
+from zielen.daemon import ChangeTrigger, Daemon
+from zielen.exceptions import InputError
+from zielen.profile import Profile, PathData as LocalPathData
 from zielen.userdata import PathData as RemotePathData
+from zielen.watchers import InotifyWatcher
 
 # zielen takes the disk usage of files into account as opposed to their
 # apparent size when calculating which ones to keep in the local directory.
@@ -427,6 +431,29 @@ def test_priority_of_new_files_is_inflated(command):
     assert command.profile.get_path_info("letters/upper/B.txt").priority == 3.0
 
 
+def test_priority_decays(command):
+    """Priority added after one half-life counts twice as much."""
+    command.profile.last_adjust -= command.profile.priority_half_life
+    command.profile.adjust_priority()
+    command.profile.increment(["numbers/1.txt"], 1)
+
+    assert command.profile.get_path_info(
+        "numbers/1.txt").priority == pytest.approx(3.0)
+
+
+def test_legacy_info_file(command):
+    """Profiles created before priorities were scaled can be adjusted."""
+    del command.profile._info_file.vals["PriorityExponent"]
+    del command.profile._info_file.vals["LastRescan"]
+    command.profile._info_file.write()
+    command.profile.read()
+    command.main()
+    command.profile.last_adjust -= command.profile.priority_half_life
+    command.profile.adjust_priority()
+
+    assert command.profile.priority_exponent == pytest.approx(1.0)
+
+
 def test_trash_directory_is_cleaned_up(command, monkeypatch):
     """Files in the remote trash directory are automatically cleaned up."""
     test_trash_file = os.path.join(command.remote_dir.trash_dir, "test.txt")
@@ -518,3 +545,114 @@ def test_excluded_files_are_removed_from_databases(command):
 
     assert "letters/a.txt" not in command.profile.get_paths()
     assert "letters/a.txt" not in command.remote_dir.get_paths()
+
+
+def test_daemon_syncs_in_process(command):
+    """The daemon can run multiple syncs in its own process."""
+    daemon = Daemon("test")
+    daemon.profile.read()
+
+    with open("local/letters/upper/B.txt", "w") as file:
+        file.write("B"*BLOCK_SIZE*2)
+    daemon._sync_in_process()
+    os.remove("local/numbers/1.txt")
+    daemon._sync_in_process()
+
+    # The profile is unlocked once the sync is complete.
+    command.main()
+
+    remote_paths = set(command.remote_dir.scan_paths(memoize=False).keys())
+    assert remote_paths == (
+        TEST_PATHS | {"letters/upper/B.txt"}) - {"numbers/1.txt"}
+
+
+def test_daemon_syncs_changed_paths(command):
+    """The daemon only scans the local paths it has seen change."""
+    daemon = Daemon("test")
+    daemon.profile.read()
+    daemon._watching_changes = True
+    daemon._sync_in_process()
+
+    with open("local/letters/upper/B.txt", "w") as file:
+        file.write("B"*BLOCK_SIZE*2)
+    daemon._mark_dirty("letters/upper/B.txt")
+    daemon._sync_in_process()
+
+    remote_paths = set(command.remote_dir.scan_paths(memoize=False).keys())
+    assert remote_paths == TEST_PATHS | {"letters/upper/B.txt"}
+    assert daemon._sync_command.local_dir.scan_paths().keys() == (
+        command.local_dir.scan_paths(memoize=False).keys())
+
+
+def test_daemon_rebuilds_sync_dirs_when_settings_change(command):
+    """Settings that the sync directories depend on are used by later syncs."""
+    daemon = Daemon("test")
+    daemon.profile.read()
+    daemon._sync_in_process()
+    with open(command.profile.cfg_path, "a") as file:
+        file.write("ScanThreads=4\n")
+    daemon._sync_in_process()
+
+    assert daemon._sync_command.local_dir.scan_threads == 4
+
+
+def test_interrupt_message_is_registered_once(command, monkeypatch):
+    """Setting up a partial profile more than once prints one message."""
+    callbacks = []
+
+    def unregister(func):
+        while func in callbacks:
+            callbacks.remove(func)
+
+    monkeypatch.setattr("atexit.register", callbacks.append)
+    monkeypatch.setattr("atexit.unregister", unregister)
+    command.profile.status = "partial"
+    command.profile.write()
+    sync_command = SyncCommand("test")
+    for _ in range(2):
+        with pytest.raises(InputError):
+            sync_command.setup_profile()
+        sync_command.lock_socket.close()
+
+    assert callbacks == [sync_command.print_interrupt_msg]
+
+
+def test_daemon_syncs_changes_made_during_syncs(command, monkeypatch):
+    """Changes made while a sync runs are synced once it is complete."""
+    sync_writes = [True, False]
+
+    async def fake_sync():
+        # The event loop doesn't read any events until the sync is finished.
+        if sync_writes.pop(0):
+            with open("local/letters/b.txt", "w") as file:
+                file.write("b")
+
+    monkeypatch.setattr(Profile, "sync_mode", "subprocess")
+    daemon = Daemon("test")
+    daemon.profile.read()
+    monkeypatch.setattr(daemon, "_sync_in_subprocess", fake_sync)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    daemon._loop = loop
+    daemon._change_trigger = ChangeTrigger(delay=5, max_delay=20)
+    daemon._sync_wakeup = asyncio.Event()
+    watcher = InotifyWatcher(
+        [daemon.profile.local_path], lambda path: None, loop,
+        daemon._handle_change)
+    watcher.start()
+    try:
+        loop.run_until_complete(daemon._sync())
+        loop.run_until_complete(asyncio.sleep(0.1))
+        changed_deadline = daemon._change_trigger.deadline
+
+        # The follow-up sync doesn't change anything, so no more are due.
+        loop.run_until_complete(daemon._sync())
+        loop.run_until_complete(asyncio.sleep(0.1))
+        unchanged_deadline = daemon._change_trigger.deadline
+    finally:
+        watcher.stop()
+        loop.close()
+
+    assert changed_deadline is not None
+    assert unchanged_deadline is None
@@ -18,10 +18,14 @@ You should have received a copy of the GNU General Public License
 along with zielen.  If not, see <http://www.gnu.org/licenses/>.
 """
 import os
+import hashlib
+import sqlite3
+import tempfile
 
 import pytest
 
-from zielen.userdata import RemoteDBFile, PathData, SyncDir
+from zielen import userdata
+from zielen.userdata import RemoteDBFile, RemoteSyncDir, PathData, SyncDir
 
 
 class TestSyncDir:
@@ -124,6 +128,163 @@ class TestSyncDir:
         assert initial_mtime == subsequent_mtime
 
 
+class TestSyncDirSnapshot:
+    @pytest.fixture
+    def sync_dir(self):
+        tmp_dir = tempfile.TemporaryDirectory(prefix="zielen-")
+        base_dir = os.path.join(tmp_dir.name, "base")
+        os.makedirs(os.path.join(base_dir, "documents/scans"))
+        os.makedirs(os.path.join(base_dir, "pictures"))
+        for path in ["documents/report.odt", "pictures/portrait.png"]:
+            open(os.path.join(base_dir, path), "w").close()
+
+        # This function must yield instead of returning so that the temporary
+        # directory object isn't cleaned up before the test.
+        yield SyncDir(base_dir, os.path.join(tmp_dir.name, "snapshot.db"))
+
+        tmp_dir.cleanup()
+
+    def test_snapshot_matches_full_scan(self, sync_dir):
+        """Scanning with a snapshot returns the same data as without one."""
+        sync_dir.scan_paths(memoize=False)
+        expected_output = SyncDir(sync_dir.path).scan_paths()
+
+        assert sync_dir.scan_paths(memoize=False) == expected_output
+
+    def test_unchanged_dirs_are_not_read(self, monkeypatch, sync_dir):
+        """Directories that haven't changed since the last scan aren't read."""
+        monkeypatch.setattr(userdata, "TIMESTAMP_GRANULARITY", 0)
+        sync_dir.scan_paths(memoize=False)
+        open(os.path.join(sync_dir.path, "pictures/landscape.png"), "w").close()
+
+        read_paths = []
+        scandir = os.scandir
+
+        def mock_scandir(path):
+            read_paths.append(path)
+            return scandir(path)
+
+        monkeypatch.setattr("os.scandir", mock_scandir)
+        paths = sync_dir.scan_paths(memoize=False)
+
+        assert "pictures/landscape.png" in paths
+        assert read_paths == [os.path.join(sync_dir.path, "pictures")]
+
+    def test_recently_modified_dirs_are_read(self, monkeypatch, sync_dir):
+        """Directories modified just before the last scan are read again."""
+        sync_dir.scan_paths(memoize=False)
+
+        read_paths = []
+        scandir = os.scandir
+
+        def mock_scandir(path):
+            read_paths.append(path)
+            return scandir(path)
+
+        monkeypatch.setattr("os.scandir", mock_scandir)
+        sync_dir.scan_paths(memoize=False)
+
+        assert os.path.join(sync_dir.path, "pictures") in read_paths
+
+    def test_removed_files_are_not_returned(self, sync_dir):
+        """Files removed since the last scan are not returned."""
+        sync_dir.scan_paths(memoize=False)
+        os.remove(os.path.join(sync_dir.path, "documents/report.odt"))
+
+        assert "documents/report.odt" not in sync_dir.scan_paths(
+            memoize=False)
+
+    def test_iter_stats_is_sorted(self, sync_dir):
+        """Paths and stats are iterated over in sorted order."""
+        paths = [path for path, stat in sync_dir.iter_stats()]
+
+        assert paths == sorted(sync_dir.scan_paths().keys())
+
+    def test_dirty_scan_matches_full_scan(self, sync_dir):
+        """Scanning only changed paths finds the same files and changes."""
+        sync_dir.scan_paths(memoize=False)
+        report_path = os.path.join(sync_dir.path, "documents/report.odt")
+        with open(report_path, "w") as file:
+            file.write("report")
+        os.rmdir(os.path.join(sync_dir.path, "documents/scans"))
+        os.makedirs(os.path.join(sync_dir.path, "music"))
+        open(os.path.join(sync_dir.path, "music/song.ogg"), "w").close()
+        sync_dir.rescan(
+            ["documents/report.odt", "documents/scans", "music"])
+
+        paths = sync_dir.scan_paths()
+        expected_output = SyncDir(sync_dir.path).scan_paths()
+
+        assert paths.keys() == expected_output.keys()
+        assert all(
+            paths[path].st_mtime_ns == stat.st_mtime_ns
+            and paths[path].st_size == stat.st_size
+            for path, stat in expected_output.items())
+
+    def test_clean_paths_are_not_scanned(self, sync_dir):
+        """Stats of paths that haven't changed are taken from the snapshot."""
+        initial_mtime = sync_dir.scan_paths(
+            memoize=False)["documents/report.odt"].st_mtime
+        os.utime(
+            os.path.join(sync_dir.path, "documents/report.odt"),
+            times=(1495316810, 1495316810))
+        sync_dir.rescan(["pictures"])
+
+        assert sync_dir.scan_paths()[
+            "documents/report.odt"].st_mtime == initial_mtime
+
+
+class TestRemoteSyncDir:
+    @pytest.fixture
+    def remote_dir(self):
+        tmp_dir = tempfile.TemporaryDirectory(prefix="zielen-")
+        os.chdir(tmp_dir.name)
+        for path in ["local/documents/scans", "remote"]:
+            os.makedirs(path)
+        for path in [
+                "local/notes.txt", "local/documents/report.odt",
+                "local/documents/scans/receipt.pdf"]:
+            open(path, "w").close()
+
+        remote_dir = RemoteSyncDir("remote")
+        remote_dir.generate()
+        for profile_id, patterns in [
+                ("client1", "*.txt\n/documents/\n"),
+                ("client2", "notes.txt\nscans\n")]:
+            with open(profile_id, "w") as file:
+                file.write(patterns)
+            remote_dir.add_exclude_file(profile_id, profile_id)
+
+        yield remote_dir
+
+        remote_dir.close()
+        tmp_dir.cleanup()
+
+    def test_check_excluded(self, remote_dir):
+        """Only paths excluded by every client are returned."""
+        local_dir = SyncDir("local")
+        paths = [
+            "notes.txt", "documents/report.odt",
+            "documents/scans/receipt.pdf", "music/song.flac"]
+        assert remote_dir.check_excluded(
+            paths, "local", local_dir.scan_paths(), "cache.json") == {
+                "notes.txt", "documents/scans/receipt.pdf"}
+
+    def test_changed_exclude_files_are_reparsed(self, remote_dir):
+        """A client's cached patterns are replaced when its file changes."""
+        local_dir = SyncDir("local")
+        remote_dir.check_excluded(
+            [], "local", local_dir.scan_paths(), "cache.json")
+
+        with open("client2", "a") as file:
+            file.write("report.odt\n")
+        remote_dir.add_exclude_file("client2", "client2")
+
+        assert remote_dir.check_excluded(
+            ["documents/report.odt"], "local", local_dir.scan_paths(),
+            "cache.json") == {"documents/report.odt"}
+
+
 class TestRemoteDBFile:
     @pytest.fixture
     def db(self, monkeypatch):
@@ -197,3 +358,33 @@ class TestRemoteDBFile:
             "documents": PathData(True, 1495316810),
             "documents/report.odt": PathData(False, 1495316810)}
         assert db.get_paths() == expected_output
+
+    def test_salts_added_by_other_connections_are_used(self):
+        """Salts added to the database by another client are used."""
+        tmp_dir = tempfile.TemporaryDirectory(prefix="zielen-")
+        db_path = os.path.join(tmp_dir.name, "remote.db")
+        db = RemoteDBFile(db_path)
+        db.create()
+        assert db.get_path_info("new.txt") is None
+
+        salt = "abcdefgh"
+        path_hash = hashlib.sha256(("new.txt" + salt).encode())
+        path_id = int.from_bytes(
+            path_hash.digest()[:8], byteorder="big", signed=True)
+        other_conn = sqlite3.connect(db_path)
+        with other_conn:
+            other_conn.execute(
+                "INSERT INTO collisions (path, salt) VALUES (?, ?);",
+                ("new.txt", salt))
+            other_conn.execute(
+                "INSERT INTO nodes (id, path, directory, lastsync) "
+                "VALUES (?, ?, ?, ?);",
+                (path_id, "new.txt", False, 1495316810))
+            other_conn.execute(
+                "INSERT INTO closure (ancestor, descendant, depth) "
+                "VALUES (?, ?, 0);",
+                (path_id, path_id))
+        other_conn.close()
+
+        assert db.get_path_info("new.txt") == PathData(False, 1495316810)
+        db.close()
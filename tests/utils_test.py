@@ -0,0 +1,59 @@
+"""Test utils.py.
+
+Copyright © 2016-2018 Garrett Powell <garrett@gpowell.net>
+
+This file is part of zielen.
+
+zielen is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+zielen is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with zielen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import pytest
+
+from zielen.utils import PathTrie
+
+
+class TestPathTrie:
+    @pytest.fixture
+    def trie(self):
+        return PathTrie([
+            "documents/scans/", "documents/report.odt", "music",
+            "music/albums"])
+
+    def test_membership(self, trie):
+        """Paths can be checked for membership."""
+        assert len(trie) == 4
+        assert "documents/scans" in trie
+        assert "documents" not in trie
+        assert set(trie) == {
+            "documents/scans", "documents/report.odt", "music",
+            "music/albums"}
+
+    def test_has_ancestor(self, trie):
+        """Paths under paths in the trie can be found."""
+        assert trie.has_ancestor("documents/scans/receipt.pdf")
+        assert trie.has_ancestor("documents/scans")
+        assert not trie.has_ancestor("documents/scans", include_self=False)
+        assert not trie.has_ancestor("documents")
+        assert not trie.has_ancestor("documents/scan")
+
+    def test_has_descendant(self, trie):
+        """Paths above paths in the trie can be found."""
+        assert trie.has_descendant("documents")
+        assert trie.has_descendant("music", include_self=False)
+        assert not trie.has_descendant("documents/scans", include_self=False)
+        assert not trie.has_descendant("pictures")
+
+    def test_roots(self, trie):
+        """Paths that aren't under any other path can be found."""
+        assert set(trie.roots()) == {
+            "documents/scans", "documents/report.odt", "music"}
@@ -0,0 +1,116 @@
+"""Test watchers.py.
+
+Copyright © 2016-2018 Garrett Powell <garrett@gpowell.net>
+
+This file is part of zielen.
+
+zielen is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+zielen is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with zielen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import asyncio
+import tempfile
+import subprocess
+
+import pytest
+
+from zielen.watchers import InotifyWatcher, FanotifyWatcher, start_watcher
+
+
+@pytest.fixture
+def watch_dir():
+    tmp_dir = tempfile.TemporaryDirectory(prefix="zielen-")
+    os.makedirs(os.path.join(tmp_dir.name, "letters"))
+    open(os.path.join(tmp_dir.name, "letters/a.txt"), "w").close()
+
+    # This function must yield instead of returning so that the temporary
+    # directory object isn't cleaned up before the test.
+    yield tmp_dir.name
+
+    tmp_dir.cleanup()
+
+
+def watch(watcher_class, path, args):
+    """Get the paths reported by a watcher when a command is run.
+
+    Returns:
+        A tuple containing a list of the paths of opened files and a list of
+        the paths of changed files.
+    """
+    loop = asyncio.new_event_loop()
+    opened_paths = []
+    changed_paths = []
+    watcher = watcher_class(
+        [path], opened_paths.append, loop, changed_paths.append)
+    try:
+        watcher.start()
+    except OSError:
+        loop.close()
+        pytest.skip("the watcher is not supported here")
+
+    # The command is run in another process because fanotify events caused
+    # by this process are ignored.
+    def run_command():
+        subprocess.check_call(args, cwd=path, stdout=subprocess.DEVNULL)
+        loop.call_soon_threadsafe(loop.call_later, 0.2, loop.stop)
+
+    loop.run_in_executor(None, run_command)
+    loop.call_later(5, loop.stop)
+    try:
+        loop.run_forever()
+    finally:
+        watcher.stop()
+        loop.close()
+    return opened_paths, changed_paths
+
+
+def test_inotify_watcher(watch_dir):
+    """Files opened in the watched directory are reported by inotify."""
+    opened_paths, _ = watch(
+        InotifyWatcher, watch_dir, ["cat", "letters/a.txt"])
+
+    assert os.path.join(watch_dir, "letters/a.txt") in opened_paths
+
+
+def test_inotify_watcher_reports_changes(watch_dir):
+    """Files moved in the watched directory are reported by inotify."""
+    _, changed_paths = watch(
+        InotifyWatcher, watch_dir, ["mv", "letters/a.txt", "b.txt"])
+
+    assert os.path.join(watch_dir, "letters/a.txt") in changed_paths
+    assert os.path.join(watch_dir, "b.txt") in changed_paths
+
+
+def test_fanotify_watcher(watch_dir):
+    """Files opened in the watched directory are reported by fanotify."""
+    opened_paths, _ = watch(
+        FanotifyWatcher, watch_dir, ["cat", "letters/a.txt"])
+
+    assert os.path.join(watch_dir, "letters/a.txt") in opened_paths
+
+
+def test_auto_backend_reports_changes(watch_dir):
+    """The default backend reports changes if they are needed."""
+    loop = asyncio.new_event_loop()
+    watcher = start_watcher("auto", [watch_dir], print, loop, print)
+    try:
+        assert watcher.REPORTS_CHANGES
+    finally:
+        watcher.stop()
+        loop.close()
+
+
+def test_unrecognized_backend(watch_dir):
+    """An unrecognized backend raises an exception."""
+    with pytest.raises(ValueError):
+        start_watcher("poll", [watch_dir], print, asyncio.new_event_loop())
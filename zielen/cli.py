@@ -20,6 +20,7 @@ along with zielen.  If not, see <http://www.gnu.org/licenses/>.
 import signal
 import sys
 import os
+import logging
 import argparse
 import pkg_resources
 from textwrap import dedent
@@ -59,8 +60,8 @@ def main_help_item() -> Item:
         "Print the version number and exit.")
     global_opts.add_def(
         "    --debug", "",
-        "Print a full stack trace instead of an error message if an error "
-        "occurs.")
+        "Print debugging information, and print a full stack trace instead "
+        "of an error message if an error occurs.")
     global_opts.add_def(
         "-q, --quiet", "",
         "Suppress all non-error output.")
@@ -261,6 +262,9 @@ def main() -> int:
         signal.signal(signal.SIGINT, signal_exception_handler)
 
         cmd_args = parse_args()
+        if cmd_args.debug:
+            logging.basicConfig(
+                format="Debug: %(message)s", level=logging.DEBUG)
         command = def_command(cmd_args)
         command.main()
     except ProgramError as error:
@@ -275,10 +279,15 @@ def main() -> int:
     return 0
 
 
-def daemon(profile_name) -> int:
+def daemon(profile_name, debug=False) -> int:
     """Start the daemon.
 
     Always print a full stack trace instead of an error message.
+
+    Args:
+        profile_name: The name of the profile to run the daemon for.
+        debug: Print debugging information, including the statistics that
+            the daemon logs.
     """
     # Exit properly on SIGTERM, SIGHUP or SIGINT. SIGTERM is the method
     # by which the daemon will normally exit, and should not raise an
@@ -287,6 +296,10 @@ def daemon(profile_name) -> int:
     signal.signal(signal.SIGHUP, signal_exception_handler)
     signal.signal(signal.SIGINT, signal_exception_handler)
 
+    if debug:
+        logging.basicConfig(
+            format="Debug: %(message)s", level=logging.DEBUG)
+
     ghost = Daemon(profile_name)
     ghost.main()
     return 0
@@ -54,6 +54,8 @@ class Command(abc.ABC):
         local_dir: A LocalSyncDir object representing the local directory.
         remote_dir: A RemoteSyncDir object representing the remote directory.
         lock_socket: A unix domain socket used for locking a profile.
+        _sync_dir_args: The settings that the sync directories were created
+            with, or None if they haven't been.
     """
     def __init__(self) -> None:
         os.makedirs(get_profiles_dir(), exist_ok=True)
@@ -65,6 +67,7 @@ class Command(abc.ABC):
         self.local_dir = None
         self.remote_dir = None
         self.lock_socket = None
+        self._sync_dir_args = None
 
     @abc.abstractmethod
     def main(self) -> None:
@@ -103,13 +106,35 @@ class Command(abc.ABC):
         self.profile.read()
         self.lock()
 
-        # Warn if profile is only partially initialized.
+        # Warn if profile is only partially initialized. The profile may be
+        # set up more than once (e.g. by the daemon), so the message is
+        # unregistered first so that it is only printed once.
         if self.profile.status == "partial":
+            atexit.unregister(self.print_interrupt_msg)
             atexit.register(self.print_interrupt_msg)
             raise InputError("invalid profile")
 
-        self.local_dir = LocalSyncDir(self.profile.local_path)
-        self.remote_dir = RemoteSyncDir(self.profile.remote_path)
+        # Sync directories from a previous setup are reused so that their
+        # database connections stay open, unless the settings they were
+        # created with have changed since then.
+        sync_dir_args = (
+            self.profile.local_path, self.profile.snapshot_path,
+            self.profile.remote_path, self.profile.scan_threads)
+        if sync_dir_args != self._sync_dir_args:
+            for sync_dir in [self.local_dir, self.remote_dir]:
+                if sync_dir is not None:
+                    sync_dir.close()
+            self.local_dir = None
+            self.remote_dir = None
+            self._sync_dir_args = sync_dir_args
+
+        if self.local_dir is None:
+            self.local_dir = LocalSyncDir(
+                self.profile.local_path, self.profile.snapshot_path,
+                self.profile.scan_threads)
+        if self.remote_dir is None:
+            self.remote_dir = RemoteSyncDir(
+                self.profile.remote_path, self.profile.scan_threads)
 
     def lock(self) -> None:
         """Lock the profile if not already locked.
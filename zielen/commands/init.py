@@ -115,8 +115,11 @@ class InitCommand(Command):
             # when they're resuming and initialization.
             self.add_remote = self.profile.add_remote
 
-            self.local_dir = LocalSyncDir(self.profile.local_path)
-            self.remote_dir = RemoteSyncDir(self.profile.remote_path)
+            self.local_dir = LocalSyncDir(
+                self.profile.local_path, self.profile.snapshot_path,
+                self.profile.scan_threads)
+            self.remote_dir = RemoteSyncDir(
+                self.profile.remote_path, self.profile.scan_threads)
             fm = FilesManager(self.local_dir, self.remote_dir, self.profile)
         else:
             # Start a new initialization.
@@ -142,8 +145,11 @@ class InitCommand(Command):
             if error_message:
                 raise InputError("remote directory {}".format(error_message))
 
-            self.local_dir = LocalSyncDir(self.profile.local_path)
-            self.remote_dir = RemoteSyncDir(self.profile.remote_path)
+            self.local_dir = LocalSyncDir(
+                self.profile.local_path, self.profile.snapshot_path,
+                self.profile.scan_threads)
+            self.remote_dir = RemoteSyncDir(
+                self.profile.remote_path, self.profile.scan_threads)
             fm = FilesManager(self.local_dir, self.remote_dir, self.profile)
 
             # The profile is now partially initialized. If the
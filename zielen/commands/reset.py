@@ -63,7 +63,11 @@ class ResetCommand(Command):
                     self.remote_dir.safe_path, self.local_dir.path,
                     files=self.remote_dir.get_paths(),
                     message="Retrieving files...",
-                    rm_source=not self.keep_remote)
+                    rm_source=not self.keep_remote,
+                    threads=self.profile.scan_threads,
+                    transfer_threads=self.profile.transfer_threads,
+                    journal_path=os.path.join(
+                        self.profile.journal_dir, "reset"))
             except FileNotFoundError:
                 if not os.path.isdir(self.remote_dir.util_dir):
                     raise RemoteError(
@@ -60,6 +60,33 @@ class SyncCommand(Command):
     def main(self) -> None:
         """Run the command."""
         self.setup_profile()
+        self.sync()
+
+    def sync(self, dirty_paths=None) -> None:
+        """Sync the local and remote directories.
+
+        The profile must already be set up and locked. The same instance can
+        be used for multiple syncs, in which case the database connections
+        and the local snapshot are reused between them.
+
+        Args:
+            dirty_paths: The relative paths of the only files and directories
+                in the local directory that may have changed since the last
+                sync. If given, only these are scanned again, unless it is
+                time for a full scan.
+        """
+        # Any stats from a previous sync are out of date. The remote
+        # directory is always scanned in full because other clients can
+        # change it.
+        scan_time = time.time()
+        if (dirty_paths is not None and scan_time
+                < self.profile.last_rescan + self.profile.rescan_interval):
+            self.local_dir.rescan(dirty_paths)
+        else:
+            self.local_dir.rescan()
+            self.profile.last_rescan = scan_time
+        self.remote_dir.rescan()
+
         fm = FilesManager(self.local_dir, self.remote_dir, self.profile)
         self.remote_dir.add_exclude_file(self.profile.exclude_path, self.profile.id)
 
@@ -73,9 +100,7 @@ class SyncCommand(Command):
 
         # Get the paths of files that have been added, deleted or modified
         # since the last sync.
-        new_paths = fm.compute_added()
-        del_paths = fm.compute_deleted()
-        mod_paths = fm.compute_modified()
+        new_paths, mod_paths, del_paths = fm.compute_changes()
 
         # Add new files to both databases, and inflate the priority of new
         # local files.
@@ -113,7 +138,8 @@ class SyncCommand(Command):
 
         # Calculate which excluded files are still in the remote directory.
         remote_excluded_files = (
-            self.profile.all_exclude_matches(self.local_dir.path)
+            self.profile.all_exclude_matches(
+                self.local_dir.path, self.local_dir.scan_paths())
             & self.remote_dir.scan_paths().keys())
 
         # Decide which files and directories to keep in the local directory.
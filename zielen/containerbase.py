@@ -136,9 +136,18 @@ class SyncDBFile:
         path: The path of the database file.
         _conn: The sqlite connection object for the database.
         _cur: The sqlite cursor object for the connection.
+        _salts: A dict of file paths and their salts from the 'collisions'
+            table, or None if the table hasn't been read yet.
+        _path_ids: A dict of file paths and the IDs that have been derived
+            from them. This is cleared whenever the 'collisions' table changes.
+        _data_version: The data version of the database when the cached path
+            IDs were last checked, or None if they haven't been.
     """
     def __init__(self, path: str) -> None:
         self.path = path
+        self._salts = None
+        self._path_ids = {}
+        self._data_version = None
         if os.path.isfile(self.path):
             self._conn = sqlite3.connect(
                 self.path,
@@ -168,8 +177,34 @@ class SyncDBFile:
         """
         if not self.path == ":memory:" and not os.path.isfile(self.path):
             raise RemoteError("could not connect to the database file")
-        with self._conn:
-            yield
+        self._check_path_ids()
+        try:
+            with self._conn:
+                yield
+        except BaseException:
+            # Salts inserted during the transaction have been rolled back.
+            self._clear_path_ids()
+            raise
+
+    def _clear_path_ids(self) -> None:
+        """Clear cached path IDs after the 'collisions' table is modified."""
+        self._salts = None
+        self._path_ids.clear()
+
+    def _check_path_ids(self) -> None:
+        """Clear cached path IDs if another connection changed the database.
+
+        Other clients and processes may add salts to the 'collisions' table at
+        any time, so this is checked at the start of each operation that
+        derives path IDs.
+        """
+        self._cur.execute("""\
+            PRAGMA data_version;
+            """)
+        data_version = self._cur.fetchone()[0]
+        if data_version != self._data_version:
+            self._clear_path_ids()
+            self._data_version = data_version
 
     def _mark_directory(self, paths: Iterable[str]) -> None:
         """Mark paths as directories."""
@@ -190,7 +225,9 @@ class SyncDBFile:
         """Return a 64-bit integer derived from the given file path.
 
         If the file path is in the 'collisions' table, then the salt from that
-        table is used to generate a unique ID.
+        table is used to generate a unique ID. The 'collisions' table is read
+        once and IDs are cached until the table is modified, either by this
+        connection or by another one (see _check_path_ids()).
 
         Args:
             path: The file path from which to derive the ID.
@@ -198,21 +235,51 @@ class SyncDBFile:
         Returns:
             A signed 64-bit integer.
         """
-        self._cur.execute("""\
-            SELECT salt
-            FROM collisions
-            WHERE path = :path;
-            """, {"path": path})
+        try:
+            return self._path_ids[path]
+        except KeyError:
+            pass
+
+        if self._salts is None:
+            self._cur.execute("""\
+                SELECT path, salt
+                FROM collisions;
+                """)
+            self._salts = dict(self._cur.fetchall())
 
-        salt = self._cur.fetchone()
-        hash_string = path
-        if salt:
-            hash_string += salt[0]
+        hash_string = path + self._salts.get(path, "")
 
         path_hash = hashlib.sha256()
         path_hash.update(hash_string.encode())
-        return int.from_bytes(
+        path_id = int.from_bytes(
             path_hash.digest()[:8], byteorder="big", signed=True)
+        self._path_ids[path] = path_id
+        return path_id
+
+    def _fill_lookup_table(self, paths: Iterable[str]) -> None:
+        """Store the IDs of some paths in the temporary 'lookup' table.
+
+        This allows information about many paths to be retrieved with a
+        single join instead of one query per path.
+
+        Args:
+            paths: The file paths to store the IDs of.
+        """
+        # A generator expression can't be used here because recursive use of
+        # cursors is not allowed.
+        lookup_vals = [(self._get_path_id(path),) for path in paths]
+
+        self._cur.execute("""\
+            CREATE TEMP TABLE IF NOT EXISTS lookup (
+                id INTEGER PRIMARY KEY);
+            """)
+        self._cur.execute("""\
+            DELETE FROM lookup;
+            """)
+        self._cur.executemany("""\
+            INSERT OR IGNORE INTO lookup (id)
+            VALUES (?);
+            """, lookup_vals)
 
     def commit(self) -> None:
         """Commit the database transaction."""
@@ -20,14 +20,243 @@ along with zielen.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import sys
 import time
-import queue
+import asyncio
+import logging
 import sqlite3
 import threading
 import subprocess
-
-import pyinotify
+import collections
+import multiprocessing
+import concurrent.futures
+from typing import Callable, NamedTuple, Optional, Set
 
 from zielen.commandbase import Command
+from zielen.commands.sync import SyncCommand
+from zielen.exceptions import ProgramError
+from zielen.profile import Profile
+from zielen.watchers import start_watcher
+
+logger = logging.getLogger(__name__)
+
+AggregatorStats = NamedTuple(
+    "AggregatorStats",
+    [("pending_paths", int), ("pending_accesses", int),
+     ("flush_latency", float), ("flushed_accesses", int)])
+
+
+class AccessAggregator:
+    """Count file accesses in memory and write them to the database in batches.
+
+    Accesses of the same file within a "cooldown" period are counted once.
+    Files are kept in the order they were last counted, so expired cooldowns
+    are removed from the front without checking every file.
+
+    Args:
+        cooldown_period: The number of seconds that must pass after an access
+            of a file is counted before another one can be counted.
+        increment_amount: The value to add to the priority of a file for each
+            access.
+
+    Attributes:
+        cooldown_period: The number of seconds that must pass after an access
+            of a file is counted before another one can be counted.
+        increment_amount: The value to add to the priority of a file for each
+            access.
+        _counts: A Counter of the paths of files that have been accessed
+            since the last flush.
+        _cooldown_files: An OrderedDict of paths of files whose accesses were
+            counted within the past cooldown period and the times they were
+            counted, in the order they were counted.
+        _lock: A lock which must be held to access the counts.
+        _flush_latency: The number of seconds the last flush took.
+        _flushed_accesses: The total number of accesses that have been
+            written to the database.
+    """
+    def __init__(self, cooldown_period: float, increment_amount: float) -> None:
+        self.cooldown_period = cooldown_period
+        self.increment_amount = increment_amount
+        self._counts = collections.Counter()
+        self._cooldown_files = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_latency = 0.0
+        self._flushed_accesses = 0
+
+    def record(self, path: str, timestamp: float) -> None:
+        """Count an access of a file unless it is within the cooldown period.
+
+        Args:
+            path: The relative path of the file.
+            timestamp: The time the file was accessed in epoch time.
+        """
+        with self._lock:
+            # Remove files whose cooldown period has passed.
+            while self._cooldown_files:
+                oldest_path, oldest_timestamp = next(
+                    iter(self._cooldown_files.items()))
+                if oldest_timestamp > timestamp - self.cooldown_period:
+                    break
+                del self._cooldown_files[oldest_path]
+
+            if path in self._cooldown_files:
+                return
+            self._cooldown_files[path] = timestamp
+            self._counts[path] += 1
+
+    def flush(self, profile: Profile) -> int:
+        """Increment the priority of every file that has been accessed.
+
+        Files that are not in the database are ignored. New files do not have
+        a priority value until the first sync after they are added. If the
+        database can't be written to, the counts are kept for the next flush.
+
+        Args:
+            profile: The profile to increment the priorities in.
+
+        Returns:
+            The number of accesses that were written to the database.
+
+        Raises:
+            sqlite3.OperationalError: The database is locked.
+        """
+        with self._lock:
+            counts, self._counts = self._counts, collections.Counter()
+        if not counts:
+            return 0
+
+        start_time = time.perf_counter()
+        try:
+            known_paths = profile.lookup_paths(counts.keys())
+
+            # Files accessed the same number of times are incremented in a
+            # single statement.
+            paths_by_count = collections.defaultdict(list)
+            for path in known_paths:
+                paths_by_count[counts[path]].append(path)
+            for count, paths in paths_by_count.items():
+                profile.increment(paths, count * self.increment_amount)
+        except sqlite3.OperationalError:
+            with self._lock:
+                self._counts.update(counts)
+            raise
+
+        flushed_accesses = sum(
+            count * len(paths) for count, paths in paths_by_count.items())
+        self._flush_latency = time.perf_counter() - start_time
+        self._flushed_accesses += flushed_accesses
+        logger.debug(
+            "flushed {0} accesses of {1} files in {2:.3f}s".format(
+                flushed_accesses, len(counts), self._flush_latency))
+        return flushed_accesses
+
+    @property
+    def stats(self) -> AggregatorStats:
+        """Statistics about the accesses that have been counted.
+
+        Returns:
+            A named tuple containing the number of files and accesses waiting
+            to be flushed, the number of seconds the last flush took and the
+            total number of accesses that have been flushed.
+        """
+        with self._lock:
+            return AggregatorStats(
+                len(self._counts), sum(self._counts.values()),
+                self._flush_latency, self._flushed_accesses)
+
+
+class ChangeTrigger:
+    """Decide when to sync after files change.
+
+    A sync is due once no file has changed for a "delay" period, so that a
+    burst of changes is synced at once. If files keep changing, a sync is due
+    once the "maximum delay" has passed since the first change that hasn't
+    been synced. Changes made while a sync is running can't be told apart
+    from the ones made by the sync itself, so they are all synced by a single
+    follow-up sync once the delay has passed after the sync finishes.
+
+    Args:
+        delay: The number of seconds to wait after the last change.
+        max_delay: The maximum number of seconds to wait after the first
+            change.
+
+    Attributes:
+        delay: The number of seconds to wait after the last change.
+        max_delay: The maximum number of seconds to wait after the first
+            change.
+        _first_change: The time of the first change since the last sync in
+            epoch time, or None if there hasn't been one.
+        _last_change: The time of the last change since the last sync in
+            epoch time, or None if there hasn't been one.
+        _paused: Whether a sync is running.
+        _changed_while_paused: Whether a file has changed while a sync was
+            running.
+    """
+    def __init__(self, delay: float, max_delay: float) -> None:
+        self.delay = delay
+        self.max_delay = max_delay
+        self._first_change = None
+        self._last_change = None
+        self._paused = False
+        self._changed_while_paused = False
+
+    def add_change(self, timestamp: float) -> None:
+        """Record that a file has changed.
+
+        Args:
+            timestamp: The time of the change in epoch time.
+        """
+        if self._paused:
+            self._changed_while_paused = True
+            return
+        if self._first_change is None:
+            self._first_change = timestamp
+        self._last_change = timestamp
+
+    def reset(self) -> None:
+        """Forget the changes that have been recorded."""
+        self._first_change = None
+        self._last_change = None
+
+    def pause(self) -> None:
+        """Forget the changes being synced once a sync has started."""
+        self.reset()
+        self._paused = True
+        self._changed_while_paused = False
+
+    def resume(self, timestamp: float) -> None:
+        """Start recording changes again once a sync has finished.
+
+        Args:
+            timestamp: The time the sync finished in epoch time. If any file
+                changed during the sync, it counts as a change at this time.
+        """
+        self._paused = False
+        if self._changed_while_paused:
+            self.add_change(timestamp)
+
+    @property
+    def deadline(self) -> Optional[float]:
+        """The time a sync is due in epoch time, or None if it isn't."""
+        if self._first_change is None:
+            return None
+        return min(
+            self._last_change + self.delay,
+            self._first_change + self.max_delay)
+
+
+def _sync_in_child(profile_input: str) -> None:
+    """Run a sync in a process started by the fork server.
+
+    Args:
+        profile_input: The name of the profile or the path of its local
+            directory.
+    """
+    logging.basicConfig(format="Debug: %(message)s", level=logging.DEBUG)
+    try:
+        SyncCommand(profile_input).main()
+    except ProgramError as error:
+        for message in error.args:
+            print("Error: {0}".format(message), file=sys.stderr)
+        sys.exit(1)
 
 
 class Daemon(Command):
@@ -36,8 +265,16 @@ class Daemon(Command):
     Every time a file or symlink is opened in the local directory, increment
     its priority value by a constant. There is a "cooldown" period that
     coalesces quick successive openings of the same file. At regular
-    intervals, multiply the priority values of each file by a constant. Run
-    the 'sync' command at a regular user-defined interval.
+    intervals, make the priority values of each file decay by scaling up
+    future increments. Run the 'sync' command at a regular user-defined
+    interval, and optionally shortly after files in the local directory
+    change. Syncs run either in a subprocess, in the daemon itself or in a
+    process forked from a fork server.
+
+    Everything runs in an asyncio event loop which reads file access events
+    as they arrive and wakes up only when there is work to do. Database work is
+    done in a single worker thread, because an sqlite connection can only be
+    used by the thread that opened it.
 
     Attributes:
         ADJUST_INTERVAL: The number of seconds to wait between making priority
@@ -48,149 +285,365 @@ class Daemon(Command):
         COOLDOWN_PERIOD: The number of seconds that must pass after a file has
             had its priority incremented before its priority can be incremented
             again.
-        SYNC_SLEEP_TIME: The number of seconds to wait between sync attempts.
-        TRANSACTION_SLEEP_TIME: The number of seconds to wait between making
-            database transactions.
+        MAX_DIRTY_PATHS: The number of changed paths to keep track of between
+            syncs before falling back to a full scan.
         profile: The currently selected profile.
-        _files_queue: A queue of filesystem events that are waiting to be
-            processed.
-        _cooldown_files: A dict of file paths that have been opened within the
-            past COOLDOWN_PERIOD seconds and their timestamps.
+        _aggregator: An AccessAggregator that counts file accesses until they
+            are written to the database.
+        _loop: The event loop that the daemon runs in.
+        _db_executor: The executor that database work is run in.
+        _flush_handle: The handle of the scheduled flush, or None if there
+            isn't one.
+        _sync_command: The SyncCommand used for syncs in the daemon itself,
+            which is kept between syncs, or None if there isn't one.
+        _sync_context: The multiprocessing context used for syncs in a fork
+            server, or None if it hasn't been created.
+        _watching_changes: Whether changes in the local directory are being
+            watched.
+        _dirty_paths: A set of relative paths of files and directories in the
+            local directory that have changed since the last sync.
+        _dirty_complete: Whether every change since the last sync is in the
+            set of changed paths.
+        _dirty_lock: A lock which must be held to access the changed paths.
+        _change_trigger: A ChangeTrigger which decides when to sync after
+            files in the local directory change, or None if syncs only
+            happen at regular intervals.
+        _sync_wakeup: An event which is set when the time of the next sync
+            may have changed.
     """
     ADJUST_INTERVAL = 10*60
     INCREMENT_AMOUNT = 1
     COOLDOWN_PERIOD = 1
-    SYNC_SLEEP_TIME = 3
-    TRANSACTION_SLEEP_TIME = 3
+    MAX_DIRTY_PATHS = 100000
 
     def __init__(self, profile_input: str) -> None:
         super().__init__()
         self.profile_input = profile_input
         self.profile = self.select_profile(profile_input)
-        self._files_queue = queue.Queue()
-        self._cooldown_files = {}
+        self._aggregator = AccessAggregator(
+            self.COOLDOWN_PERIOD, self.INCREMENT_AMOUNT)
+        self._loop = None
+        self._db_executor = None
+        self._flush_handle = None
+        self._sync_command = None
+        self._sync_context = None
+        self._watching_changes = False
+        self._dirty_paths = set()
+        self._dirty_complete = False
+        self._dirty_lock = threading.Lock()
+        self._change_trigger = None
+        self._sync_wakeup = None
 
     def main(self) -> None:
         """Start the daemon."""
-        self.profile.read()
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._db_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1)
+        try:
+            self._loop.run_until_complete(self._run())
+        finally:
+            self._db_executor.shutdown()
+            self._loop.close()
 
-        sync_thread = threading.Thread(target=self._sync, daemon=True)
-        sync_thread.start()
+    def _run_db(self, func: Callable, *args) -> asyncio.Future:
+        """Run a function that uses the database in the worker thread.
+
+        Args:
+            func: The function to call.
+            args: The arguments to pass to the function.
+
+        Returns:
+            A future for the return value of the function.
+        """
+        return self._loop.run_in_executor(self._db_executor, func, *args)
+
+    def _open_profile(self) -> Profile:
+        """Open the selected profile so that it can be used in this thread."""
+        profile = Profile(self.profile.name)
+        profile.read()
+        return profile
+
+    async def _run(self) -> None:
+        """Watch for file access and schedule database work and syncs."""
+        self.profile = await self._run_db(self._open_profile)
 
         local_dir = self.profile.local_path
         remote_dir = self.profile.remote_path
+        watch_paths = [local_dir, remote_dir]
 
-        wm = pyinotify.WatchManager()
-        notifier = pyinotify.ThreadedNotifier(
-            wm, lambda x: self._files_queue.put((x, time.time())))
-        notifier.daemon = True
-        notifier.start()
+        def handle_access(path: str) -> None:
+            for watch_path in watch_paths:
+                if os.path.commonpath([path, watch_path]) == watch_path:
+                    self._aggregator.record(
+                        os.path.relpath(path, watch_path), time.time())
+                    self._schedule_flush()
+                    break
 
-        mask = pyinotify.IN_OPEN | pyinotify.IN_CREATE
-        watch_paths = [local_dir, remote_dir]
-        for watch_path in watch_paths:
-            wm.add_watch(watch_path, mask, rec=True, auto_add=True)
-
-        # Every few seconds, get a set of file paths from the queue and
-        # increment their priority values in the database. This is done to
-        # spread out the individual sqlite transactions over time so that
-        # the database isn't a bottleneck.
-        deduplicated_paths = []
-        while True:
-            # Get the paths of files that have been accessed.
-            accessed_paths = []
-            while not self._files_queue.empty():
-                event, timestamp = self._files_queue.get()
-                for watch_path in watch_paths:
-                    if os.path.commonpath([
-                            event.pathname, watch_path]) == watch_path:
-                        rel_path = os.path.relpath(event.pathname, watch_path)
-                        break
-
-                if not event.dir and self.profile.get_path_info(rel_path):
-                    # The file is in the local database and is not a directory.
-                    # New files do not have a priority value until the first
-                    # sync after they are added.
-                    accessed_paths.append((rel_path, timestamp))
-
-            for path, timestamp in accessed_paths:
-                past_timestamp = self._cooldown_files.get(path)
-
-                if ((past_timestamp
-                        and timestamp > past_timestamp + self.COOLDOWN_PERIOD)
-                        or not past_timestamp):
-                    # The time at which the current file was opened is not
-                    # within self.COOLDOWN_PERIOD seconds of the time it
-                    # was last opened.
-                    deduplicated_paths.append(path)
-
-                    # Update the timestamp for accessed file paths. Putting
-                    # this inside the conditional statement prevents the
-                    # cooldown period from lasting more than
-                    # self.COOLDOWN_PERIOD seconds.
-                    self._cooldown_files[path] = timestamp
-
-            # Remove any file paths that were modified more than
-            # self.COOLDOWN_PERIOD seconds in the past.
-            current_time = time.time()
-            self._cooldown_files = {
-                path: timestamp
-                for path, timestamp in self._cooldown_files.items()
-                if timestamp > current_time - self.COOLDOWN_PERIOD}
-
-            # If the database is locked due to a long-running sync, try again.
-            try:
-                self._adjust()
-                self.profile.increment(
-                    deduplicated_paths, self.INCREMENT_AMOUNT)
-                self.profile.read()
-                self.profile.write()
-            except sqlite3.OperationalError:
-                continue
-            else:
-                deduplicated_paths = []
-            finally:
-                time.sleep(self.TRANSACTION_SLEEP_TIME)
+        # Changes are used to trigger syncs and to limit the scans of syncs
+        # which run in the daemon itself.
+        self._sync_wakeup = asyncio.Event()
+        if self.profile.sync_delay is not None:
+            self._change_trigger = ChangeTrigger(
+                self.profile.sync_delay, self.profile.max_sync_delay)
+        in_process = self.profile.sync_mode == "inprocess"
+        watch_changes = in_process or self._change_trigger is not None
 
-    def _adjust(self) -> None:
-        """Adjust the priority values in the database at regular intervals."""
+        watcher = start_watcher(
+            self.profile.watch_backend, watch_paths, handle_access,
+            self._loop, self._handle_change if watch_changes else None)
+        self._watching_changes = watcher.REPORTS_CHANGES and in_process
+        if watch_changes and not watcher.REPORTS_CHANGES:
+            logger.warning(
+                "the watch backend doesn't report changes to files, so "
+                "SyncDelay and partial rescans have no effect")
+        try:
+            await asyncio.gather(
+                self._adjust_periodically(), self._sync_periodically())
+        finally:
+            watcher.stop()
+
+    def _handle_change(self, path: Optional[str]) -> None:
+        """Keep track of a change reported by the watcher.
+
+        Args:
+            path: The absolute path of the file or directory that changed, or
+                None if changes may have been missed.
+        """
+        local_dir = self.profile.local_path
+        if path is None:
+            self._mark_dirty(None)
+        elif os.path.commonpath([path, local_dir]) == local_dir:
+            rel_path = os.path.relpath(path, local_dir)
+            if rel_path == ".":
+                return
+            self._mark_dirty(rel_path)
+        else:
+            return
+
+        if self._change_trigger is not None:
+            self._change_trigger.add_change(time.time())
+            self._sync_wakeup.set()
+
+    def _schedule_flush(self) -> None:
+        """Write counted accesses to the database after the flush interval.
+
+        This is done to spread out the individual sqlite transactions over
+        time so that the database isn't a bottleneck.
+        """
+        if self._flush_handle is None:
+            self._flush_handle = self._loop.call_later(
+                self.profile.flush_interval,
+                lambda: self._loop.create_task(self._flush()))
+
+    def _write_accesses(self) -> None:
+        """Write counted accesses to the database."""
+        if self._aggregator.flush(self.profile):
+            self.profile.read()
+            self.profile.write()
+
+    async def _flush(self) -> None:
+        """Write counted accesses to the database in the worker thread."""
+        # Accesses counted from now on need another flush.
+        self._flush_handle = None
+        try:
+            await self._run_db(self._write_accesses)
+        except sqlite3.OperationalError:
+            # The database is locked due to a long-running sync, so the
+            # accesses are kept to try again later.
+            pass
+
+        if self._aggregator.stats.pending_accesses:
+            self._schedule_flush()
+
+    def _adjust(self) -> float:
+        """Adjust the priority values in the database if it is time to.
+
+        Returns:
+            The number of seconds until the next adjustment.
+        """
         if time.time() >= self.profile.last_adjust + self.ADJUST_INTERVAL:
             # This is necessary because a sync may have occurred since
             # the last adjustment, which updates a value in the info
             # file. If we don't read the info file before writing to it,
             # that value will get reset.
             self.profile.read()
+            self.profile.adjust_priority(self.ADJUST_INTERVAL)
+            self.profile.write()
+        return self.profile.last_adjust + self.ADJUST_INTERVAL - time.time()
 
-            # Use the formula for half-life to calculate the constant to
-            # multiply each priority value by.
-            half_life = self.profile.priority_half_life
-            adjust_constant = 0.5 ** (self.ADJUST_INTERVAL / half_life)
+    async def _adjust_periodically(self) -> None:
+        """Adjust the priority values in the database at regular intervals."""
+        while True:
+            try:
+                delay = await self._run_db(self._adjust)
+            except sqlite3.OperationalError:
+                # If the database is locked due to a long-running sync, try
+                # again later.
+                delay = self.profile.flush_interval
+            await asyncio.sleep(max(delay, 0))
 
-            self.profile.adjust_all(adjust_constant)
-            self.profile.last_adjust = time.time()
-            self.profile.write()
+    def _mark_dirty(self, path: Optional[str]) -> None:
+        """Keep track of a path in the local directory that has changed.
+
+        Args:
+            path: The relative path of the file or directory, or None if
+                changes may have been missed.
+        """
+        with self._dirty_lock:
+            if not self._dirty_complete:
+                return
+            if path is None or len(self._dirty_paths) >= self.MAX_DIRTY_PATHS:
+                self._dirty_paths = set()
+                self._dirty_complete = False
+            else:
+                self._dirty_paths.add(path)
+
+    def _take_dirty_paths(self) -> Optional[Set[str]]:
+        """Get the paths that have changed since the last sync and start over.
+
+        Returns:
+            A set of relative paths of files and directories in the local
+            directory, or None if changes may have been missed.
+        """
+        with self._dirty_lock:
+            paths = self._dirty_paths if self._dirty_complete else None
+            self._dirty_paths = set()
+            self._dirty_complete = self._watching_changes
+        return paths
+
+    def _sync_in_process(self) -> None:
+        """Run a sync in the worker thread.
+
+        The profile and the local directory are kept between syncs so that
+        the database connections and the local snapshot don't have to be
+        opened again, unless the settings they depend on change. The remote
+        directory is closed after each sync so that it can be unmounted in
+        between. While the sync runs, database work from the daemon waits for
+        it to finish.
+
+        Only the local paths that the daemon has seen change since the last
+        sync are scanned again, with the rest of the stats taken from the
+        snapshot. If a sync fails, the next one scans everything.
+        """
+        if self._sync_command is None:
+            self._sync_command = SyncCommand(self.profile_input)
+            # Share the daemon's database connection.
+            self._sync_command.profile = self.profile
+
+        command = self._sync_command
+        try:
+            command.setup_profile()
+            command.sync(self._take_dirty_paths())
+        except ProgramError as error:
+            self._mark_dirty(None)
+            for message in error.args:
+                print("Error: {0}".format(message), file=sys.stderr)
+        except Exception:
+            # Start from scratch next time in case the state of the command
+            # is inconsistent.
+            self._mark_dirty(None)
+            logger.exception("the sync failed")
+            self._sync_command = None
+        finally:
+            if command.lock_socket is not None:
+                command.lock_socket.close()
+            if command.remote_dir is not None:
+                command.remote_dir.close()
+                command.remote_dir = None
+
+    def _sync_in_forkserver(self) -> None:
+        """Run a sync in a process forked from the fork server and wait.
+
+        The fork server is started the first time and has the program
+        already imported, so each sync avoids the startup time of a new
+        interpreter while still running in a separate process.
+        """
+        if self._sync_context is None:
+            self._sync_context = multiprocessing.get_context("forkserver")
+            self._sync_context.set_forkserver_preload(["zielen.daemon"])
+
+        process = self._sync_context.Process(
+            target=_sync_in_child, args=(self.profile_input,))
+        process.start()
+        process.join()
 
-    def _sync(self) -> None:
-        """Initiate a sync in a subprocess at a regular interval."""
+    async def _sync_in_subprocess(self) -> None:
+        """Run a sync in a new 'zielen' subprocess and wait for it."""
+        try:
+            process = await asyncio.create_subprocess_exec(
+                "zielen", "--debug", "sync", self.profile_input,
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                stderr=subprocess.PIPE)
+        except OSError as error:
+            print("Error: could not start sync: {0}".format(error),
+                  file=sys.stderr)
+            return
+
+        # Print the subprocess's stderr to stderr so that it is added to the
+        # journal.
+        while True:
+            line = await process.stderr.readline()
+            if not line:
+                break
+            print(line.decode(errors="replace"), file=sys.stderr, end="")
+        await process.wait()
+
+    async def _sync(self) -> None:
+        """Run a sync in the way chosen by the user and wait for it.
+
+        Changes in the local directory don't trigger another sync while the
+        sync runs. If there were any, one more sync is due once the delay has
+        passed after this one finishes. Changes reported after that are
+        debounced along with it.
+        """
+        if self._change_trigger is not None:
+            self._change_trigger.pause()
+        try:
+            # Using a separate process means that an in-progress sync
+            # continues after the daemon exits and that functions registered
+            # with atexit run when the sync ends. Running the sync in the
+            # daemon itself avoids starting a process and keeps the databases
+            # open between syncs, but an in-progress sync is stopped along
+            # with the daemon, and atexit functions only run once the daemon
+            # exits.
+            if self.profile.sync_mode == "inprocess":
+                await self._run_db(self._sync_in_process)
+            elif self.profile.sync_mode == "forkserver":
+                await self._loop.run_in_executor(
+                    None, self._sync_in_forkserver)
+            else:
+                await self._sync_in_subprocess()
+            sys.stderr.flush()
+        finally:
+            if self._change_trigger is not None:
+                self._change_trigger.resume(time.time())
+
+    async def _sync_periodically(self) -> None:
+        """Initiate a sync at a regular interval and after files change.
+
+        Changes made while a sync is running are synced by a single sync
+        after it is complete.
+        """
         last_attempt = self.profile.last_sync
         while True:
-            if time.time() >= last_attempt + self.profile.sync_interval:
-                # Use a subprocess so that an in-progress sync continues
-                # after the daemon exits and so that functions registered
-                # with atexit execute correctly.
-                cmd = subprocess.Popen(
-                    ["zielen", "--debug", "sync", self.profile_input],
-                    bufsize=1, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE, universal_newlines=True)
-
-                # Print the subprocess's stderr to stderr so that it is
-                # added to the journal.
-                for line in cmd.stderr:
-                    if line:
-                        print(line, file=sys.stderr, end="")
-                cmd.wait()
-                sys.stderr.flush()
-
-                # If a sync fails, wait the full interval before trying again.
-                last_attempt = time.time()
-            time.sleep(self.SYNC_SLEEP_TIME)
+            deadline = last_attempt + self.profile.sync_interval
+            if (self._change_trigger is not None
+                    and self._change_trigger.deadline is not None):
+                deadline = min(deadline, self._change_trigger.deadline)
+
+            delay = deadline - time.time()
+            if delay > 0:
+                # Wake up early if a file changes, since that could move
+                # the time of the next sync.
+                self._sync_wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._sync_wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._sync()
+
+            # If a sync fails, wait the full interval before trying again.
+            last_attempt = time.time()
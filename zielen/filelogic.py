@@ -18,15 +18,18 @@ You should have received a copy of the GNU General Public License
 along with zielen.  If not, see <http://www.gnu.org/licenses/>.
 """
 import os
-import copy
 import time
 import shutil
-from typing import Iterable, Tuple, Set, NamedTuple
+import stat as statmod
+import collections
+from typing import (
+    Iterable, Tuple, Set, NamedTuple, Dict, List, Any, Generator)
 
 from zielen.exceptions import RemoteError, AvailableSpaceError
 from zielen.profile import Profile, ProfileExcludeFile
 from zielen.userdata import LocalSyncDir, RemoteSyncDir
-from zielen.utils import timestamp_path
+from zielen.utils import timestamp_path, PathTrie
+from zielen.selection import FileSelector
 from zielen.fstools import (
     is_unsafe_symlink, symlink_tree, transfer_tree, update_mtime)
 
@@ -51,6 +54,12 @@ class UpdatedPaths(UpdatedPathsBase):
         return self.local | self.remote
 
 
+ChangedPaths = NamedTuple(
+    "ChangedPaths",
+    [("added", UpdatedPaths), ("modified", UpdatedPaths),
+     ("deleted", DeletedPaths)])
+
+
 class PathsDiff:
     """Compare two sets of file paths.
 
@@ -63,17 +72,35 @@ class PathsDiff:
         starting_paths: The file paths used to populate the initial set.
 
     Attributes:
-        _path_pairs: A set of tuples each containing a pair of file paths, with
-            the first belonging to the initial set and the second belonging to
-            the resultant set. For paths that are in one set and not the other,
-            the other item in the tuple will be None.
+        _res_by_init: A dict mapping each path in the initial set to the path
+            it has in the resultant set, or None if it has been removed.
+        _inits_by_res: A dict mapping each path in the resultant set that came
+            from the initial set to the set of paths it came from.
+        _added_paths: The set of paths that were added to the resultant set
+            without coming from the initial set.
         init_paths: The set of all paths that are in the initial set.
         res_paths: The set of all paths that are in the resultant set.
         mod_paths: The set of all path pairs where both paths exist and are
             different.
     """
     def __init__(self, starting_paths: Iterable[str]) -> None:
-        self._path_pairs = {(path, path) for path in starting_paths}
+        self._res_by_init = {path: path for path in starting_paths}
+        self._inits_by_res = {path: {path} for path in self._res_by_init}
+        self._added_paths = set()
+
+    def _unlink(self, init_path: str) -> None:
+        """Remove the mapping from a path in the initial set to its result.
+
+        Args:
+            init_path: The path in the initial set.
+        """
+        res_path = self._res_by_init[init_path]
+        if res_path is None:
+            return
+        init_paths = self._inits_by_res[res_path]
+        init_paths.discard(init_path)
+        if not init_paths:
+            del self._inits_by_res[res_path]
 
     def rm(self, paths: Iterable[str]) -> None:
         """Remove paths from the resultant set.
@@ -82,10 +109,9 @@ class PathsDiff:
             paths: The paths to remove from the resultant set.
         """
         for rm_path in paths:
-            self._path_pairs = {
-                (init_path, None)
-                if res_path == rm_path else (init_path, res_path)
-                for init_path, res_path in self._path_pairs}
+            for init_path in self._inits_by_res.pop(rm_path, ()):
+                self._res_by_init[init_path] = None
+            self._added_paths.discard(rm_path)
 
     def add(self, paths: Iterable[str]) -> None:
         """Add paths to the resultant set.
@@ -93,8 +119,7 @@ class PathsDiff:
         Args:
             paths: The paths to add to the resultant set.
         """
-        add_pairs = {(None, path) for path in paths}
-        self._path_pairs |= add_pairs
+        self._added_paths.update(paths)
 
     def rename(self, new_pairs: Iterable[Tuple[str, str]]) -> None:
         """Give paths in the initial set a new name in the resultant set.
@@ -105,10 +130,11 @@ class PathsDiff:
                 second being the new name to give it in the resultant set.
         """
         for old_path, new_path in new_pairs:
-            self._path_pairs = {
-                (init_path, new_path)
-                if init_path == old_path else (init_path, res_path)
-                for init_path, res_path in self._path_pairs}
+            if old_path not in self._res_by_init:
+                continue
+            self._unlink(old_path)
+            self._res_by_init[old_path] = new_path
+            self._inits_by_res.setdefault(new_path, set()).add(old_path)
 
     @property
     def init_paths(self) -> Set[str]:
@@ -117,9 +143,7 @@ class PathsDiff:
         Returns:
             The set of file paths in the initial set.
         """
-        paths = {
-            old_path for old_path, new_path in self._path_pairs if old_path}
-        return paths
+        return set(self._res_by_init)
 
     @property
     def res_paths(self) -> Set[str]:
@@ -128,9 +152,7 @@ class PathsDiff:
         Returns:
             The set of file paths in teh resultant set.
         """
-        paths = {
-            new_path for old_path, new_path in self._path_pairs if new_path}
-        return paths
+        return self._inits_by_res.keys() | self._added_paths
 
     @property
     def mod_paths(self) -> Set[Tuple[str, str]]:
@@ -140,20 +162,31 @@ class PathsDiff:
             The set of tuples each containing a path from the initial set and a
             path from the resultant set where both are different and not None.
         """
-        paths = {
-            (new_path, old_path) for new_path, old_path in self._path_pairs
-            if new_path and old_path and new_path != old_path}
-        return paths
+        return {
+            (init_path, res_path)
+            for init_path, res_path in self._res_by_init.items()
+            if res_path is not None and init_path != res_path}
 
     def __or__(self, in_object):
         """Create a new FilesDiff object that is the union of two others.
 
+        Paths in the initial set of both objects take their name in the
+        resultant set from the second object.
+
         Args:
             in_object: The FilesDiff object to get file paths from.
         """
         if isinstance(in_object, type(self)):
-            new_self = copy.deepcopy(self)
-            new_self._path_pairs |= in_object._path_pairs
+            new_self = type(self)([])
+            for diff in (self, in_object):
+                for init_path, res_path in diff._res_by_init.items():
+                    if init_path in new_self._res_by_init:
+                        new_self._unlink(init_path)
+                    new_self._res_by_init[init_path] = res_path
+                    if res_path is not None:
+                        new_self._inits_by_res.setdefault(
+                            res_path, set()).add(init_path)
+                new_self._added_paths |= diff._added_paths
             return new_self
         else:
             raise TypeError(
@@ -161,6 +194,77 @@ class PathsDiff:
                     type(self), type(in_object)))
 
 
+def _get_ancestors(path: str) -> List[str]:
+    """Get the paths of every parent directory of a relative path.
+
+    Args:
+        path: The relative path to get the ancestors of.
+
+    Returns:
+        A list of paths sorted from leaf to trunk, not including the input
+        path.
+    """
+    ancestors = []
+    parent = os.path.dirname(path)
+    while parent:
+        ancestors.append(parent)
+        parent = os.path.dirname(parent)
+    return ancestors
+
+
+def _merge_sorted(*streams: Iterable[Tuple[str, Any]]) -> Generator[
+        Tuple[str, Tuple[Any, ...]], None, None]:
+    """Merge streams of paths that are each sorted by path.
+
+    Args:
+        streams: Iterables of tuples containing a unique path and a value,
+            sorted by path.
+
+    Yields:
+        A tuple containing each path from any of the streams in sorted order
+        and a tuple of the value from each stream, with None for the streams
+        that don't contain the path.
+    """
+    iterators = [iter(stream) for stream in streams]
+    heads = [next(iterator, None) for iterator in iterators]
+    while True:
+        paths = [head[0] for head in heads if head is not None]
+        if not paths:
+            return
+        path = min(paths)
+
+        values = []
+        for i, head in enumerate(heads):
+            if head is not None and head[0] == path:
+                values.append(head[1])
+                heads[i] = next(iterators[i], None)
+            else:
+                values.append(None)
+        yield path, tuple(values)
+
+
+def _sum_subtrees(values: Dict[str, int]) -> Dict[str, int]:
+    """Sum values over every subtree in a single bottom-up pass.
+
+    Args:
+        values: A dict of relative paths and a value for each one.
+
+    Returns:
+        A dict of the same paths and the sum of the value of each path and
+        the values of all paths under it.
+    """
+    totals = dict(values)
+
+    # Visit paths from leaf to trunk so that the total of every path is
+    # complete before it is added to its parent.
+    for path in sorted(totals, key=lambda x: x.count(os.sep), reverse=True):
+        parent = os.path.dirname(path)
+        if parent in totals:
+            totals[parent] += totals[path]
+
+    return totals
+
+
 class FilesManager:
     """Manage the movement of files in the local and remote directories.
 
@@ -197,58 +301,28 @@ class FilesManager:
             local directory and the amount of space remaining (in bytes) until
             the storage limit is reached.
         """
-        if exclude is None:
-            exclude = []
-
         # File stats must be fetched again because files in the remote 
         # directory may have been updated by changes in the local directory,
         # changing their size.
         local_files = self.profile.get_paths(directory=False)
         remote_stats = self.remote_dir.scan_paths(dirs=False, memoize=False)
         local_stats = self.local_dir.scan_paths()
-        adjusted_priorities = []
 
-        # Adjust directory priorities for size.
+        selector = FileSelector(
+            exclude=exclude, account_for_size=self.profile.account_for_size)
         for file_path, file_data in local_files.items():
-            for exclude_path in exclude:
-                if (file_path == exclude_path
-                    or file_path.startswith(
-                            exclude_path.rstrip(os.sep) + os.sep)):
-                    break
-            else:
-                # The file is not included in the list of excluded paths.
-                file_size = remote_stats[file_path].st_blocks * 512
-                file_priority = file_data.priority
-                if self.profile.account_for_size:
-                    try:
-                        adjusted_priorities.append((
-                            file_path, file_priority / file_size, file_size))
-                    except ZeroDivisionError:
-                        adjusted_priorities.append((file_path, 0, file_size))
-                else:
-                    adjusted_priorities.append((
-                        file_path, file_priority, file_size))
-
-        # Sort files by priority. Files of the same priority are sorted by
-        # file path so that the results of a sync are always predictable.
-        # That way, multiple consecutive syncs won't prioritize files
-        # differently.
-        adjusted_priorities.sort(key=lambda x: x[0])
-        adjusted_priorities.sort(key=lambda x: x[1], reverse=True)
-        prioritized_files = [
-            (path, size) for path, priority, size in adjusted_priorities]
+            selector.add(
+                file_path, file_data.priority,
+                remote_stats[file_path].st_blocks * 512)
 
         # This assumes that all symlinks have a disk usage of one block.
         symlink_size = os.stat(self.local_dir.path).st_blksize
-        remaining_space = space_limit
-
-        # Calculate which directories will stay in the local directory.
-        selected_files = set()
-        for file_path, file_size in prioritized_files:
-            new_remaining_space = remaining_space - file_size + symlink_size
-            if new_remaining_space > 0:
-                selected_files.add(file_path)
-                remaining_space = new_remaining_space
+
+        # Files of the same priority are selected in order of file path so
+        # that the results of a sync are always predictable. That way,
+        # multiple consecutive syncs won't prioritize files differently.
+        remaining_space, selected_files = selector.select(
+            space_limit, symlink_size, self.profile.selection_strategy)
 
         return SelectedPaths(remaining_space, selected_files)
 
@@ -272,15 +346,21 @@ class FilesManager:
         local_stats = self.local_dir.scan_paths()
         adjusted_priorities = []
 
-        # Calculate the disk usage of each directory and adjust directory
-        # priorities for size.
+        # Calculate the disk usage and the number of files under every
+        # directory in a single pass. Get the size of the files in the remote
+        # directory, as symlinks in the local directory are not followed.
+        subtree_sizes = _sum_subtrees({
+            path: remote_stats[path].st_blocks * 512
+            for path, _ in self.remote_dir.iter_paths()
+            if path in remote_stats})
+        file_counts = {path: 0 for path in local_dirs}
+        file_counts.update((path, 1) for path in local_files)
+        subtree_files = _sum_subtrees(file_counts)
+
+        # Adjust directory priorities for size.
         for dir_path, dir_data in local_dirs.items():
             dir_priority = dir_data.priority
-            dir_size = 0
-            for sub_path in self.remote_dir.get_paths(root=dir_path):
-                # Get the size of the files in the remote directory, as
-                # symlinks in the local directory are not followed.
-                dir_size += remote_stats[sub_path].st_blocks * 512
+            dir_size = subtree_sizes.get(dir_path, 0)
 
             if self.profile.account_for_size:
                 try:
@@ -310,14 +390,18 @@ class FilesManager:
         symlink_size = os.stat(self.local_dir.path).st_blksize
         remaining_space = space_limit - len(local_files) * symlink_size
 
-        # Select which directories will stay in the local directory.
+        # Select which directories will stay in the local directory. Selected
+        # directories are never nested, so the total size and number of files
+        # of the selected directories under each directory can be kept up to
+        # date by walking up from each newly selected directory.
         selected_dirs = set()
-        selected_subdirs = set()
-        selected_files = set()
+        selected_sizes = collections.defaultdict(int)
+        selected_file_counts = collections.defaultdict(int)
         for dir_path in prioritized_dirs:
             dir_size = dir_sizes[dir_path]
+            ancestors = _get_ancestors(dir_path)
 
-            if dir_path in selected_subdirs:
+            if any(ancestor in selected_dirs for ancestor in ancestors):
                 # The current directory is a subdirectory of a directory
                 # that has already been selected. Skip it.
                 continue
@@ -327,39 +411,36 @@ class FilesManager:
                 # Skip it.
                 continue
 
-            # Find all subdirectories of the current directory that are
-            # already in the set of selected files.
-            contained_files = set()
-            contained_dirs = set()
-            subdirs_size = 0
-            for subpath, subpath_data in self.profile.get_paths(
-                    root=dir_path).items():
-                if subpath_data.directory:
-                    contained_dirs.add(subpath)
-                else:
-                    contained_files.add(subpath)
-                if subpath in selected_dirs:
-                    subdirs_size += dir_sizes[subpath]
+            # Selecting the current directory replaces any directories under
+            # it that have already been selected.
+            added_size = dir_size - selected_sizes[dir_path]
+            added_files = (
+                subtree_files[dir_path] - selected_file_counts[dir_path])
 
             new_remaining_space = (
-                remaining_space
-                - dir_size
-                + subdirs_size
-                + len(contained_files - selected_files) * symlink_size)
+                remaining_space - added_size + added_files * symlink_size)
             if new_remaining_space >= 0:
-                # Add the current directory to the set of selected files and
-                # remove all of its subdirectories from the set.
-                selected_subdirs |= contained_dirs
-                selected_files |= contained_files
-                selected_dirs -= contained_dirs
                 selected_dirs.add(dir_path)
+                for ancestor in ancestors:
+                    selected_sizes[ancestor] += added_size
+                    selected_file_counts[ancestor] += added_files
                 remaining_space = new_remaining_space
 
+        # Remove directories that were later selected along with a parent.
+        selected_dirs = {
+            dir_path for dir_path in selected_dirs
+            if not any(
+                ancestor in selected_dirs
+                for ancestor in _get_ancestors(dir_path))}
+
         return SelectedPaths(remaining_space, selected_dirs)
 
     def update_local(self, update_paths: Iterable[str]) -> None:
         """Update the local directory with remote files.
 
+        Files which are already in the local directory and are unchanged
+        copies of the remote ones are not copied again.
+
         Args:
             update_paths: The paths of files and directories to copy from the
                 remote directory to the local one. All other files in the local
@@ -392,13 +473,20 @@ class FilesManager:
         try:
             nonlocal_paths = symlink_tree(
                 self.remote_dir.safe_path, self.local_dir.path,
-                self.remote_dir.get_paths(directory=False),
-                self.remote_dir.get_paths(directory=True))
+                (path for path, _ in self.remote_dir.iter_paths(
+                    directory=False)),
+                (path for path, _ in self.remote_dir.iter_paths(
+                    directory=True)))
 
             transfer_tree(
                 self.remote_dir.safe_path, self.local_dir.path,
-                files=update_paths,
-                message="Updating local files...")
+                files=update_paths, message="Updating local files...",
+                threads=self.profile.scan_threads,
+                transfer_threads=self.profile.transfer_threads,
+                delta_threshold=self.profile.delta_threshold,
+                journal_path=os.path.join(
+                    self.profile.journal_dir, "update-local"),
+                skip_unchanged=True)
         except FileNotFoundError:
             if not os.path.isdir(self.remote_dir.util_dir):
                 raise RemoteError("the remote directory could not be found")
@@ -425,7 +513,12 @@ class FilesManager:
         try:
             transfer_tree(
                 self.local_dir.path, self.remote_dir.safe_path,
-                files=update_paths, message="Updating remote files...")
+                files=update_paths, message="Updating remote files...",
+                threads=self.profile.scan_threads,
+                transfer_threads=self.profile.transfer_threads,
+                delta_threshold=self.profile.delta_threshold,
+                journal_path=os.path.join(
+                    self.profile.journal_dir, "update-remote"))
         except FileNotFoundError:
             if not os.path.isdir(self.remote_dir.util_dir):
                 raise RemoteError("the remote directory could not be found")
@@ -453,8 +546,8 @@ class FilesManager:
         # remote dir.
         symlink_tree(
             self.remote_dir.safe_path, self.local_dir.path,
-            self.profile.get_paths(directory=False),
-            self.profile.get_paths(directory=True),
+            (path for path, _ in self.profile.iter_paths(directory=False)),
+            (path for path, _ in self.profile.iter_paths(directory=True)),
             overwrite=True)
 
     def setup_from_local(self) -> None:
@@ -476,9 +569,14 @@ class FilesManager:
             transfer_tree(
                 self.local_dir.path, self.remote_dir.safe_path,
                 exclude=(
-                    self.profile.all_exclude_matches(self.local_dir.path)
+                    self.profile.all_exclude_matches(
+                        self.local_dir.path, self.local_dir.scan_paths())
                     | unsafe_symlinks),
-                message="Moving files to remote...")
+                message="Moving files to remote...",
+                threads=self.profile.scan_threads,
+                transfer_threads=self.profile.transfer_threads,
+                journal_path=os.path.join(
+                    self.profile.journal_dir, "setup"))
         except FileNotFoundError:
             if not os.path.isdir(self.remote_dir.util_dir):
                 raise RemoteError("the remote directory could not be found")
@@ -565,132 +663,117 @@ class FilesManager:
             The relative paths of files that are unneeded and should be removed
             to make room for new files.
         """
-        retained_paths = set(retained_paths)
-
-        # Create a set including all the files and directories contained in
-        # each directory from the input.
-        all_retained_paths = set()
-        for path in retained_paths:
-            all_retained_paths |= self.profile.get_paths(root=path).keys()
+        # Only paths in the local database have files and directories
+        # under them.
+        retained_paths = PathTrie(
+            self.profile.lookup_paths(retained_paths).keys())
 
         # Don't include excluded files or files not in the local database
         # (e.g. unsafe symlinks).
         all_paths = (self.local_dir.scan_paths(
-            exclude=self.profile.all_exclude_matches(self.local_dir.path)
+            exclude=self.profile.all_exclude_matches(
+                self.local_dir.path, self.local_dir.scan_paths())
             ).keys() & self.profile.get_paths().keys())
 
-        # Exclude the paths that are parents of paths in the input.
-        stale_paths = set()
-        for path in all_paths - all_retained_paths:
-            if not (self.profile.get_paths(path).keys() & all_retained_paths):
-                stale_paths.add(path)
+        # Exclude the paths that are contained in each directory from the
+        # input and the paths that are parents of paths in the input.
+        stale_paths = {
+            path for path in all_paths
+            if not retained_paths.has_ancestor(path)
+            and not retained_paths.has_descendant(path)}
 
         return stale_paths
 
-    def compute_added(self) -> UpdatedPaths:
-        """Compute paths of files that have been added since the last sync.
-
-        This method excludes the paths of local symlinks that are absolute
-        or point to files outside the local directory. A file is considered
-        to be new if it is not in the local database.
+    def _is_unsafe_symlink(self, path: str, stat: os.stat_result) -> bool:
+        """Check if a local file is a symlink that can't be safely transferred.
 
-        Returns:
-            A named tuple containing two sets of relative paths of files
-            that have been added since the last sync: local ones and
-            remote ones.
-        """
-        new_local_paths = {
-            path for path in self.local_dir.scan_paths().keys()
-            if not self.profile.get_path_info(path)
-            and not is_unsafe_symlink(
-                os.path.join(self.local_dir.path, path), self.local_dir.path)}
-        new_local_paths -= self.profile.all_exclude_matches(
-            self.local_dir.path)
-        new_remote_paths = {
-            path for path in self.remote_dir.scan_paths().keys()
-            if not self.profile.get_path_info(path)}
-
-        return UpdatedPaths(new_local_paths, new_remote_paths)
-
-    def compute_modified(self) -> UpdatedPaths:
-        """Compute paths of files that have been modified since the last sync.
-
-        This method excludes the paths of directories and the paths of files
-        that are new since the last sync. A file is considered to be
-        modified if its mtime is more recent than the time of the last sync
-        and it is in the database. Additionally, remote files are considered
-        to be modified if the time they were last updated by a sync (stored
-        in the remote database) is more recent than the time of the last sync.
+        Args:
+            path: The relative path of the local file.
+            stat: The os.stat_result object for the file, not following
+                symlinks.
 
         Returns:
-            A named tuple containing two sets of relative paths of files
-            that have been modified since the last sync: local ones and
-            remote ones.
+            True if the file is an unsafe symlink and False otherwise.
         """
-        last_sync = self.profile.last_sync
-
-        local_mtimes = (
-            (path, data.st_mtime) for path, data in self.local_dir.scan_paths(
-                dirs=False).items())
-        remote_mtimes = (
-            (path, data.st_mtime) for path, data in self.remote_dir.scan_paths(
-                dirs=False).items())
-
-        # Only include file paths that are in the database to exclude files
-        # that are new since the last sync.
-        local_mod_paths = {
-            path for path, mtime in local_mtimes
-            if mtime > last_sync and self.profile.get_path_info(path)
-            and not is_unsafe_symlink(
-                os.path.join(self.local_dir.path, path), self.local_dir.path)}
-        remote_mod_paths = {
-            path for path, mtime in remote_mtimes
-            if mtime > last_sync and self.profile.get_path_info(path)}
-
-        remote_mod_paths |= self.remote_dir.get_paths(
-            directory=False, min_lastsync=last_sync).keys()
-
-        return UpdatedPaths(local_mod_paths, remote_mod_paths)
-
-    def compute_deleted(self) -> DeletedPaths:
-        """Compute files that need to be deleted to sync the two directories.
+        # Only symlinks need to be read from the filesystem.
+        return (
+            statmod.S_ISLNK(stat.st_mode)
+            and is_unsafe_symlink(
+                os.path.join(self.local_dir.path, path), self.local_dir.path))
+
+    def compute_changes(self) -> ChangedPaths:
+        """Compute the paths of files that have changed since the last sync.
+
+        The scans of the local and remote directories and the local database
+        are walked together in sorted order, so each path is classified in a
+        single pass. Only the database is streamed; the scans are sorted in
+        memory because the rest of the sync reuses them.
+
+        A file is considered to be new if it is not in the local database.
+        The paths of local symlinks that are absolute or point to files
+        outside the local directory are excluded.
+
+        A file is considered to be modified if it is not a directory, its
+        mtime is more recent than the time of the last sync and it is in the
+        database. Additionally, remote files are considered to be modified if
+        the time they were last updated by a sync (stored in the remote
+        database) is more recent than the time of the last sync.
 
         A file needs to be deleted if it is found in the local database but
-        not in either the local or remote directory. A file moved to the
+        not in either the local or remote directory, not including the files
+        under directories that need to be deleted. A file is moved to the
         trash if it needs to be deleted from the remote directory but is not
         found in any of the local trash directories.
 
         Returns:
-            A named tuple containing three sets of relative file paths: local
-            files to be deleted, remote files to be deleted and remote files to
-            be moved to the trash.
+            A named tuple containing the paths of files that have been added,
+            modified and deleted since the last sync.
         """
-        local_paths = self.local_dir.scan_paths().keys()
-        remote_paths = self.remote_dir.scan_paths().keys()
-        known_paths = self.profile.get_paths().keys()
-
-        # Compute files that need to be deleted, not including the files
-        # under selected directories.
-        local_del_paths = known_paths - remote_paths
-        remote_del_paths = known_paths - local_paths
-        for path in local_del_paths.copy():
-            sub_paths = set(self.profile.get_paths(root=path).keys())
-            sub_paths.remove(path)
-            local_del_paths -= sub_paths
-        for path in remote_del_paths.copy():
-            sub_paths = set(self.remote_dir.get_paths(root=path).keys())
-            sub_paths.remove(path)
-            remote_del_paths -= sub_paths
-
-        # Compute files to be moved to the trash.
-        if self.profile.use_trash:
-            trash_paths = (
-                remote_del_paths & self.profile.get_paths(local=False).keys())
-        else:
-            trash_paths = set()
-        remote_del_paths -= trash_paths
+        last_sync = self.profile.last_sync
+        excluded_paths = self.profile.all_exclude_matches(
+            self.local_dir.path, self.local_dir.scan_paths())
+        added = UpdatedPaths(set(), set())
+        modified = UpdatedPaths(set(), set())
+        deleted = DeletedPaths(set(), set(), set())
+
+        for path, (local_stat, remote_stat, data) in _merge_sorted(
+                self.local_dir.iter_stats(), self.remote_dir.iter_stats(),
+                self.profile.iter_paths(ordered=True)):
+            if data is None:
+                if (local_stat is not None
+                        and path not in excluded_paths
+                        and not self._is_unsafe_symlink(path, local_stat)):
+                    added.local.add(path)
+                if remote_stat is not None:
+                    added.remote.add(path)
+                continue
+
+            if local_stat is not None:
+                if (not statmod.S_ISDIR(local_stat.st_mode)
+                        and local_stat.st_mtime > last_sync
+                        and not self._is_unsafe_symlink(path, local_stat)):
+                    modified.local.add(path)
+            elif not any(
+                    ancestor in deleted.remote or ancestor in deleted.trash
+                    for ancestor in _get_ancestors(path)):
+                if self.profile.use_trash and not data.local:
+                    deleted.trash.add(path)
+                else:
+                    deleted.remote.add(path)
+
+            if remote_stat is not None:
+                if (not statmod.S_ISDIR(remote_stat.st_mode)
+                        and remote_stat.st_mtime > last_sync):
+                    modified.remote.add(path)
+            elif not any(
+                    ancestor in deleted.local
+                    for ancestor in _get_ancestors(path)):
+                deleted.local.add(path)
+
+        modified.remote.update(self.remote_dir.get_paths(
+            directory=False, min_lastsync=last_sync).keys())
 
-        return DeletedPaths(local_del_paths, remote_del_paths, trash_paths)
+        return ChangedPaths(added, modified, deleted)
 
     def _rename_files(
             self, path_pairs: Iterable[Tuple[str, str]],
@@ -781,7 +864,8 @@ class FilesManager:
             paths: The relative paths of files to remove.
         """
         paths = set(paths)
-        paths -= self.profile.all_exclude_matches(self.local_dir.path)
+        paths -= self.profile.all_exclude_matches(
+            self.local_dir.path, self.local_dir.scan_paths())
         self._rm_files(paths, self.local_dir.path)
 
     def rm_remote_files(self, paths: Iterable[str]) -> None:
@@ -802,7 +886,8 @@ class FilesManager:
             excluded_paths: The paths of excluded files to remove.
         """
         rm_paths = self.remote_dir.check_excluded(
-            excluded_paths, self.local_dir.path)
+            excluded_paths, self.local_dir.path, self.local_dir.scan_paths(),
+            self.profile.exclude_cache_path)
         rm_paths &= self.remote_dir.get_paths().keys()
         self.rm_remote_files(rm_paths)
 
@@ -875,5 +960,6 @@ class FilesManager:
         """
         total_excluded_size = sum(
             self.local_dir.scan_paths()[path].st_blocks * 512
-            for path in self.profile.all_exclude_matches(self.local_dir.path))
+            for path in self.profile.all_exclude_matches(
+                self.local_dir.path, self.local_dir.scan_paths()))
         return total_excluded_size
@@ -18,25 +18,70 @@ You should have received a copy of the GNU General Public License
 along with zielen.  If not, see <http://www.gnu.org/licenses/>.
 """
 import os
+import re
 import sys
 import time
+import errno
+import stat as statmod
 import shutil
+import hashlib
+import logging
+import json
 import tempfile
-from typing import Iterable, Optional, Set
+import zlib
+import collections
+import concurrent.futures
+from typing import Iterable, Optional, Set, List, Tuple
 
-from zielen.utils import shell_cmd, ProgressBar
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from zielen.utils import shell_cmd, ProgressBar, PathTrie
 from zielen.exceptions import FileTransferError
 
 PROGRESS_BAR_LENGTH = 0.35
 
+# The ioctl request number for cloning a file on Linux (from linux/fs.h).
+FICLONE = 0x40049409
+
+# The size of the blocks that are compared when updating a file with a delta
+# transfer.
+DELTA_BLOCK_SIZE = 128 * 1024
+
+# The prefix of the temporary files that files are written to before they are
+# renamed into place. It is followed by a token identifying the transfer.
+TEMP_PREFIX = ".zielen-part-"
+
+# Regex that matches the names of temporary files.
+TEMP_NAME_REGEX = re.compile(re.escape(TEMP_PREFIX) + r"[0-9a-f]{16}-")
+
+# The number of copied files to rename into place and record in the journal at
+# a time.
+COMMIT_BATCH_SIZE = 64
+
+logger = logging.getLogger(__name__)
+
 
 def transfer_tree(
         source: str, dest: str, files=None, exclude=None,
-        message="", rm_source=False) -> None:
+        message="", rm_source=False, threads=1,
+        transfer_threads=1, delta_threshold=None, journal_path=None,
+        skip_unchanged=False) -> None:
     """Recursively copy files, preserving file metadata.
 
     Existing files in the destination are overwritten. A progress bar is
-    printed to the terminal displaying the progress of the transfer.
+    printed to the terminal displaying the progress of the transfer. All
+    directories are created before any files are copied, and files may be
+    copied concurrently.
+
+    Regular files are written to a temporary file and renamed over the
+    destination file once they have been flushed to disk, so an interrupted
+    transfer never leaves a partially written file in the destination.
+    Temporary files are ignored when scanning the source directory. If there
+    is a journal, temporary files left behind by an earlier attempt at the
+    same transfer are removed when it starts.
 
     Args:
         source: The path of the directory to copy the contents of.
@@ -49,6 +94,22 @@ def transfer_tree(
         message: A message to display opposite the progress bar. If None, the
             progress bar won't appear.
         rm_source: Remove source files once they are copied to the destination.
+        threads: The number of threads to use when scanning the source
+            directory.
+        transfer_threads: The number of files to copy at a time.
+        delta_threshold: The minimum size in bytes of a file for the blocks
+            it shares with the existing file it overwrites to be cloned from
+            that file. This is only done if the filesystem supports
+            copy_file_range(2). If None, files are always copied in their
+            entirety.
+        journal_path: The path of a file to record copied files in. If the
+            transfer is interrupted, files recorded in the journal which
+            haven't changed since are skipped when it is resumed. The journal
+            is removed once the transfer completes. If None, don't keep a
+            journal.
+        skip_unchanged: Skip regular files whose destination is a regular
+            file with the same size and mtime, which is the case for files
+            that were copied by a previous transfer and haven't changed since.
 
     Raises:
         FileNotFoundError: The source or destination files couldn't be found.
@@ -63,12 +124,16 @@ def transfer_tree(
     # Get a set of all source paths that are to be transferred.
     if files is None:
         rel_paths = {
-            os.path.relpath(entry.path, source) for entry in scan_tree(source)}
+            os.path.relpath(entry.path, source)
+            for entry in scan_tree(source, threads=threads)}
     else:
         rel_paths = set()
-        for path in files:
+
+        # Paths under other paths in the input would be scanned twice.
+        for path in PathTrie(files).roots():
             try:
-                for entry in scan_tree(os.path.join(source, path)):
+                for entry in scan_tree(
+                        os.path.join(source, path), threads=threads):
                     rel_paths.add(os.path.relpath(entry.path, source))
             except NotADirectoryError:
                 rel_paths.add(path)
@@ -76,51 +141,743 @@ def transfer_tree(
     if exclude is not None:
         rel_paths -= set(exclude)
 
-    # Sort the paths so that the path of a directory comes after the paths
-    # of its files. This allows directories to be removed only after their
-    # files have been removed.
-    rel_paths = list(rel_paths)
-    rel_paths.sort(reverse=True)
+    # Skip temporary files left behind by an interrupted transfer.
+    rel_paths = {
+        path for path in rel_paths
+        if not is_temp_name(os.path.basename(path))}
 
-    source_paths = [os.path.join(source, path) for path in rel_paths]
-    dest_paths = [os.path.join(dest, path) for path in rel_paths]
+    # Separate the paths of directories from the paths of other files so
+    # that directories can be created before any files are copied into them.
+    source_stats = {
+        path: os.lstat(os.path.join(source, path)) for path in rel_paths}
+    dir_paths = [
+        path for path, stat in source_stats.items()
+        if statmod.S_ISDIR(stat.st_mode)]
+    file_paths = [
+        path for path, stat in source_stats.items()
+        if not statmod.S_ISDIR(stat.st_mode)]
 
     if use_bar:
-        source_sizes = {path: os.stat(path).st_size for path in source_paths}
-        total_source_size = sum(source_sizes.values())
+        total_source_size = sum(
+            stat.st_size for stat in source_stats.values())
         transferred_size = 0
         transfer_bar = ProgressBar(PROGRESS_BAR_LENGTH, message=message)
 
-    for source_path, dest_path in zip(source_paths, dest_paths):
-        os.makedirs(os.path.dirname(dest_path), exist_ok=True)
-        try:
-            shutil.copy2(source_path, dest_path, follow_symlinks=False)
-        except (shutil.SameFileError, FileExistsError):
-            os.remove(dest_path)
-            shutil.copy2(source_path, dest_path, follow_symlinks=False)
-        except IsADirectoryError:
-            os.makedirs(dest_path, exist_ok=True)
-        except PermissionError:
-            raise FileTransferError("permission denied: {0}".format(
-                os.path.relpath(source_path, source)))
-
+    def update_bar(path: str) -> None:
+        nonlocal transferred_size
         if use_bar:
-            transferred_size += source_sizes[source_path]
+            transferred_size += source_stats[path].st_size
             try:
                 transfer_bar.update(transferred_size / total_source_size)
             except ZeroDivisionError:
                 transfer_bar.update(1)
 
+    def transfer_file(path: str) -> Tuple[str, str, Optional[str]]:
+        source_path = os.path.join(source, path)
+        dest_path = os.path.join(dest, path)
+        try:
+            backend, temp_path = _copy_file(
+                source_path, dest_path, temp_token, delta_threshold)
+        except PermissionError:
+            raise FileTransferError("permission denied: {0}".format(path))
+        return path, backend, temp_path
+
+    # Files which have been copied but not yet renamed into place.
+    pending = []
+
+    def commit_pending() -> None:
+        # Flush the new files to disk before renaming them so that a crash
+        # can't leave an empty or partially written file in the destination.
+        for path, temp_path in pending:
+            if temp_path is not None:
+                _fsync_path(temp_path)
+        for path, temp_path in pending:
+            if temp_path is not None:
+                os.replace(temp_path, os.path.join(dest, path))
+        for parent in {os.path.dirname(path) for path, _ in pending}:
+            _fsync_path(os.path.join(dest, parent))
+
+        if journal is not None:
+            journal.record((path, source_stats[path]) for path, _ in pending)
         if rm_source:
+            for path, _ in pending:
+                os.remove(os.path.join(source, path))
+        pending.clear()
+
+    def finish_file(path: str, backend: str, temp_path: Optional[str]):
+        backend_counts[backend] += 1
+        pending.append((path, temp_path))
+        if len(pending) >= COMMIT_BATCH_SIZE:
+            commit_pending()
+        update_bar(path)
+
+    # Count the number of files copied using each method.
+    backend_counts = collections.Counter()
+
+    # Skip files that were copied before the transfer was interrupted.
+    journal = None
+    temp_token = os.urandom(8).hex()
+    if journal_path is not None:
+        journal = TransferJournal(journal_path, source, dest)
+        journal.rm_temp_files()
+        temp_token = journal.temp_token
+        remaining_paths = []
+        for path in file_paths:
+            if journal.is_complete(
+                    path, source_stats[path], os.path.join(dest, path)):
+                if rm_source:
+                    os.remove(os.path.join(source, path))
+                update_bar(path)
+            else:
+                remaining_paths.append(path)
+        file_paths = remaining_paths
+
+    # Skip files that already have an identical copy in the destination.
+    if skip_unchanged:
+        remaining_paths = []
+        for path in file_paths:
+            if _is_copy(source_stats[path], os.path.join(dest, path)):
+                if rm_source:
+                    os.remove(os.path.join(source, path))
+                update_bar(path)
+            else:
+                remaining_paths.append(path)
+        file_paths = remaining_paths
+
+    # Sort the paths so that the path of a directory comes before the paths
+    # of its files.
+    for parent in sorted({os.path.dirname(path) for path in file_paths}):
+        os.makedirs(os.path.join(dest, parent), exist_ok=True)
+    for path in sorted(dir_paths):
+        os.makedirs(os.path.join(dest, path), exist_ok=True)
+        update_bar(path)
+
+    # Record where temporary files will be written before writing any of
+    # them so that they can be found if the transfer is interrupted.
+    if journal is not None and file_paths:
+        journal.record_temp_dirs(
+            os.path.join(dest, parent)
+            for parent in {os.path.dirname(path) for path in file_paths})
+
+    try:
+        if transfer_threads > 1 and len(file_paths) > 1:
+            executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=transfer_threads)
+            futures = [
+                executor.submit(transfer_file, path) for path in file_paths]
+            finished = set()
             try:
-                os.remove(source_path)
-            except OSError:
-                os.rmdir(source_path)
+                for future in concurrent.futures.as_completed(futures):
+                    finish_file(*future.result())
+                    finished.add(future)
+            finally:
+                # Don't start copying any more files if one of them failed.
+                for future in futures:
+                    future.cancel()
+                executor.shutdown()
+
+                # Keep the files that were still being copied.
+                for future in futures:
+                    if (future not in finished and not future.cancelled()
+                            and future.exception() is None):
+                        path, _, temp_path = future.result()
+                        pending.append((path, temp_path))
+        else:
+            for path in file_paths:
+                finish_file(*transfer_file(path))
+    finally:
+        # Keep the files that were copied successfully so that they can be
+        # skipped if the transfer is resumed.
+        try:
+            commit_pending()
+        finally:
+            if journal is not None:
+                journal.close()
+
+    if backend_counts:
+        logger.debug("copied {0} files to '{1}' ({2})".format(
+            len(file_paths), dest, ", ".join(
+                "{0}: {1}".format(name, count)
+                for name, count in sorted(backend_counts.items()))))
+
+    if rm_source:
+        # Sort the paths so that the path of a directory comes after the paths
+        # of its subdirectories. This allows directories to be removed only
+        # after their files have been removed.
+        for path in sorted(dir_paths, reverse=True):
+            os.rmdir(os.path.join(source, path))
+
+    if journal is not None:
+        journal.remove()
 
     if use_bar:
         print()
 
 
+def _clone_file(source_fd: int, dest_fd: int, size: int) -> None:
+    """Make the destination file a copy-on-write clone of the source file."""
+    if fcntl is None:
+        raise OSError(errno.ENOTSUP, "reflinks are not supported")
+    fcntl.ioctl(dest_fd, FICLONE, source_fd)
+
+
+def _check_short_copy(source_fd: int, size: int, copied: int) -> None:
+    """Raise an exception for a copy that stopped before the end of a file.
+
+    Some filesystems report that nothing was copied instead of returning an
+    error when a backend isn't supported. Reaching the end of the file early
+    can also mean that it shrank while it was being copied, which is only a
+    problem for that file.
+
+    Args:
+        source_fd: The file descriptor being read from.
+        size: The size of the file when the copy started.
+        copied: The number of bytes that were copied before the copy stopped.
+
+    Raises:
+        OSError: The backend isn't supported or the file was truncated.
+    """
+    if copied == 0 and os.fstat(source_fd).st_size >= size:
+        raise OSError(errno.ENOTSUP, "no data was copied")
+    raise OSError(errno.EINVAL, "the file was truncated while being copied")
+
+
+def _copy_file_range(source_fd: int, dest_fd: int, size: int) -> None:
+    """Copy data between files in the kernel using copy_file_range(2)."""
+    if not hasattr(os, "copy_file_range"):
+        raise OSError(errno.ENOSYS, "copy_file_range is not available")
+    copied = 0
+    while copied < size:
+        count = os.copy_file_range(source_fd, dest_fd, size - copied)
+        if count == 0:
+            _check_short_copy(source_fd, size, copied)
+        copied += count
+
+
+def _sendfile(source_fd: int, dest_fd: int, size: int) -> None:
+    """Copy data between files in the kernel using sendfile(2)."""
+    copied = 0
+    while copied < size:
+        count = os.sendfile(dest_fd, source_fd, copied, size - copied)
+        if count == 0:
+            _check_short_copy(source_fd, size, copied)
+        copied += count
+
+
+# These are tried in order until one of them is supported for a given pair of
+# filesystems.
+_COPY_BACKENDS = [
+    ("ficlone", _clone_file),
+    ("copy_file_range", _copy_file_range),
+    ("sendfile", _sendfile)]
+
+# Errors which indicate that a backend isn't supported for a pair of
+# filesystems rather than that the copy itself failed.
+_UNSUPPORTED_ERRNOS = {
+    errno.ENOSYS, errno.ENOTSUP, errno.EOPNOTSUPP, errno.ENOTTY,
+    errno.EXDEV}
+
+# Errors which indicate that a backend can't be used for a particular file,
+# such as one that is being written to or executed. These may not happen for
+# the next file, so the backend isn't given up on.
+_UNCOPYABLE_ERRNOS = {errno.EINVAL, errno.EBADF, errno.ETXTBSY}
+
+# The backends that have failed for each pair of source and destination
+# devices, so that they aren't attempted for every file.
+_unsupported_backends = set()
+
+
+def _copy_contents(source_file, dest_file) -> str:
+    """Copy the contents of a file using the fastest method available.
+
+    Args:
+        source_file: The file object to read from.
+        dest_file: The empty file object to write to.
+
+    Returns:
+        The name of the method used to copy the file.
+    """
+    source_fd = source_file.fileno()
+    dest_fd = dest_file.fileno()
+    size = os.fstat(source_fd).st_size
+    devices = (os.fstat(source_fd).st_dev, os.fstat(dest_fd).st_dev)
+
+    for name, backend in _COPY_BACKENDS:
+        if (name, devices) in _unsupported_backends:
+            continue
+        try:
+            backend(source_fd, dest_fd, size)
+        except OSError as error:
+            if error.errno in _UNSUPPORTED_ERRNOS:
+                _unsupported_backends.add((name, devices))
+            elif error.errno not in _UNCOPYABLE_ERRNOS:
+                raise
+
+            # Discard anything that was written before the failure.
+            os.lseek(source_fd, 0, os.SEEK_SET)
+            os.lseek(dest_fd, 0, os.SEEK_SET)
+            os.ftruncate(dest_fd, 0)
+        else:
+            return name
+
+    shutil.copyfileobj(source_file, dest_file)
+    return "userspace"
+
+
+def _can_share_blocks(path: str) -> bool:
+    """Check if the blocks of a file may be shared by copying them.
+
+    Args:
+        path: The path of a file on the filesystem to check.
+
+    Returns:
+        False if copy_file_range(2) is known not to work on the filesystem
+        and True otherwise.
+    """
+    if not hasattr(os, "copy_file_range"):
+        return False
+    device = os.lstat(path).st_dev
+    return ("copy_file_range", (device, device)) not in _unsupported_backends
+
+
+def _write_all(fd: int, data: bytes) -> None:
+    """Write all of a bytes object to a file descriptor.
+
+    os.write() may write fewer bytes than it was given, so this keeps
+    writing until all of them have been written.
+
+    Args:
+        fd: The file descriptor to write to at its current offset.
+        data: The bytes to write.
+    """
+    data = memoryview(data)
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _copy_range(
+        source_fd: int, dest_fd: int, offset: int, length: int) -> None:
+    """Append a range of one file to another.
+
+    This is done in the kernel if possible, which allows filesystems that
+    support it to share the underlying blocks instead of copying them.
+
+    Args:
+        source_fd: The file descriptor to read from.
+        dest_fd: The file descriptor to write to at its current offset.
+        offset: The offset in the source file to start reading from.
+        length: The number of bytes to copy.
+    """
+    end = offset + length
+    if hasattr(os, "copy_file_range"):
+        try:
+            while offset < end:
+                count = os.copy_file_range(
+                    source_fd, dest_fd, end - offset, offset)
+                if count == 0:
+                    break
+                offset += count
+        except OSError as error:
+            if error.errno in _UNSUPPORTED_ERRNOS:
+                _unsupported_backends.add((
+                    "copy_file_range",
+                    (os.fstat(source_fd).st_dev, os.fstat(dest_fd).st_dev)))
+            elif error.errno not in _UNCOPYABLE_ERRNOS:
+                raise
+
+    while offset < end:
+        data = os.pread(source_fd, min(end - offset, DELTA_BLOCK_SIZE), offset)
+        if not data:
+            break
+        _write_all(dest_fd, data)
+        offset += len(data)
+
+
+def _delta_copy(source_file, dest_path: str, temp_file) -> str:
+    """Copy a file by reusing the blocks of an older version of it.
+
+    The older version is split into fixed-size blocks, and a weak and a
+    strong checksum is computed for each one. Each block of the source file
+    is then looked up by its checksums. Blocks which are found anywhere in the
+    older version are copied from there, and the remaining blocks are copied
+    from the source file.
+
+    Both files are read in their entirety and a complete new file is
+    written, which is then renamed over the older version. This only saves
+    I/O when the filesystem can share the blocks of the older version with
+    the new file (e.g. Btrfs and XFS) or copy them on the server (e.g. NFS
+    4.2), in which case only the changed blocks are written.
+
+    Args:
+        source_file: The file object to read from.
+        dest_path: The path of the older version of the file.
+        temp_file: The empty unbuffered file object to write to.
+
+    Returns:
+        The name of the method used to copy the file.
+    """
+    temp_fd = temp_file.fileno()
+    with open(dest_path, "rb") as dest_file:
+        # Map the checksums of each block in the older version to its offset.
+        dest_blocks = {}
+        offset = 0
+        for block in iter(lambda: dest_file.read(DELTA_BLOCK_SIZE), b""):
+            dest_blocks.setdefault(
+                zlib.adler32(block), {}).setdefault(
+                hashlib.sha256(block).digest(), offset)
+            offset += len(block)
+
+        # Consecutive blocks that are found in the older version are copied
+        # as a single range.
+        run_start = None
+        run_length = 0
+        for block in iter(lambda: source_file.read(DELTA_BLOCK_SIZE), b""):
+            match = dest_blocks.get(zlib.adler32(block))
+            if match is not None:
+                match = match.get(hashlib.sha256(block).digest())
+
+            if run_length and match == run_start + run_length:
+                run_length += len(block)
+                continue
+
+            if run_length:
+                _copy_range(dest_file.fileno(), temp_fd, run_start, run_length)
+            if match is None:
+                _write_all(temp_fd, block)
+                run_start, run_length = None, 0
+            else:
+                run_start, run_length = match, len(block)
+
+        if run_length:
+            _copy_range(dest_file.fileno(), temp_fd, run_start, run_length)
+
+    return "delta"
+
+
+def get_temp_path(path: str, token: str) -> str:
+    """Get the path of the temporary file that a file is written to.
+
+    Files are written to a temporary file in the same directory and then
+    renamed into place so that an interrupted transfer never leaves a
+    partially written file behind.
+
+    Args:
+        path: The path of the file.
+        token: A string of 16 hexadecimal digits identifying the transfer.
+
+    Returns:
+        The path of the temporary file.
+    """
+    parent, name = os.path.split(path)
+    if len(name) > 200:
+        # Keep the name of the temporary file within the limits of most
+        # filesystems.
+        name = name[:150] + hashlib.sha256(os.fsencode(name)).hexdigest()[:16]
+    return os.path.join(parent, "{0}{1}-{2}".format(TEMP_PREFIX, token, name))
+
+
+def is_temp_name(name: str) -> bool:
+    """Check if a file name is the name of a temporary file.
+
+    Args:
+        name: The name of the file.
+
+    Returns:
+        True if the file is a temporary file written by a transfer and False
+        otherwise.
+    """
+    return TEMP_NAME_REGEX.match(name) is not None
+
+
+def _copy_file(
+        source_path: str, dest_path: str, temp_token: str,
+        delta_threshold=None) -> Tuple[str, Optional[str]]:
+    """Copy a file, preserving file metadata.
+
+    Symbolic links are not followed. Regular files are copied to a temporary
+    file which must then be renamed over the destination file by the caller.
+    Other files are copied directly, overwriting the destination.
+
+    Args:
+        source_path: The path of the file to copy.
+        dest_path: The path to copy the file to.
+        temp_token: The token to include in the name of the temporary file.
+        delta_threshold: The minimum size in bytes of a regular file which
+            overwrites another regular file for the blocks they share to be
+            cloned from the file being overwritten. If None, files are always
+            copied in their entirety.
+
+    Returns:
+        A tuple containing the name of the method used to copy the file and
+        the path of the temporary file, or None if there isn't one.
+    """
+    source_stat = os.lstat(source_path)
+    if not statmod.S_ISREG(source_stat.st_mode):
+        try:
+            shutil.copy2(source_path, dest_path, follow_symlinks=False)
+        except (shutil.SameFileError, FileExistsError):
+            os.remove(dest_path)
+            shutil.copy2(source_path, dest_path, follow_symlinks=False)
+        return "shutil", None
+
+    use_delta = False
+    if (delta_threshold is not None
+            and source_stat.st_size >= delta_threshold):
+        try:
+            dest_stat = os.lstat(dest_path)
+        except FileNotFoundError:
+            pass
+        else:
+            use_delta = (
+                statmod.S_ISREG(dest_stat.st_mode)
+                and not os.path.samestat(source_stat, dest_stat)
+                and _can_share_blocks(dest_path))
+
+    temp_path = get_temp_path(dest_path, temp_token)
+    try:
+        temp_fd = os.open(
+            temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW,
+            0o600)
+        with open(source_path, "rb") as source_file, open(
+                temp_fd, "wb", buffering=0) as temp_file:
+            if use_delta:
+                backend = _delta_copy(source_file, dest_path, temp_file)
+            else:
+                backend = _copy_contents(source_file, temp_file)
+        shutil.copystat(source_path, temp_path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+    return backend, temp_path
+
+
+def _is_copy(source_stat: os.stat_result, dest_path: str) -> bool:
+    """Check if a file is an unchanged copy of a regular file.
+
+    Args:
+        source_stat: The os.stat_result object for the source file, not
+            following symlinks.
+        dest_path: The path of the destination file.
+
+    Returns:
+        True if the source and destination are both regular files with the
+        same size and mtime and False otherwise.
+    """
+    if not statmod.S_ISREG(source_stat.st_mode):
+        return False
+    try:
+        dest_stat = os.lstat(dest_path)
+    except (FileNotFoundError, NotADirectoryError):
+        return False
+    return (
+        statmod.S_ISREG(dest_stat.st_mode)
+        and dest_stat.st_size == source_stat.st_size
+        and dest_stat.st_mtime_ns == source_stat.st_mtime_ns)
+
+
+def _fsync_path(path: str) -> None:
+    """Flush a file or directory to disk.
+
+    Args:
+        path: The path of the file or directory.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError as error:
+        # Some filesystems don't support syncing directories.
+        if error.errno not in _UNSUPPORTED_ERRNOS | _UNCOPYABLE_ERRNOS:
+            raise
+    finally:
+        os.close(fd)
+
+
+class TransferJournal:
+    """A record of the files that have been copied by transfer_tree().
+
+    If a transfer is interrupted, the journal is left behind so that files
+    which were already copied can be skipped when the transfer is resumed.
+    The first line of the journal is a JSON array of the source and
+    destination directories and the token of the transfer, and each
+    subsequent line is a JSON array. An array
+    containing the relative path, size and mtime is written for each file
+    that was copied, and an array containing only an absolute path is
+    written for each directory that temporary files are written to.
+
+    The names of the temporary files include a random token which is stored
+    in the journal, so the temporary files of a transfer can be told apart
+    from those of a transfer another client is running in the same
+    directory, even if its journal has the same path.
+
+    Args:
+        path: The path of the journal file.
+        source: The path of the directory being copied from.
+        dest: The path of the directory being copied to.
+
+    Attributes:
+        path: The path of the journal file.
+        temp_token: The token to include in the names of temporary files.
+        _dirs: A list of the absolute paths of the source and destination
+            directories.
+        _entries: A dict of relative paths of copied files and tuples of
+            their size and mtime in nanoseconds.
+        _temp_dirs: A set of absolute paths of directories that temporary
+            files may have been left in.
+        _file: The journal file object if it is open for writing.
+    """
+    def __init__(self, path: str, source: str, dest: str) -> None:
+        self.path = path
+        self.temp_token = None
+        self._dirs = [os.path.abspath(source), os.path.abspath(dest)]
+        self._entries = {}
+        self._temp_dirs = set()
+        self._file = None
+        self._read()
+        if self.temp_token is None:
+            self.temp_token = os.urandom(8).hex()
+
+    def _read(self) -> None:
+        """Read the entries from an existing journal.
+
+        Copied files are only read if the journal is for the same transfer,
+        but directories with temporary files and the token are always read.
+        """
+        try:
+            with open(self.path) as file:
+                try:
+                    header = json.loads(file.readline())
+                except ValueError:
+                    return
+                same_transfer = header[:2] == self._dirs
+                if len(header) > 2:
+                    self.temp_token = header[2]
+                else:
+                    # Journals written before the token was stored used one
+                    # derived from their path.
+                    self.temp_token = hashlib.sha256(os.fsencode(
+                        os.path.abspath(self.path))).hexdigest()[:16]
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # The last line may be incomplete if the transfer
+                        # was interrupted while it was being written.
+                        break
+                    if len(entry) == 1:
+                        self._temp_dirs.add(entry[0])
+                    elif same_transfer:
+                        path, size, mtime = entry
+                        self._entries[path] = (size, mtime)
+        except FileNotFoundError:
+            pass
+
+    def rm_temp_files(self) -> None:
+        """Remove temporary files left behind by an interrupted transfer."""
+        for dir_path in self._temp_dirs:
+            try:
+                entries = list(os.scandir(dir_path))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                if (is_temp_name(entry.name)
+                        and entry.name[len(TEMP_PREFIX):].startswith(
+                            self.temp_token)):
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+        self._temp_dirs.clear()
+
+    def is_complete(
+            self, path: str, source_stat: os.stat_result,
+            dest_path: str) -> bool:
+        """Check if a file was already copied and hasn't changed since.
+
+        Args:
+            path: The relative path of the file.
+            source_stat: The os.stat_result object for the source file, not
+                following symlinks.
+            dest_path: The path of the destination file.
+
+        Returns:
+            True if the file doesn't need to be copied again and False
+            otherwise.
+        """
+        entry = (source_stat.st_size, source_stat.st_mtime_ns)
+        if self._entries.get(path) != entry:
+            return False
+        try:
+            dest_stat = os.lstat(dest_path)
+        except FileNotFoundError:
+            return False
+        return (
+            statmod.S_IFMT(dest_stat.st_mode)
+            == statmod.S_IFMT(source_stat.st_mode)
+            and (dest_stat.st_size, dest_stat.st_mtime_ns) == entry)
+
+    def record(self, stats: Iterable[Tuple[str, os.stat_result]]) -> None:
+        """Record that files have been copied and flush the journal to disk.
+
+        Args:
+            stats: Pairs of relative paths and os.stat_result objects for
+                source files that have been copied.
+        """
+        self._open()
+        for path, stat in stats:
+            entry = (stat.st_size, stat.st_mtime_ns)
+            self._entries[path] = entry
+            self._file.write(json.dumps([path, *entry]) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def record_temp_dirs(self, dir_paths: Iterable[str]) -> None:
+        """Record directories that temporary files are about to be written to.
+
+        Args:
+            dir_paths: The paths of the directories.
+        """
+        self._open()
+        for dir_path in dir_paths:
+            dir_path = os.path.abspath(dir_path)
+            if dir_path not in self._temp_dirs:
+                self._temp_dirs.add(dir_path)
+                self._file.write(json.dumps([dir_path]) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def _open(self) -> None:
+        """Open the journal for writing if it isn't already open."""
+        if self._file is None:
+            os.makedirs(
+                os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            if self._entries:
+                self._file = open(self.path, "a")
+            else:
+                self._file = open(self.path, "w")
+                self._file.write(
+                    json.dumps(self._dirs + [self.temp_token]) + "\n")
+
+    def close(self) -> None:
+        """Close the journal file, leaving it in place."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self) -> None:
+        """Remove the journal once the transfer is complete."""
+        self.close()
+        self._entries.clear()
+        self._temp_dirs.clear()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
 def symlink_tree(
         src_dir: str, dest_dir: str, src_files: Iterable[str],
         src_dirs: Iterable[str], overwrite=False) -> Set[str]:
@@ -179,19 +936,188 @@ def symlink_tree(
     return new_paths
 
 
-def scan_tree(path: str):
+class StatEntry:
+    """An object with the same interface as os.DirEntry.
+
+    This is used in place of an os.DirEntry object when the entries of a
+    directory are not read from the filesystem, but the stats of each file
+    are still needed.
+
+    Args:
+        path: The path of the file.
+        stat: The os.stat_result object for the file, not following symlinks.
+
+    Attributes:
+        path: The path of the file.
+        name: The base name of the file.
+    """
+    __slots__ = ("path", "name", "_stat")
+
+    def __init__(self, path: str, stat: os.stat_result) -> None:
+        self.path = path
+        self.name = os.path.basename(path)
+        self._stat = stat
+
+    def __repr__(self) -> str:
+        return "<StatEntry '{0}'>".format(self.name)
+
+    def __fspath__(self) -> str:
+        return self.path
+
+    def inode(self) -> int:
+        return self._stat.st_ino
+
+    def is_symlink(self) -> bool:
+        return statmod.S_ISLNK(self._stat.st_mode)
+
+    def is_dir(self, follow_symlinks=True) -> bool:
+        if follow_symlinks and self.is_symlink():
+            return os.path.isdir(self.path)
+        return statmod.S_ISDIR(self._stat.st_mode)
+
+    def is_file(self, follow_symlinks=True) -> bool:
+        if follow_symlinks and self.is_symlink():
+            return os.path.isfile(self.path)
+        return statmod.S_ISREG(self._stat.st_mode)
+
+    def stat(self, follow_symlinks=True) -> os.stat_result:
+        if follow_symlinks and self.is_symlink():
+            return os.stat(self.path)
+        return self._stat
+
+
+def scan_tree(path: str, cached_names=None, threads=1):
     """Recursively scan a directory tree and yield an os.DirEntry object.
 
     Args:
         path: The path of the directory to scan.
+        cached_names: A function that accepts the path of a directory and its
+            os.stat_result object and returns the names of the files in the
+            directory if they are known not to have changed, or None
+            otherwise. Directories for which names are returned are not
+            read. Instead, each file in them is stat'ed individually. If None,
+            every directory is read.
+        threads: The number of threads to read directories with. Entries are
+            yielded in the same order regardless of the number of threads.
 
     Yields:
-        An os.DirEntry object for each file in the tree.
+        An os.DirEntry object (or a StatEntry object) for each file in the
+        tree.
     """
-    for entry in os.scandir(path):
+    if threads > 1:
+        yield from _scan_tree_parallel(path, cached_names, threads)
+    elif cached_names is None:
+        for entry in os.scandir(path):
+            yield entry
+            if entry.is_dir(follow_symlinks=False):
+                yield from scan_tree(entry.path)
+    else:
+        yield from _scan_tree_cached(path, os.stat(path), cached_names)
+
+
+def _list_dir(path: str, dir_stat: os.stat_result, cached_names) -> List:
+    """Get the entries of a directory with their stats already fetched.
+
+    Args:
+        path: The path of the directory to read.
+        dir_stat: The os.stat_result object for the directory.
+        cached_names: The function passed to scan_tree().
+
+    Returns:
+        A list of os.DirEntry or StatEntry objects.
+    """
+    names = None if cached_names is None else cached_names(path, dir_stat)
+    entries = []
+    if names is None:
+        for entry in os.scandir(path):
+            try:
+                # The result is cached by the os.DirEntry object.
+                entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                # The file was removed after the directory was read.
+                continue
+            entries.append(entry)
+    else:
+        for name in names:
+            entry_path = os.path.join(path, name)
+            try:
+                entries.append(StatEntry(
+                    entry_path, os.stat(entry_path, follow_symlinks=False)))
+            except FileNotFoundError:
+                # The file was removed after the directory was stat'ed.
+                pass
+
+    return entries
+
+
+def _scan_tree_cached(path: str, dir_stat: os.stat_result, cached_names):
+    """Recursively scan a directory tree, skipping unchanged directories.
+
+    Args:
+        path: The path of the directory to scan.
+        dir_stat: The os.stat_result object for the directory.
+        cached_names: The function passed to scan_tree().
+
+    Yields:
+        An os.DirEntry or StatEntry object for each file in the tree.
+    """
+    for entry in _list_dir(path, dir_stat, cached_names):
         yield entry
         if entry.is_dir(follow_symlinks=False):
-            yield from scan_tree(entry.path)
+            yield from _scan_tree_cached(
+                entry.path, entry.stat(follow_symlinks=False), cached_names)
+
+
+def _scan_tree_parallel(path: str, cached_names, threads: int):
+    """Recursively scan a directory tree using a pool of threads.
+
+    Every subdirectory of a directory is submitted to the pool as soon as the
+    directory has been read, but the tree is still traversed depth-first in
+    the same order as scan_tree() with a single thread. This way,
+    directories are read concurrently while the output stays deterministic.
+
+    Args:
+        path: The path of the directory to scan.
+        cached_names: The function passed to scan_tree().
+        threads: The maximum number of threads to use.
+
+    Yields:
+        An os.DirEntry or StatEntry object for each file in the tree.
+    """
+    # Only the futures whose results haven't been consumed yet are kept so
+    # that the listings of directories which have already been walked can be
+    # freed.
+    pending_futures = set()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+
+    def submit(dir_path: str, dir_stat: os.stat_result):
+        future = executor.submit(_list_dir, dir_path, dir_stat, cached_names)
+        pending_futures.add(future)
+        return future
+
+    def walk(future):
+        entries = future.result()
+        pending_futures.discard(future)
+
+        # Start reading every subdirectory before descending into any of them.
+        sub_futures = {
+            entry.path: submit(entry.path, entry.stat(follow_symlinks=False))
+            for entry in entries if entry.is_dir(follow_symlinks=False)}
+
+        for entry in entries:
+            yield entry
+            if entry.path in sub_futures:
+                yield from walk(sub_futures.pop(entry.path))
+
+    root_stat = None if cached_names is None else os.stat(path)
+    try:
+        yield from walk(submit(path, root_stat))
+    finally:
+        # Don't wait on directories that haven't been read yet if the
+        # generator is closed early.
+        for future in pending_futures:
+            future.cancel()
+        executor.shutdown()
 
 
 def is_unsafe_symlink(link_path: str, parent_path: str) -> bool:
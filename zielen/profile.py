@@ -20,7 +20,7 @@ along with zielen.  If not, see <http://www.gnu.org/licenses/>.
 import os
 import re
 import sys
-import glob
+import time
 import uuid
 import getpass
 import sqlite3
@@ -28,22 +28,32 @@ import datetime
 import textwrap
 import readline  # This is not unused. Importing it adds features to input().
 import collections
+import stat as statmod
 from typing import (
-    Any, Iterable, Generator, Dict, NamedTuple, Optional, Union, Set, List)
+    Any, Iterable, Generator, Dict, NamedTuple, Optional, Union, Set, List,
+    Tuple, Pattern)
 
 import pkg_resources
 
 from zielen.paths import get_xdg_data_home, get_profiles_dir
 from zielen.containerbase import JSONFile, ConfigFile, SyncDBFile
 from zielen.fstools import scan_tree
+from zielen.selection import STRATEGIES
 from zielen.utils import (
-    DictProperty, secure_string, set_no_autocomplete, set_path_autocomplete,
-    get_path_ancestry)
+    DictProperty, PathTrie, secure_string, set_no_autocomplete,
+    set_path_autocomplete, get_path_ancestry, WATCH_BACKENDS)
 from zielen.exceptions import FileParseError
 
+# The ways the daemon can run a sync.
+SYNC_MODES = ["subprocess", "inprocess", "forkserver"]
+
 PathData = NamedTuple(
     "PathData", [("directory", bool), ("priority", float), ("local", bool)])
 
+# The largest base-2 exponent of the factor that priority values are stored
+# scaled by before every value in the database is scaled back down.
+MAX_PRIORITY_EXPONENT = 512
+
 
 class Profile:
     """Get information about a profile and its contents.
@@ -53,6 +63,12 @@ class Profile:
         path: The path of the profile directory.
         cfg_path: The path of the configuration file.
         exclude_path: The path of the exclude file.
+        exclude_cache_path: The path of the file caching the compiled exclude
+            patterns of every client.
+        snapshot_path: The path of the database of file stats from the last
+            scan of the local directory.
+        journal_dir: The path of the directory containing the journals of
+            interrupted file transfers.
         _exclude_file: An object for the exclude pattern file.
         _info_file: An object for the JSON file for profile metadata.
         _db_file: An object for the file priority database.
@@ -71,6 +87,9 @@ class Profile:
         # Import methods from content classes.
         self.cfg_path = self._cfg_file.path
         self.exclude_path = self._exclude_file.path
+        self.exclude_cache_path = os.path.join(self.path, "exclude_cache.json")
+        self.snapshot_path = os.path.join(self.path, "snapshot.db")
+        self.journal_dir = os.path.join(self.path, "journal")
         self.exclude_matches = self._exclude_file.matches
         self.all_exclude_matches = self._exclude_file.all_matches
         self.add_paths = self._db_file.add_paths
@@ -78,8 +97,9 @@ class Profile:
         self.update_paths = self._db_file.update_paths
         self.rm_paths = self._db_file.rm_paths
         self.get_path_info = self._db_file.get_path_info
+        self.lookup_paths = self._db_file.lookup_paths
         self.get_paths = self._db_file.get_paths
-        self.increment = self._db_file.increment
+        self.iter_paths = self._db_file.iter_paths
         self.adjust_all = self._db_file.adjust_all
 
     def read(self) -> None:
@@ -91,6 +111,7 @@ class Profile:
         self._cfg_file.read()
         self._cfg_file.check_all()
         self._exclude_file.reset()
+        self._exclude_file.scan_threads = self.scan_threads
 
     def generate(
             self, init_options: Dict[str, Any], exclude_path=None,
@@ -174,6 +195,73 @@ class Profile:
     def last_adjust(self, value: float) -> None:
         self._info_file.vals["LastAdjust"] = self._convert_timestamp(value)
 
+    @property
+    def last_rescan(self) -> float:
+        """The time of the last full scan of the local directory in epoch time.
+
+        Between full scans, the daemon may only have the files it has seen
+        change scanned again.
+        """
+        value = self._info_file.vals.get("LastRescan")
+        return 0.0 if value is None else self._convert_epoch(value)
+
+    @last_rescan.setter
+    def last_rescan(self, value: float) -> None:
+        self._info_file.vals["LastRescan"] = self._convert_timestamp(value)
+
+    @property
+    def priority_exponent(self) -> float:
+        """The base-2 logarithm of the factor priorities are scaled by.
+
+        Instead of multiplying every priority value by a constant to make
+        them decay, increments are multiplied by a factor which doubles every
+        half-life. This factor is updated at each priority adjustment.
+        """
+        # Profiles created by older versions don't have this value.
+        return self._info_file.vals.get("PriorityExponent") or 0.0
+
+    @priority_exponent.setter
+    def priority_exponent(self, value: float) -> None:
+        self._info_file.vals["PriorityExponent"] = value
+
+    def increment(self, paths: Iterable[str], increment: float) -> None:
+        """Increment the priority of some paths by some value.
+
+        The value is scaled so that it decays relative to the values that
+        were added before it.
+
+        Args:
+            paths: The paths to increment the priority of.
+            increment: The value to increment the paths by.
+        """
+        self._db_file.increment(
+            paths, increment * 2 ** self.priority_exponent)
+
+    def adjust_priority(self, max_elapsed=None) -> None:
+        """Make the priority values of files decay since the last adjustment.
+
+        This only updates the factor that new increments are scaled by, so
+        the values in the database are only rewritten once the factor grows
+        too large to be stored accurately.
+
+        Args:
+            max_elapsed: The most time in seconds to make the priority values
+                decay for. This keeps them from decaying for time the daemon
+                wasn't running. If None, there is no limit.
+        """
+        current_time = time.time()
+        elapsed = current_time - self.last_adjust
+        if max_elapsed is not None:
+            elapsed = min(elapsed, max_elapsed)
+        exponent = self.priority_exponent + (
+            elapsed / self.priority_half_life)
+        if exponent > MAX_PRIORITY_EXPONENT:
+            self.adjust_all(2 ** -exponent)
+            exponent = 0.0
+
+        self.priority_exponent = exponent
+        self.last_adjust = current_time
+
     @property
     def version(self) -> str:
         """The version of the program that the profile was initialized by."""
@@ -217,12 +305,10 @@ class Profile:
         return os.path.expanduser(
             os.path.normpath(self._cfg_file.vals["RemoteDir"]))
 
-    @property
-    def storage_limit(self) -> int:
-        """The number of bytes of data to keep in the local directory."""
+    def _convert_size(self, value: str) -> int:
+        """Convert a string with a unit of data to a number of bytes."""
         num, prefix, unit = re.findall(
-            r"^([0-9]+)\s*([KMG])(B|iB)?$",
-            self._cfg_file.vals["StorageLimit"], re.IGNORECASE)[0]
+            r"^([0-9]+)\s*([KMG])(B|iB)?$", value, re.IGNORECASE)[0]
 
         if unit == "iB" or not unit:
             base = 1024
@@ -238,6 +324,11 @@ class Profile:
 
         return int(num) * base**exponent
 
+    @property
+    def storage_limit(self) -> int:
+        """The number of bytes of data to keep in the local directory."""
+        return self._convert_size(self._cfg_file.vals["StorageLimit"])
+
     @property
     def sync_interval(self) -> int:
         """The number of seconds the daemon will wait between syncs."""
@@ -279,6 +370,64 @@ class Profile:
         """Take file size into account when prioritizing files."""
         return self._convert_bool(self._cfg_file.vals["AccountForSize"])
 
+    @property
+    def scan_threads(self) -> int:
+        """The number of threads to use when scanning directory trees."""
+        return int(self._cfg_file.vals["ScanThreads"])
+
+    @property
+    def transfer_threads(self) -> int:
+        """The number of files to copy at a time."""
+        return int(self._cfg_file.vals["TransferThreads"])
+
+    @property
+    def flush_interval(self) -> int:
+        """The number of seconds between writing file accesses to disk."""
+        return int(self._cfg_file.vals["FlushInterval"])
+
+    @property
+    def watch_backend(self) -> str:
+        """The name of the backend used to watch for file access."""
+        return self._cfg_file.vals["WatchBackend"]
+
+    @property
+    def rescan_interval(self) -> int:
+        """The number of seconds between full scans of the local directory."""
+        return int(self._cfg_file.vals["RescanInterval"]) * 60**2
+
+    @property
+    def sync_delay(self) -> Optional[int]:
+        """The number of seconds the daemon waits after a change to sync."""
+        value = self._cfg_file.vals["SyncDelay"]
+        if value.startswith("-"):
+            return None
+        else:
+            return int(value)
+
+    @property
+    def max_sync_delay(self) -> int:
+        """The longest the daemon waits after a change to sync in seconds."""
+        return int(self._cfg_file.vals["MaxSyncDelay"])
+
+    @property
+    def sync_mode(self) -> str:
+        """The way the daemon runs a sync."""
+        return self._cfg_file.vals["SyncMode"]
+
+    @property
+    def delta_threshold(self) -> Optional[int]:
+        """The minimum size of files to update with delta transfers."""
+        value = self._cfg_file.vals["DeltaThreshold"]
+        if value.startswith("-"):
+            return None
+        else:
+            return self._convert_size(value)
+
+    @property
+    def selection_strategy(self) -> str:
+        """The strategy used to select which files to keep locally."""
+        return self._cfg_file.vals["SelectionStrategy"]
+
 
 class ProfileExcludeFile:
     """Manipulate a file containing exclude patterns for the profile.
@@ -287,23 +436,40 @@ class ProfileExcludeFile:
     directory so that each client can determine if every other client has
     excluded a given file.
 
+    The patterns are compiled into a single regular expression the first time
+    they are needed. Paths are matched against it as they are listed, so the
+    directory is never walked once per pattern.
+
     Attributes:
         comment_regex: Regex that denotes a comment line.
+        magic_regex: Regex that matches the characters which give a file name
+            in a globbing pattern special meaning.
         path: The path of the exclude pattern file.
+        _regex: The compiled regular expression that matches every pattern,
+            or None if there are no patterns.
+        _compiled: Whether the patterns have been compiled yet.
         _matches: A dict of relative paths of files that match the globbing
             patterns for each input path.
         _all_matches: A dict of relative paths of files that match the globbing
             patterns and all files under them for each input path.
+        scan_threads: The number of threads to use when scanning the
+            directory.
     """
     comment_regex = re.compile(r"^\s*#")
+    magic_regex = re.compile(r"[*?[]")
 
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, scan_threads=1) -> None:
         self.path = path
+        self.scan_threads = scan_threads
+        self._regex = None
+        self._compiled = False
         self._matches = {}
         self._all_matches = {}
-        
+
     def reset(self) -> None:
         """Clear cached information."""
+        self._regex = None
+        self._compiled = False
         self._matches.clear()
         self._all_matches.clear()
 
@@ -339,71 +505,306 @@ class ProfileExcludeFile:
                 if not self.comment_regex.search(line):
                     yield line
 
-    def _glob(self, start_path: str) -> None:
+    @staticmethod
+    def _translate_name(name: str) -> str:
+        """Convert a globbing pattern for a single file name into a regex.
+
+        Args:
+            name: The pattern, which must not contain slashes.
+
+        Returns:
+            A regular expression that matches the same file names.
+        """
+        regex = []
+        i, length = 0, len(name)
+        while i < length:
+            char = name[i]
+            i += 1
+            if char == "*":
+                regex.append("[^/]*")
+            elif char == "?":
+                regex.append("[^/]")
+            elif char == "[":
+                j = i
+                if j < length and name[j] == "!":
+                    j += 1
+                if j < length and name[j] == "]":
+                    j += 1
+                while j < length and name[j] != "]":
+                    j += 1
+                if j >= length:
+                    # An unclosed bracket is matched literally.
+                    regex.append(re.escape(char))
+                    continue
+                char_set = name[i:j].replace("\\", "\\\\")
+                i = j + 1
+                if char_set.startswith("!"):
+                    char_set = "^" + char_set[1:]
+                elif char_set.startswith("^"):
+                    char_set = "\\" + char_set
+                regex.append("(?!/)[{0}]".format(char_set))
+            else:
+                regex.append(re.escape(char))
+
+        return "".join(regex)
+
+    @classmethod
+    def _translate(cls, pattern: str) -> Optional[str]:
+        """Convert a globbing pattern into a regex.
+
+        The regex matches relative paths with a leading slash added, and
+        with a trailing slash added if the path is a directory or a symlink
+        to a directory. This follows
+        the rules of the glob module: hidden files are only matched by a
+        pattern that starts with a dot and a double asterisk only crosses
+        directories when it makes up a whole path component.
+
+        Args:
+            pattern: The globbing pattern, with surrounding whitespace
+                removed.
+
+        Returns:
+            A regular expression that matches the same paths, or None if the
+            pattern doesn't contain any file names.
+        """
+        # Glob patterns without a leading slash search the whole tree.
+        anchored = pattern.startswith("/")
+        dir_only = pattern.endswith("/")
+        names = [name for name in pattern.split("/") if name not in ["", "."]]
+        if not names:
+            return None
+        if not anchored:
+            names.insert(0, "**")
+
+        regex = []
+        for name in names:
+            if name == "**":
+                regex.append("(?:/[^/.][^/]*)*")
+            elif cls.magic_regex.search(name) is None:
+                regex.append("/" + re.escape(name))
+            elif name.startswith("."):
+                regex.append("/(?=[^/])" + cls._translate_name(name))
+            else:
+                regex.append("/(?=[^/.])" + cls._translate_name(name))
+        regex.append("/" if dir_only else "/?")
+
+        return "".join(regex)
+
+    def compile(self) -> Optional[Pattern]:
+        """Compile the patterns in the file into a single regex.
+
+        The regex is matched against paths using is_match().
+
+        Returns:
+            The compiled regex, or None if there are no patterns.
+        """
+        if not self._compiled:
+            regexes = []
+            for line in self._readlines():
+                # This assumes that cases where the user may accidentally
+                # leave leading/trailing whitespace are more common than cases
+                # where they may actually need it. This also strips trailing
+                # newlines.
+                regex = self._translate(line.strip())
+                if regex is not None:
+                    regexes.append("(?:{0})".format(regex))
+
+            self._regex = (
+                re.compile("|".join(regexes), re.DOTALL) if regexes else None)
+            self._compiled = True
+
+        return self._regex
+
+    @staticmethod
+    def is_dir(start_path: str, path: str, stat: os.stat_result) -> bool:
+        """Check if a path counts as a directory when matching patterns.
+
+        Symlinks to directories count as directories, like with the glob
+        module.
+
+        Args:
+            start_path: The directory the path is relative to.
+            path: The relative path to check.
+            stat: The os.stat_result object for the path, not following
+                symlinks.
+
+        Returns:
+            True if the path is a directory or a symlink to one and False
+            otherwise.
+        """
+        if statmod.S_ISLNK(stat.st_mode):
+            return os.path.isdir(os.path.join(start_path, path))
+        return statmod.S_ISDIR(stat.st_mode)
+
+    @staticmethod
+    def is_match(regex: Pattern, path: str, is_dir: bool) -> bool:
+        """Check if a path matches a regex returned by compile().
+
+        Args:
+            regex: The compiled patterns.
+            path: The relative path to check.
+            is_dir: The path is a directory.
+
+        Returns:
+            True if the path matches one of the patterns and False otherwise.
+        """
+        if is_dir:
+            return regex.fullmatch("/" + path + "/") is not None
+        return regex.fullmatch("/" + path) is not None
+
+    def _match(self, start_path: str, paths=None) -> None:
         """Create a set of all file paths that match the globbing patterns.
 
         Args:
             start_path: The directory to search in for files that match the
                 patterns.
+            paths: A dict of the relative paths of the files in the directory
+                and their stats, like the one returned by
+                SyncDir.scan_paths(). If not given, the directory is scanned.
         """
         self._matches[start_path] = set()
         self._all_matches[start_path] = set()
 
-        for line in self._readlines():
-            # This assumes that cases where the user may accidentally leave
-            # leading/trailing whitespace are more common than cases where they
-            # may actually need it. This also strips trailing newlines.
-            line = line.strip()
-            if not line:
-                continue
-            if line.startswith("/"):
-                glob_str = os.path.join(start_path, line.lstrip("/"))
-            else:
-                # Glob patterns without a leading slash search the whole tree.
-                glob_str = os.path.join(start_path, "**", line)
-
-            for match_path in glob.glob(glob_str, recursive=True):
-                rel_match_path = os.path.relpath(match_path, start_path)
-                self._matches[start_path].add(rel_match_path)
-                self._all_matches[start_path].add(rel_match_path)
-                try:
-                    for entry in scan_tree(match_path):
-                        self._all_matches[start_path].add(
-                            os.path.relpath(entry.path, start_path))
-                except NotADirectoryError:
-                    pass
-
-    def matches(self, start_path: str) -> Set[str]:
+        regex = self.compile()
+        if regex is None:
+            return
+
+        if paths is None:
+            path_types = [
+                (os.path.relpath(entry.path, start_path), entry.is_dir())
+                for entry in scan_tree(start_path, threads=self.scan_threads)]
+        else:
+            path_types = [
+                (path, self.is_dir(start_path, path, stat))
+                for path, stat in paths.items()]
+
+        for path, is_dir in path_types:
+            if self.is_match(regex, path, is_dir):
+                self._matches[start_path].add(path)
+
+        # Files under a matching directory are found with a prefix test
+        # instead of scanning each directory again.
+        match_trie = PathTrie(self._matches[start_path])
+        self._all_matches[start_path] = {
+            path for path, _ in path_types if match_trie.has_ancestor(path)}
+
+    def matches(self, start_path: str, paths=None) -> Set[str]:
         """Get the paths of files that match globbing patterns.
 
         Args:
             start_path: The path to search for matches in.
+            paths: A dict of the relative paths of the files in the directory
+                and their stats. If given, these are matched against instead
+                of scanning the directory.
 
         Returns:
             The relative paths of files in the specified directory that match
             the globbing patterns.
         """
         if start_path not in self._matches:
-            self._glob(start_path)
+            self._match(start_path, paths)
 
         return self._matches[start_path]
 
-    def all_matches(self, start_path: str) -> Set[str]:
+    def all_matches(self, start_path: str, paths=None) -> Set[str]:
         """Get the paths of files that match globbing patterns with children.
 
         Args:
             start_path: The path to search for matches in.
+            paths: A dict of the relative paths of the files in the directory
+                and their stats. If given, these are matched against instead
+                of scanning the directory.
 
         Returns:
             The relative paths of files in the specified directory that match
             the globbing patterns and all of their children.
         """
         if start_path not in self._all_matches:
-            self._glob(start_path)
+            self._match(start_path, paths)
 
         return self._all_matches[start_path]
 
 
+class ProfileExcludeCacheFile(JSONFile):
+    """Cache the compiled exclude patterns of every client.
+
+    The patterns of each exclude file in the remote directory are stored as
+    a regex along with the mtime and size of the file. A file is only parsed
+    again once its mtime or size changes.
+
+    Args:
+        path: The path of the JSON file.
+
+    Attributes:
+        FORMAT_VERSION: The version of the format of the cached regexes. This
+            must be incremented whenever the way patterns are translated
+            changes so that existing caches are discarded.
+        vals: A dict containing the format version and a dict with the path
+            of each exclude file as keys and dicts containing its mtime, size
+            and regex as values.
+    """
+    FORMAT_VERSION = 1
+
+    def __init__(self, path: str) -> None:
+        super().__init__(path)
+        self.vals = {"Version": self.FORMAT_VERSION, "Files": {}}
+
+    def read(self) -> None:
+        """Read the file, starting with an empty cache if it's unreadable.
+
+        The cache is also discarded if it was written in a different format.
+        """
+        try:
+            super().read()
+        except (FileNotFoundError, ValueError):
+            self.vals = None
+        if (not isinstance(self.vals, dict)
+                or self.vals.get("Version") != self.FORMAT_VERSION):
+            self.vals = {"Version": self.FORMAT_VERSION, "Files": {}}
+
+    def get_regexes(self, paths: Iterable[str]) -> List[Optional[Pattern]]:
+        """Get the compiled patterns of each exclude file.
+
+        Entries for files that are not given are removed from the cache.
+        Files that don't exist are skipped.
+
+        Args:
+            paths: The paths of the exclude files.
+
+        Returns:
+            A list of the regex for each file, or None for files which don't
+            contain any patterns. See ProfileExcludeFile.is_match().
+        """
+        self.read()
+        old_files = self.vals["Files"]
+        new_files = {}
+        for path in paths:
+            data = old_files.get(path)
+            try:
+                path_stat = os.stat(path)
+                if (data is None
+                        or data["mtime"] != path_stat.st_mtime_ns
+                        or data["size"] != path_stat.st_size):
+                    regex = ProfileExcludeFile(path).compile()
+                    data = {
+                        "mtime": path_stat.st_mtime_ns,
+                        "size": path_stat.st_size,
+                        "regex": None if regex is None else regex.pattern}
+            except FileNotFoundError:
+                # The client was removed since the files were listed.
+                continue
+            new_files[path] = data
+
+        if new_files != old_files:
+            self.vals["Files"] = new_files
+            self.write()
+
+        return [
+            None if data["regex"] is None
+            else re.compile(data["regex"], re.DOTALL)
+            for data in new_files.values()]
+
+
 class ProfileInfoFile(JSONFile):
     """Parse a JSON-formatted file for profile metadata.
 
@@ -430,6 +831,8 @@ class ProfileInfoFile(JSONFile):
             "Status": "partial",
             "LastSync": None,
             "LastAdjust": None,
+            "LastRescan": None,
+            "PriorityExponent": 0.0,
             "Version": version,
             "ID": unique_id,
             "InitOptions": {}
@@ -496,62 +899,68 @@ class ProfileDBFile(SyncDBFile):
                 );
                 """)
 
-    def _update_priority(self, paths: Iterable[str]) -> None:
-        """Update the priority values of directories.
+    def _update_dirs(self, paths: Iterable[str], local=True) -> None:
+        """Update the priority values and local status of directories.
 
-        Directories are checked in leaf-to-trunk order. The priority value
-        of a directory is set to the sum of the priority values of all its
-        immediate children. For every directory that's checked, all of its
-        ancestors up the tree are also checked.
+        The priority value of a directory is set to the sum of the priority
+        values of all its immediate children. A directory is considered to be
+        not in the local directory if any of its immediate children are not
+        in the local directory. Every directory that's given and all of its
+        ancestors up the tree are updated.
 
-        Args:
-            paths: The relative paths of the directories to update the priority
-                values of.
-        """
-        nodes_values = []
-        for path in get_path_ancestry(paths):
-            path_id = self._get_path_id(path)
-            nodes_values.append({"path_id": path_id})
-
-        self._cur.executemany("""\
-            UPDATE nodes
-            SET priority = (
-                SELECT COALESCE(SUM(n.priority), 0)
-                FROM nodes AS n
-                JOIN closure AS c
-                ON (n.id = c.descendant)
-                WHERE c.ancestor = :path_id
-                AND c.depth = 1)
-            WHERE id = :path_id;
-            """, nodes_values)
-
-    def _update_local(self, paths: Iterable[str]) -> None:
-        """Update whether directories have been kept in the local directory.
-
-        Directories are checked in leaf-to-trunk order. A directory is
-        considered to be not in the local directory if any of its immediate
-        children are not in the local directory. For every directory that's
-        checked, all of its ancestors up the tree are also checked.
+        The directories to update are stored in a temporary table along with
+        their depth, and then each level of the tree is updated with a single
+        statement in leaf-to-trunk order.
 
         Args:
             paths: The relative paths of the directories to update.
+            local: Update whether directories have been kept in the local
+                directory as well as their priority values.
         """
-        nodes_values = []
-        for path in get_path_ancestry(paths):
-            path_id = self._get_path_id(path)
-            nodes_values.append({"path_id": path_id})
+        # A generator expression can't be used here because recursive use of
+        # cursors is not allowed.
+        ancestor_vals = [
+            (self._get_path_id(path), path.count(os.sep))
+            for path in get_path_ancestry(paths)]
+        if not ancestor_vals:
+            return
 
+        self._cur.execute("""\
+            CREATE TEMP TABLE IF NOT EXISTS ancestors (
+                id      INTEGER PRIMARY KEY,
+                depth   INT     NOT NULL);
+            """)
+        self._cur.execute("""\
+            DELETE FROM ancestors;
+            """)
         self._cur.executemany("""\
-            UPDATE nodes
-            SET local = (
-                SELECT COALESCE(MIN(n.local), 0)
-                FROM nodes AS n
-                JOIN closure AS c
-                ON (n.id = c.descendant)
-                WHERE c.ancestor = :path_id
-                AND c.depth = 1)
-            WHERE id = :path_id;
-            """, nodes_values)
+            INSERT OR IGNORE INTO ancestors (id, depth)
+            VALUES (?, ?);
+            """, ancestor_vals)
+
+        depths = sorted({depth for _, depth in ancestor_vals}, reverse=True)
+        for depth in depths:
+            self._cur.execute("""\
+                UPDATE nodes
+                SET priority = (
+                    SELECT COALESCE(SUM(n.priority), 0)
+                    FROM nodes AS n
+                    JOIN closure AS c
+                    ON (n.id = c.descendant)
+                    WHERE c.ancestor = nodes.id
+                    AND c.depth = 1),
+                local = CASE WHEN :local THEN (
+                    SELECT COALESCE(MIN(n.local), 0)
+                    FROM nodes AS n
+                    JOIN closure AS c
+                    ON (n.id = c.descendant)
+                    WHERE c.ancestor = nodes.id
+                    AND c.depth = 1) ELSE local END
+                WHERE id IN (
+                    SELECT id
+                    FROM ancestors
+                    WHERE depth = :depth);
+                """, {"local": local, "depth": depth})
 
     def add_paths(self, files: Iterable[str], dirs: Iterable[str],
                   priority=0, local=True) -> None:
@@ -568,6 +977,7 @@ class ProfileDBFile(SyncDBFile):
             local: The paths are the paths of files that have been kept in the
                 local directory.
         """
+        self._check_path_ids()
         # Sort paths by depth. A file can't be added to the database until its
         # parent directory has been added.
         files = set(files)
@@ -613,6 +1023,7 @@ class ProfileDBFile(SyncDBFile):
                 """, insert_nodes_vals)
             if self._cur.rowcount <= 0:
                 break
+            self._clear_path_ids()
 
         # Insert new values into both tables.
         self._cur.executemany("""\
@@ -627,8 +1038,7 @@ class ProfileDBFile(SyncDBFile):
             UNION ALL SELECT :path_id, :path_id, 0;
             """, insert_closure_vals)
         self._mark_directory(parents)
-        self._update_priority(parents)
-        self._update_local(parents)
+        self._update_dirs(parents)
 
     def add_inflated(self, files: Iterable[str], dirs: Iterable[str]) -> None:
         """Add new file paths to the database with an inflated priority.
@@ -658,6 +1068,7 @@ class ProfileDBFile(SyncDBFile):
             local: The paths are the paths of files that have been kept in the
                 local directory. Use None to leave the value unchanged.
         """
+        self._check_path_ids()
         update_vals = []
         for path in paths:
             path_id = self._get_path_id(path)
@@ -691,8 +1102,7 @@ class ProfileDBFile(SyncDBFile):
 
         parents = {
             os.path.dirname(path) for path in paths if os.path.dirname(path)}
-        self._update_priority(parents)
-        self._update_local(parents)
+        self._update_dirs(parents)
 
     def rm_paths(self, paths: Iterable[str]) -> None:
         """Remove file paths from the database.
@@ -703,6 +1113,7 @@ class ProfileDBFile(SyncDBFile):
         Args:
             paths: The file paths to remove.
         """
+        self._check_path_ids()
         # A generator expression can't be used here because recursive use of
         # cursors is not allowed.
         rm_vals = [{
@@ -726,8 +1137,9 @@ class ProfileDBFile(SyncDBFile):
                 SELECT path
                 FROM nodes);
             """)
-        self._update_priority(parents)
-        self._update_local(parents)
+        if self._cur.rowcount > 0:
+            self._clear_path_ids()
+        self._update_dirs(parents)
 
     def get_path_info(self, path: str) -> PathData:
         """Get data associated with a file path.
@@ -740,6 +1152,7 @@ class ProfileDBFile(SyncDBFile):
             a directory, the file priority and a bool representing whether
             the file has been kept in the local directory.
         """
+        self._check_path_ids()
         # Clear the query result set.
         self._cur.fetchall()
 
@@ -754,6 +1167,87 @@ class ProfileDBFile(SyncDBFile):
         if result:
             return PathData(*result)
 
+    def lookup_paths(self, paths: Iterable[str]) -> Dict[str, PathData]:
+        """Get data associated with many file paths at once.
+
+        Args:
+            paths: The file paths to search the database for.
+
+        Returns:
+            A dict containing the paths that were found in the database as
+            keys and named tuples like those returned by get_path_info() as
+            values.
+        """
+        self._check_path_ids()
+        # Clear the query result set.
+        self._cur.fetchall()
+
+        self._fill_lookup_table(paths)
+        self._cur.execute("""\
+            SELECT n.path, n.directory, n.priority, n.local
+            FROM nodes AS n
+            JOIN lookup AS l
+            ON (n.id = l.id);
+            """)
+
+        return {
+            path: PathData(directory, priority, local)
+            for array in iter(self._cur.fetchmany, [])
+            for path, directory, priority, local in array}
+
+    def iter_paths(
+            self, root=None, directory=None, local=None, ordered=False
+            ) -> Generator[Tuple[str, PathData], None, None]:
+        """Iterate over the paths of files in the database.
+
+        This takes the same arguments as get_paths(), but rows are read from
+        the database lazily instead of all being loaded into memory at once.
+        A separate cursor is used so that the database can be queried while
+        iterating.
+
+        Args:
+            ordered: Yield the paths in sorted order. Paths are compared by
+                code point, which is the same order that Python uses to
+                compare strings.
+
+        Yields:
+            A tuple containing a file path and a named tuple of data
+            associated with it.
+        """
+        self._check_path_ids()
+        cursor = self._conn.cursor()
+        cursor.arraysize = self._cur.arraysize
+        if root:
+            cursor.execute("""\
+                SELECT n.path, n.directory, n.priority, n.local
+                FROM nodes AS n
+                JOIN closure AS c
+                ON (n.id = c.descendant)
+                WHERE c.ancestor = :start_id
+                AND (:directory IS NULL OR n.directory = :directory)
+                AND (:local IS NULL OR n.local = :local)
+                {0};
+                """.format("ORDER BY n.path" if ordered else ""), {
+                    "start_id": self._get_path_id(root),
+                    "directory": directory, "local": local})
+        else:
+            # Every node is its own descendant in the closure table, so
+            # joining it here would return each path once for every ancestor.
+            cursor.execute("""\
+                SELECT path, directory, priority, local
+                FROM nodes
+                WHERE (:directory IS NULL OR directory = :directory)
+                AND (:local IS NULL OR local = :local)
+                {0};
+                """.format("ORDER BY path" if ordered else ""),
+                {"directory": directory, "local": local})
+
+        # As long as cursor.arraysize is greater than 1, fetchmany() should
+        # be more efficient than fetchall().
+        for array in iter(cursor.fetchmany, []):
+            for path, directory, priority, local in array:
+                yield path, PathData(directory, priority, local)
+
     def get_paths(
             self, root=None, directory=None, local=None
             ) -> Dict[str, PathData]:
@@ -775,24 +1269,8 @@ class ProfileDBFile(SyncDBFile):
             is a directory, the file priority and a bool representing whether
             the file has been kept in the local directory.
         """
-        start_id = self._get_path_id(root) if root else None
-        self._cur.execute("""\
-            SELECT n.path, n.directory, n.priority, n.local
-            FROM nodes AS n
-            JOIN closure AS c
-            ON (n.id = c.descendant)
-            WHERE (:start_id IS NULL OR c.ancestor = :start_id)
-            AND (:directory IS NULL OR n.directory = :directory)
-            AND (:local IS NULL OR n.local = :local);
-            """, {
-                "start_id": start_id, "directory": directory, "local": local})
-
-        # As long as self._cur.arraysize is greater than 1, fetchmany() should
-        # be more efficient than fetchall().
-        return {
-            path: PathData(directory, priority, local)
-            for array in iter(self._cur.fetchmany, [])
-            for path, directory, priority, local in array}
+        return dict(self.iter_paths(
+            root=root, directory=directory, local=local))
 
     def increment(self, paths: Iterable[str],
                   increment: Union[int, float]) -> None:
@@ -802,6 +1280,7 @@ class ProfileDBFile(SyncDBFile):
             paths: The paths to increment the priority of.
             increment: The value to increment the paths by.
         """
+        self._check_path_ids()
         # A generator expression can't be used here because recursive use of
         # cursors is not allowed.
         increment_vals = [{
@@ -816,7 +1295,7 @@ class ProfileDBFile(SyncDBFile):
             SET priority = priority + :increment
             WHERE id = :path_id;
             """, increment_vals)
-        self._update_priority(parents)
+        self._update_dirs(parents, local=False)
 
     def adjust_all(self, adjustment: Union[int, float]) -> None:
         """Multiply the priorities of all file paths by a constant.
@@ -868,7 +1347,10 @@ class ProfileConfigFile(ConfigFile):
         ]
     _optional_keys = [
         "SyncInterval", "PriorityHalfLife", "UseTrash", "TrashCleanupPeriod",
-        "InflatePriority", "AccountForSize"
+        "InflatePriority", "AccountForSize", "ScanThreads",
+        "TransferThreads", "DeltaThreshold", "SelectionStrategy",
+        "FlushInterval", "WatchBackend", "SyncMode", "RescanInterval",
+        "SyncDelay", "MaxSyncDelay"
         ]
     _all_keys = _required_keys + _optional_keys
     _bool_keys = [
@@ -880,7 +1362,17 @@ class ProfileConfigFile(ConfigFile):
         "UseTrash": "yes",
         "TrashCleanupPeriod": "30",
         "InflatePriority": "yes",
-        "AccountForSize": "yes"
+        "AccountForSize": "yes",
+        "ScanThreads": "1",
+        "TransferThreads": "1",
+        "DeltaThreshold": "-1",
+        "SelectionStrategy": "greedy",
+        "FlushInterval": "3",
+        "WatchBackend": "auto",
+        "SyncMode": "subprocess",
+        "RescanInterval": "24",
+        "SyncDelay": "-1",
+        "MaxSyncDelay": "60"
         }
     _prompt_messages = {
         "LocalDir":     "Enter the path of the local sync directory.",
@@ -930,9 +1422,29 @@ class ProfileConfigFile(ConfigFile):
         elif key == "PriorityHalfLife":
             if not re.search("^[0-9]+$", value):
                 return "must be an integer"
-        elif key == "TrashCleanupPeriod":
+        elif key in ["TrashCleanupPeriod", "SyncDelay"]:
             if not re.search(r"^-?[0-9]+$", value):
                 return "must be an integer"
+        elif key in [
+                "ScanThreads", "TransferThreads", "FlushInterval",
+                "RescanInterval", "MaxSyncDelay"]:
+            if not re.search("^[1-9][0-9]*$", value):
+                return "must be a positive integer"
+        elif key == "DeltaThreshold":
+            if not re.search(
+                    r"^(-[0-9]+|[0-9]+\s*[KMG](B|iB)?)$", value,
+                    re.IGNORECASE):
+                return ("must be a negative integer or an integer followed "
+                        "by a unit (e.g. 100MB)")
+        elif key == "SelectionStrategy":
+            if value not in STRATEGIES:
+                return "must be one of: {0}".format(", ".join(STRATEGIES))
+        elif key == "WatchBackend":
+            if value not in WATCH_BACKENDS:
+                return "must be one of: {0}".format(", ".join(WATCH_BACKENDS))
+        elif key == "SyncMode":
+            if value not in SYNC_MODES:
+                return "must be one of: {0}".format(", ".join(SYNC_MODES))
 
     def check_all(self, check_empty=True, context="config file") -> None:
         """Check that file is valid and syntactically correct.
@@ -0,0 +1,229 @@
+"""Select which files to keep in the local directory.
+
+Copyright © 2016-2018 Garrett Powell <garrett@gpowell.net>
+
+This file is part of zielen.
+
+zielen is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+zielen is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with zielen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import heapq
+from array import array
+from typing import Iterable, List, Set, Tuple
+
+from zielen.utils import PathTrie
+
+STRATEGIES = ["greedy", "knapsack"]
+
+
+class FileSelector:
+    """Choose a subset of files that fits in a given amount of space.
+
+    The data for each file is stored in compact arrays indexed by the
+    position of the file path in a list. Two strategies are available:
+
+    greedy: Files are considered in order of priority and every file that
+        still fits is selected. If the priority is adjusted for size, the
+        priority of each file is divided by its size.
+    knapsack: Files are considered in order of priority per byte, and the
+        result is compared with the one obtained by selecting the single
+        file with the highest priority first. Whichever selection has the
+        highest total priority is used. This generally makes better use of
+        the available space.
+
+    Args:
+        exclude: An iterable of paths of files and directories to not
+            consider when selecting files.
+        account_for_size: Divide the priority of each file by its size when
+            using the greedy strategy.
+
+    Attributes:
+        account_for_size: Divide the priority of each file by its size when
+            using the greedy strategy.
+        _exclude: A PathTrie of paths of files and directories to not
+            consider.
+        _paths: A list of the paths of the files that have been added.
+        _priorities: An array of the priority of each file.
+        _sizes: An array of the size of each file in bytes.
+    """
+    def __init__(self, exclude=None, account_for_size=True) -> None:
+        self.account_for_size = account_for_size
+        self._exclude = PathTrie(exclude or [])
+        self._paths = []
+        self._priorities = array("d")
+        self._sizes = array("q")
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    def is_excluded(self, path: str) -> bool:
+        """Check if a path or any of its parent directories is excluded.
+
+        Args:
+            path: The relative path to check.
+
+        Returns:
+            True if the path is excluded and False otherwise.
+        """
+        return self._exclude.has_ancestor(path)
+
+    def add(self, path: str, priority: float, size: int) -> None:
+        """Add a file to select from unless it is excluded.
+
+        Args:
+            path: The relative path of the file.
+            priority: The priority of the file.
+            size: The disk usage of the file in bytes.
+        """
+        if self._exclude and self.is_excluded(path):
+            return
+        self._paths.append(path)
+        self._priorities.append(priority)
+        self._sizes.append(size)
+
+    def select(
+            self, space_limit: int, symlink_size: int,
+            strategy="greedy") -> Tuple[int, Set[str]]:
+        """Select files to fit in the given amount of space.
+
+        Every file that is not selected is assumed to take up the space of
+        a symlink.
+
+        Args:
+            space_limit: The amount of space available (in bytes), assuming
+                that every file is a symlink.
+            symlink_size: The disk usage of a symlink in bytes.
+            strategy: The name of the strategy to use.
+
+        Returns:
+            A tuple containing the amount of space remaining (in bytes) and a
+            set of the paths of the selected files.
+
+        Raises:
+            ValueError: The strategy is not recognized.
+        """
+        if strategy == "greedy":
+            indices = self._select_greedy(space_limit, symlink_size)
+        elif strategy == "knapsack":
+            indices = self._select_knapsack(space_limit, symlink_size)
+        else:
+            raise ValueError("unrecognized strategy '{0}'".format(strategy))
+
+        remaining_space = space_limit
+        for index in indices:
+            remaining_space -= self._sizes[index] - symlink_size
+
+        return remaining_space, {self._paths[index] for index in indices}
+
+    def _fill(
+            self, ordered_indices: Iterable[int], space_limit: int,
+            symlink_size: int, min_cost: int) -> List[int]:
+        """Select every file that still fits, in order.
+
+        Args:
+            ordered_indices: The indices of the files in the order that they
+                should be considered.
+            space_limit: The amount of space available in bytes.
+            symlink_size: The disk usage of a symlink in bytes.
+            min_cost: The smallest amount of space that selecting any file
+                can take up. Once the remaining space is smaller than this,
+                the remaining files are not considered.
+
+        Returns:
+            A list of the indices of the selected files.
+        """
+        selected = []
+        remaining_space = space_limit
+        for index in ordered_indices:
+            if remaining_space <= min_cost:
+                break
+            new_remaining_space = (
+                remaining_space - self._sizes[index] + symlink_size)
+            if new_remaining_space > 0:
+                selected.append(index)
+                remaining_space = new_remaining_space
+
+        return selected
+
+    def _select_greedy(self, space_limit: int, symlink_size: int) -> List[int]:
+        """Select files in order of priority.
+
+        Files of the same priority are ordered by file path so that the
+        results are always predictable. A heap is used so that files are only
+        ordered until no more of them fit in the remaining space.
+        """
+        if not self._paths:
+            return []
+
+        if self.account_for_size:
+            keys = [
+                -priority / size if size else 0
+                for priority, size in zip(self._priorities, self._sizes)]
+        else:
+            keys = [-priority for priority in self._priorities]
+
+        heap = list(zip(keys, self._paths, range(len(self._paths))))
+        heapq.heapify(heap)
+        ordered_indices = (
+            heapq.heappop(heap)[2] for _ in range(len(heap)))
+
+        min_cost = min(self._sizes) - symlink_size
+        return self._fill(ordered_indices, space_limit, symlink_size, min_cost)
+
+    def _select_knapsack(
+            self, space_limit: int, symlink_size: int) -> List[int]:
+        """Select files in order of priority per byte with backfilling.
+
+        This is the greedy 1/2-approximation for the 0-1 knapsack problem,
+        with the remaining space after the single best file being filled as
+        well.
+        """
+        if not self._paths:
+            return []
+
+        def density(index: int) -> float:
+            cost = self._sizes[index] - symlink_size
+            if cost <= 0:
+                return float("inf")
+            return self._priorities[index] / cost
+
+        ordered_indices = sorted(
+            range(len(self._paths)),
+            key=lambda x: (-density(x), self._paths[x]))
+        min_cost = min(self._sizes) - symlink_size
+
+        density_selected = self._fill(
+            ordered_indices, space_limit, symlink_size, min_cost)
+
+        # Find the file with the highest priority that fits on its own.
+        best_index = None
+        for index in range(len(self._paths)):
+            if space_limit - self._sizes[index] + symlink_size <= 0:
+                continue
+            if (best_index is None
+                    or self._priorities[index] > self._priorities[best_index]):
+                best_index = index
+
+        if best_index is None or best_index in set(density_selected):
+            return density_selected
+
+        best_remaining_space = (
+            space_limit - self._sizes[best_index] + symlink_size)
+        best_selected = [best_index] + self._fill(
+            (index for index in ordered_indices if index != best_index),
+            best_remaining_space, symlink_size, min_cost)
+
+        if (sum(self._priorities[index] for index in best_selected)
+                > sum(self._priorities[index] for index in density_selected)):
+            return best_selected
+        return density_selected
@@ -21,28 +21,244 @@ import os
 import shutil
 import sqlite3
 import time
+import stat as statmod
+import collections
 from typing import (
-    Tuple, Iterable, List, Dict, NamedTuple, Generator, Union, Set)
+    Tuple, Iterable, List, Dict, NamedTuple, Generator, Union, Set, Optional,
+    FrozenSet)
 
 from zielen.exceptions import RemoteError
 from zielen.containerbase import SyncDBFile
-from zielen.fstools import scan_tree
-from zielen.profile import ProfileExcludeFile
-from zielen.utils import FactoryDict, secure_string
+from zielen.fstools import scan_tree, is_temp_name
+from zielen.profile import ProfileExcludeFile, ProfileExcludeCacheFile
+from zielen.utils import (
+    FactoryDict, PathTrie, secure_string, get_path_ancestry)
 
 PathData = NamedTuple("PathData", [("directory", bool), ("lastsync", float)])
 
+SnapshotData = NamedTuple(
+    "SnapshotData",
+    [("mode", int), ("inode", int), ("mtime", int), ("ctime", int),
+     ("size", int), ("blocks", int)])
+
+# Filesystem timestamps only advance once per clock tick, which can be as long
+# as two seconds, so a directory modified within this many nanoseconds of when
+# it was scanned may be modified again without its timestamps changing.
+TIMESTAMP_GRANULARITY = 2 * 10**9
+
 
 class SyncDir:
     """Perform operations on a sync directory.
 
+    Args:
+        path: The path of the directory.
+        snapshot_path: The path of the database file used to store the stats
+            of files between scans. If None, the whole directory is read each
+            time it is scanned.
+        scan_threads: The number of threads to use when scanning the
+            directory.
+
     Attributes:
         path: The directory path without a trailing slash.
+        scan_threads: The number of threads to use when scanning the
+            directory.
+        _snapshot_file: The snapshot database object, if any.
+        _sub_stats: A dict of relative paths and os.stat_result objects for
+            every file in the directory from the last scan.
+        _stat_index: A dict of both relative and absolute paths and their
+            os.stat_result objects from the last scan. This is used to look up
+            the stats of files in constant time.
     """
 
-    def __init__(self, path: str) -> None:
+    def __init__(self, path: str, snapshot_path=None, scan_threads=1) -> None:
         self.path = path.rstrip(os.sep)
-        self._sub_entries = []
+        self.scan_threads = scan_threads
+        self._sub_stats = {}
+        self._stat_index = {}
+        if snapshot_path is None:
+            self._snapshot_file = None
+        else:
+            self._snapshot_file = SnapshotDBFile(snapshot_path)
+
+    def _add_stat(self, abs_path: str, stat: os.stat_result) -> str:
+        """Store the stats of a scanned file.
+
+        Args:
+            abs_path: The absolute path of the file.
+            stat: The os.stat_result object for the file.
+
+        Returns:
+            The relative path of the file.
+        """
+        # Computing the relative path is expensive to do each time.
+        rel_path = os.path.relpath(abs_path, self.path)
+        self._sub_stats[rel_path] = stat
+        self._stat_index[rel_path] = stat
+        self._stat_index[abs_path] = stat
+        return rel_path
+
+    def _scan(self, dirty_paths=None) -> None:
+        """Scan the filesystem and store the stats of every file.
+
+        If there is a snapshot from a previous scan, directories whose inode,
+        mtime and ctime have not changed since then are not read. The names of
+        the files in them are taken from the snapshot instead. Directories
+        which were modified too close to the start of the previous scan are
+        always read, because they may have changed again within the same
+        timestamp tick. The snapshot is updated once the scan is complete.
+
+        Args:
+            dirty_paths: The relative paths of the only files and directories
+                that may have changed since the last scan. If given, the stats
+                of every other file are taken from the snapshot.
+        """
+        self._sub_stats = {}
+        self._stat_index = {}
+        if self._snapshot_file is None:
+            for entry in scan_tree(self.path, threads=self.scan_threads):
+                if is_temp_name(entry.name):
+                    continue
+                self._add_stat(entry.path, entry.stat(follow_symlinks=False))
+            return
+
+        # The stats of the directory itself must be taken before it is read
+        # so that any changes made during the scan are picked up next time.
+        scan_start = int(time.time() * 10**9)
+        root_stat = os.stat(self.path, follow_symlinks=False)
+        old_snapshot = self._snapshot_file.get_stats()
+        old_scan_start = self._snapshot_file.get_scan_start()
+
+        if dirty_paths is not None and old_snapshot and old_scan_start:
+            new_snapshot = self._scan_dirty(old_snapshot, dirty_paths)
+            if new_snapshot is not None:
+                new_snapshot["."] = SnapshotDBFile.from_stat(root_stat)
+                # Directories outside of the dirty paths weren't stat'ed
+                # again, so they must still be compared against the time of
+                # the scan that their stats came from.
+                self._snapshot_file.update(
+                    old_snapshot, new_snapshot, old_scan_start)
+                return
+            self._sub_stats = {}
+            self._stat_index = {}
+
+        # Group the names of files in the snapshot by parent directory.
+        old_names = collections.defaultdict(list)
+        for rel_path in old_snapshot:
+            if rel_path != ".":
+                parent, name = os.path.split(rel_path)
+                old_names[parent or "."].append(name)
+
+        # Directories with timestamps at or after this time may have been
+        # modified in the same tick as they were stat'ed by the last scan.
+        racy_time = (
+            None if old_scan_start is None
+            else old_scan_start - TIMESTAMP_GRANULARITY)
+
+        def cached_names(dir_path: str, dir_stat: os.stat_result):
+            rel_dir_path = os.path.relpath(dir_path, self.path)
+            old_data = old_snapshot.get(rel_dir_path)
+            if (old_data
+                    and racy_time is not None
+                    and old_data.mtime < racy_time
+                    and old_data.ctime < racy_time
+                    and old_data.inode == dir_stat.st_ino
+                    and old_data.mtime == dir_stat.st_mtime_ns
+                    and old_data.ctime == dir_stat.st_ctime_ns):
+                return old_names[rel_dir_path]
+            return None
+
+        new_snapshot = {".": SnapshotDBFile.from_stat(root_stat)}
+        for entry in scan_tree(
+                self.path, cached_names, threads=self.scan_threads):
+            # Skip the temporary files of transfers which are in progress or
+            # were interrupted.
+            if is_temp_name(entry.name):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            rel_path = self._add_stat(entry.path, stat)
+            new_snapshot[rel_path] = SnapshotDBFile.from_stat(stat)
+
+        self._snapshot_file.update(old_snapshot, new_snapshot, scan_start)
+
+    def _scan_dirty(
+            self, old_snapshot: Dict[str, SnapshotData],
+            dirty_paths: Iterable[str]) -> Optional[Dict[str, SnapshotData]]:
+        """Store the stats of every file, only reading the ones that changed.
+
+        Files which are not under any of the dirty paths are assumed to be
+        unchanged since the last scan. The dirty paths and their parent
+        directories are stat'ed again, and the dirty directories are scanned.
+
+        Args:
+            old_snapshot: The stats from the last scan.
+            dirty_paths: The relative paths of the only files and directories
+                that may have changed since the last scan.
+
+        Returns:
+            The stats to store in the new snapshot, not including the
+            directory itself, or None if the snapshot doesn't match the
+            filesystem and the whole directory must be scanned.
+        """
+        dirty_trie = PathTrie(dirty_paths)
+        new_snapshot = {
+            rel_path: data for rel_path, data in old_snapshot.items()
+            if rel_path != "." and not dirty_trie.has_ancestor(rel_path)}
+        for rel_path, data in new_snapshot.items():
+            stat = SnapshotDBFile.to_stat(data)
+            self._sub_stats[rel_path] = stat
+            self._stat_index[rel_path] = stat
+            self._stat_index[os.path.join(self.path, rel_path)] = stat
+
+        dirty_roots = [
+            path for path in dirty_trie
+            if not dirty_trie.has_ancestor(path, include_self=False)]
+        parent_paths = set(get_path_ancestry(
+            os.path.dirname(path) for path in dirty_roots)) - {""}
+
+        # The parent directories of the dirty paths haven't been removed,
+        # replaced or renamed, or they would be dirty too.
+        for rel_path in parent_paths:
+            try:
+                stat = os.stat(
+                    os.path.join(self.path, rel_path), follow_symlinks=False)
+            except (FileNotFoundError, NotADirectoryError):
+                return None
+            if not statmod.S_ISDIR(stat.st_mode):
+                return None
+            self._add_stat(os.path.join(self.path, rel_path), stat)
+            new_snapshot[rel_path] = SnapshotDBFile.from_stat(stat)
+
+        for rel_path in dirty_roots:
+            if is_temp_name(os.path.basename(rel_path)):
+                continue
+            abs_path = os.path.join(self.path, rel_path)
+            try:
+                stat = os.stat(abs_path, follow_symlinks=False)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            self._add_stat(abs_path, stat)
+            new_snapshot[rel_path] = SnapshotDBFile.from_stat(stat)
+
+            if statmod.S_ISDIR(stat.st_mode):
+                for entry in scan_tree(abs_path, threads=self.scan_threads):
+                    if is_temp_name(entry.name):
+                        continue
+                    stat = entry.stat(follow_symlinks=False)
+                    entry_path = self._add_stat(entry.path, stat)
+                    new_snapshot[entry_path] = SnapshotDBFile.from_stat(stat)
+
+        return new_snapshot
+
+    def rescan(self, dirty_paths=None) -> None:
+        """Scan the filesystem again, discarding the cached stats.
+
+        Args:
+            dirty_paths: The relative paths of the only files and directories
+                that may have changed since the last scan. If given and there
+                is a snapshot, the stats of every other file are taken from
+                the snapshot instead of the filesystem.
+        """
+        self._scan(dirty_paths)
 
     def scan_paths(
             self, rel=True, files=True, symlinks=True, dirs=True, exclude=None,
@@ -71,40 +287,60 @@ class SyncDir:
         exclude = set() if exclude is None else set(exclude)
         if lookup:
             def lookup_stat(path: str) -> os.stat_result:
-                full_path = os.path.join(self.path, path)
-                for entry, rel_path in self._sub_entries:
-                    if entry.path == full_path:
-                        return entry.stat()
-                return os.stat(full_path, follow_symlinks=False)
+                # Paths are looked up in the index first so that no file is
+                # stat'ed twice.
+                try:
+                    return self._stat_index[path]
+                except KeyError:
+                    return os.stat(
+                        os.path.join(self.path, path), follow_symlinks=False)
 
             output = FactoryDict(lookup_stat)
         else:
             output = {}
 
-        if not memoize or not self._sub_entries:
-            self._sub_entries = []
-            for entry in scan_tree(self.path):
-                # Computing the relative path is expensive to do each time.
-                rel_path = os.path.relpath(entry.path, self.path)
-                self._sub_entries.append((entry, rel_path))
+        if not memoize or not self._sub_stats:
+            self._scan()
 
-        for entry, rel_path in self._sub_entries:
-            if entry.is_file(follow_symlinks=False) and not files:
+        for rel_path, stat in self._sub_stats.items():
+            if statmod.S_ISREG(stat.st_mode) and not files:
                 continue
-            elif entry.is_dir(follow_symlinks=False) and not dirs:
+            elif statmod.S_ISDIR(stat.st_mode) and not dirs:
                 continue
-            elif entry.is_symlink() and not symlinks:
+            elif statmod.S_ISLNK(stat.st_mode) and not symlinks:
                 continue
             elif rel_path in exclude:
                 continue
             else:
                 if rel:
-                    output[rel_path] = entry.stat(follow_symlinks=False)
+                    output[rel_path] = stat
                 else:
-                    output[entry.path] = entry.stat(follow_symlinks=False)
+                    output[os.path.join(self.path, rel_path)] = stat
 
         return output
 
+    def iter_stats(
+            self, memoize=True) -> Generator[
+                Tuple[str, os.stat_result], None, None]:
+        """Iterate over the paths and stats of files in the directory.
+
+        Unlike scan_paths(), this doesn't copy the stats of every file, and
+        the paths are yielded in sorted order.
+
+        Args:
+            memoize: If true, use cached data. Otherwise, re-scan the
+                filesystem.
+
+        Yields:
+            A tuple containing a relative file path and an os.stat_result
+            object for the file, not following symlinks.
+        """
+        if not memoize or not self._sub_stats:
+            self._scan()
+
+        for rel_path in sorted(self._sub_stats):
+            yield rel_path, self._sub_stats[rel_path]
+
     def disk_usage(self, memoize=True) -> int:
         """Get the total disk usage of the directory and all of its contents.
 
@@ -129,11 +365,16 @@ class SyncDir:
         """
         return shutil.disk_usage(self.path).free
 
+    def close(self) -> None:
+        """Close all database connections."""
+        if self._snapshot_file is not None:
+            self._snapshot_file.close()
+
 
 class LocalSyncDir(SyncDir):
     """Perform operations on a local sync directory."""
-    def __init__(self, path):
-        super().__init__(path)
+    def __init__(self, path, snapshot_path=None, scan_threads=1):
+        super().__init__(path, snapshot_path, scan_threads)
         os.makedirs(path, exist_ok=True)
 
 
@@ -150,8 +391,9 @@ class RemoteSyncDir(SyncDir):
             exclude pattern file.
         _db_file: The remote database object.
     """
-    def __init__(self, path: str) -> None:
-        super().__init__(path)
+    def __init__(self, path: str, scan_threads=1) -> None:
+        super().__init__(
+            path, os.path.join(path, ".zielen", "snapshot.db"), scan_threads)
         self.util_dir = os.path.join(self.path, ".zielen")
         self.safe_path = os.path.normpath(os.path.join(self.util_dir, ".."))
         self.trash_dir = os.path.join(self.util_dir, "Trash")
@@ -163,7 +405,9 @@ class RemoteSyncDir(SyncDir):
         self.update_paths = self._db_file.update_paths
         self.rm_paths = self._db_file.rm_paths
         self.get_path_info = self._db_file.get_path_info
+        self.lookup_paths = self._db_file.lookup_paths
         self.get_paths = self._db_file.get_paths
+        self.iter_paths = self._db_file.iter_paths
 
     def generate(self) -> None:
         """Generate files for storing persistent data."""
@@ -180,8 +424,9 @@ class RemoteSyncDir(SyncDir):
         self._db_file.commit()
 
     def close(self) -> None:
-        """Close all database connections."""
+        """Extend parent method to also close the remote database."""
         self._db_file.close()
+        super().close()
 
     def add_exclude_file(self, filepath: str, profile_id: str) -> None:
         """Add a profile exclude file to the remote.
@@ -210,27 +455,55 @@ class RemoteSyncDir(SyncDir):
             pass
 
     def check_excluded(
-            self, paths: Iterable[str], start_path: str) -> Set[str]:
+            self, paths: Iterable[str], start_path: str,
+            local_paths: Dict[str, os.stat_result],
+            cache_path: str) -> Set[str]:
         """Get the paths that have been excluded by each client.
 
+        The patterns of each client are compiled once and cached, and every
+        path is checked against all clients in a single pass.
+
         Args:
             paths: The paths to check.
             start_path: The path of the directory to match globbing patterns
                 against.
+            local_paths: A dict of the relative paths of the files in the
+                directory and their stats, like the one returned by
+                scan_paths(). Paths not in the directory are never
+                excluded.
+            cache_path: The path of the file to cache compiled patterns in.
 
         Returns:
             The subset of input paths that have been excluded by each client.
         """
-        pattern_files = []
-        for entry in os.scandir(self._exclude_dir):
-            pattern_files.append(ProfileExcludeFile(entry.path))
+        regexes = ProfileExcludeCacheFile(cache_path).get_regexes(
+            entry.path for entry in os.scandir(self._exclude_dir))
+        if None in regexes:
+            return set()
+
+        # Matching directories are remembered because most paths share them.
+        dir_clients = {}
+
+        def get_clients(path: str, is_dir: bool) -> FrozenSet[int]:
+            if is_dir and path in dir_clients:
+                return dir_clients[path]
+            clients = frozenset(
+                index for index, regex in enumerate(regexes)
+                if ProfileExcludeFile.is_match(regex, path, is_dir))
+            parent_path = os.path.dirname(path)
+            if parent_path:
+                clients |= get_clients(parent_path, True)
+            if is_dir:
+                dir_clients[path] = clients
+            return clients
 
         rm_files = set()
         for path in paths:
-            for pattern_file in pattern_files:
-                if path not in pattern_file.all_matches(start_path):
-                    break
-            else:
+            if path not in local_paths:
+                continue
+            is_dir = ProfileExcludeFile.is_dir(
+                start_path, path, local_paths[path])
+            if len(get_clients(path, is_dir)) == len(regexes):
                 rm_files.add(path)
 
         return rm_files
@@ -239,15 +512,28 @@ class RemoteSyncDir(SyncDir):
             self, rel=True, files=True, symlinks=True, dirs=True, exclude=None,
             memoize=True, lookup=True):
         """Extend parent method to automatically exclude the util directory."""
-        rel_util_path = os.path.relpath(self.util_dir, self.path)
+        util_path = (
+            os.path.relpath(self.util_dir, self.path) if rel
+            else self.util_dir)
         output = super().scan_paths(
             rel=rel, files=files, symlinks=symlinks, dirs=dirs,
-            exclude=exclude, memoize=memoize)
-        output = {
-            path: stats for path, stats in output.items()
-            if os.path.commonpath((path, rel_util_path)) != rel_util_path}
+            exclude=exclude, memoize=memoize, lookup=lookup)
+
+        # Remove paths in place so that the dict keeps its default factory.
+        util_paths = [
+            path for path in output
+            if os.path.commonpath((path, util_path)) == util_path]
+        for path in util_paths:
+            del output[path]
         return output
 
+    def iter_stats(self, memoize=True):
+        """Extend parent method to automatically exclude the util directory."""
+        util_path = os.path.relpath(self.util_dir, self.path)
+        for path, stat in super().iter_stats(memoize=memoize):
+            if path != util_path and not path.startswith(util_path + os.sep):
+                yield path, stat
+
 
 class RemoteDBFile(SyncDBFile):
     """Manipulate the remote file database.
@@ -321,6 +607,7 @@ class RemoteDBFile(SyncDBFile):
             files: The paths of regular files to add to the database.
             dirs: The paths of directories to add to the database.
         """
+        self._check_path_ids()
         # Sort paths by depth. A file can't be added to the database until its
         # parent directory has been added.
         files = set(files)
@@ -366,6 +653,7 @@ class RemoteDBFile(SyncDBFile):
                 """, insert_nodes_vals)
             if self._cur.rowcount <= 0:
                 break
+            self._clear_path_ids()
 
         # Insert new values into both tables.
         self._cur.executemany("""\
@@ -392,6 +680,7 @@ class RemoteDBFile(SyncDBFile):
             lastsync: The time that the paths were last updated by a sync. Use
                 None to leave the value unchanged.
         """
+        self._check_path_ids()
         update_vals = []
         for path in paths:
             path_id = self._get_path_id(path)
@@ -424,6 +713,7 @@ class RemoteDBFile(SyncDBFile):
         Args:
             paths: The file paths to remove.
         """
+        self._check_path_ids()
         # A generator expression can't be used here because recursive use of
         # cursors is not allowed.
         rm_vals = [{
@@ -445,6 +735,8 @@ class RemoteDBFile(SyncDBFile):
                 SELECT path
                 FROM nodes);
             """)
+        if self._cur.rowcount > 0:
+            self._clear_path_ids()
 
     def get_path_info(self, path: str) -> PathData:
         """Get data associated with a file path.
@@ -457,6 +749,7 @@ class RemoteDBFile(SyncDBFile):
             a directory and the time that the file was last updated by a
             sync as a unix timestamp.
         """
+        self._check_path_ids()
         path_id = self._get_path_id(path)
         self._cur.execute("""\
             SELECT directory, lastsync
@@ -468,6 +761,75 @@ class RemoteDBFile(SyncDBFile):
         if result:
             return PathData(*result)
 
+    def lookup_paths(self, paths: Iterable[str]) -> Dict[str, PathData]:
+        """Get data associated with many file paths at once.
+
+        Args:
+            paths: The file paths to search the database for.
+
+        Returns:
+            A dict containing the paths that were found in the database as
+            keys and named tuples like those returned by get_path_info() as
+            values.
+        """
+        self._check_path_ids()
+        self._fill_lookup_table(paths)
+        self._cur.execute("""\
+            SELECT n.path, n.directory, n.lastsync
+            FROM nodes AS n
+            JOIN lookup AS l
+            ON (n.id = l.id);
+            """)
+
+        return {
+            path: PathData(directory, lastsync)
+            for array in iter(self._cur.fetchmany, [])
+            for path, directory, lastsync in array}
+
+    def iter_paths(
+            self, root=None, directory=None, min_lastsync=None
+            ) -> Generator[Tuple[str, PathData], None, None]:
+        """Iterate over paths that match certain constraints.
+
+        This takes the same arguments as get_paths(), but rows are read from
+        the database lazily instead of all being loaded into memory at once.
+        A separate cursor is used so that the database can be queried while
+        iterating.
+
+        Yields:
+            A tuple containing a file path and a named tuple of data
+            associated with it.
+        """
+        self._check_path_ids()
+        cursor = self._conn.cursor()
+        cursor.arraysize = self._cur.arraysize
+        if root:
+            cursor.execute("""\
+                SELECT n.path, n.directory, n.lastsync
+                FROM nodes AS n
+                JOIN closure AS c
+                ON (n.id = c.descendant)
+                WHERE c.ancestor = :start_id
+                AND (:directory IS NULL OR n.directory = :directory)
+                AND (:min_lastsync IS NULL OR n.lastsync > :min_lastsync);
+                """, {"start_id": self._get_path_id(root),
+                      "directory": directory, "min_lastsync": min_lastsync})
+        else:
+            # Every node is its own descendant in the closure table, so
+            # joining it here would return each path once for every ancestor.
+            cursor.execute("""\
+                SELECT path, directory, lastsync
+                FROM nodes
+                WHERE (:directory IS NULL OR directory = :directory)
+                AND (:min_lastsync IS NULL OR lastsync > :min_lastsync);
+                """, {"directory": directory, "min_lastsync": min_lastsync})
+
+        # As long as cursor.arraysize is greater than 1, fetchmany() should
+        # be more efficient than fetchall().
+        for array in iter(cursor.fetchmany, []):
+            for path, directory, lastsync in array:
+                yield path, PathData(directory, lastsync)
+
     def get_paths(
             self, root=None, directory=None, min_lastsync=None
             ) -> Dict[str, PathData]:
@@ -487,21 +849,200 @@ class RemoteDBFile(SyncDBFile):
             is a directory and the time that the file was last updated by a
             sync as a unix timestamp.
         """
-        start_id = self._get_path_id(root) if root else None
+        return dict(self.iter_paths(
+            root=root, directory=directory, min_lastsync=min_lastsync))
+
+
+class SnapshotDBFile:
+    """Manipulate a database of file stats from the last scan of a directory.
+
+    This allows a sync directory to be scanned incrementally. A directory's
+    mtime and ctime change whenever a file is added to, removed from or
+    renamed within it, so directories whose stats haven't changed since the
+    last scan don't need to be read again.
+
+    Args:
+        path: The path of the database file.
+
+    Attributes:
+        path: The path of the database file.
+        _conn: The sqlite connection object for the database.
+        _cur: The sqlite cursor object for the connection.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._conn = None
+        self._cur = None
+
+    def _connect(self) -> None:
+        """Connect to the database file."""
+        self._conn = sqlite3.connect(self.path, isolation_level="DEFERRED")
+        self._cur = self._conn.cursor()
+        self._cur.arraysize = 1000
+
+    def _check_connection(self) -> bool:
+        """Connect to the database file if it exists.
+
+        The snapshot is just a cache, so the database file may be removed at
+        any time (e.g. along with the remote directory).
+
+        Returns:
+            True if there is a connection to the database and False otherwise.
+        """
+        if not os.path.isfile(self.path):
+            self.close()
+            return False
+        if self._conn is None:
+            self._connect()
+        return True
+
+    @staticmethod
+    def from_stat(stat: os.stat_result) -> SnapshotData:
+        """Get the data to store from an os.stat_result object."""
+        return SnapshotData(
+            stat.st_mode, stat.st_ino, stat.st_mtime_ns, stat.st_ctime_ns,
+            stat.st_size, stat.st_blocks)
+
+    @staticmethod
+    def to_stat(data: SnapshotData) -> os.stat_result:
+        """Get an os.stat_result object from stored data.
+
+        Fields which aren't stored are set to zero.
+        """
+        def float_time(time_ns: int) -> float:
+            # This is how os.stat() computes the time as a float.
+            return time_ns // 10**9 + (time_ns % 10**9) * 1e-9
+
+        return os.stat_result(
+            (data.mode, data.inode, 0, 0, 0, 0, data.size, 0,
+             data.mtime // 10**9, data.ctime // 10**9),
+            {"st_atime": 0.0, "st_mtime": float_time(data.mtime),
+             "st_ctime": float_time(data.ctime), "st_atime_ns": 0,
+             "st_mtime_ns": data.mtime, "st_ctime_ns": data.ctime,
+             "st_blocks": data.blocks})
+
+    def create(self) -> None:
+        """Create a new empty database.
+
+        Raises:
+            FileExistsError: The database file already exists.
+        """
+        if os.path.isfile(self.path):
+            raise FileExistsError("the database file already exists")
+
+        self._connect()
+        with self._conn:
+            self._cur.executescript("""\
+                CREATE TABLE snapshot (
+                    path        TEXT    NOT NULL,
+                    mode        INT     NOT NULL,
+                    inode       INT     NOT NULL,
+                    mtime       INT     NOT NULL,
+                    ctime       INT     NOT NULL,
+                    size        INT     NOT NULL,
+                    blocks      INT     NOT NULL,
+                    PRIMARY KEY (path)
+                ) WITHOUT ROWID;
+
+                CREATE TABLE scan (
+                    start       INT     NOT NULL
+                );
+                """)
+
+    def get_stats(self) -> Dict[str, SnapshotData]:
+        """Get the stats of every file from the last scan.
+
+        Returns:
+            A dict with relative file paths as keys and named tuples as
+            values. The directory itself has the path ".". If there is no
+            snapshot, the dict is empty.
+        """
+        if not self._check_connection():
+            return {}
+
         self._cur.execute("""\
-            SELECT n.path, n.directory, n.lastsync
-            FROM nodes AS n
-            JOIN closure AS c
-            ON (n.id = c.descendant)
-            WHERE (:start_id IS NULL OR c.ancestor = :start_id)
-            AND (:directory IS NULL OR n.directory = :directory)
-            AND (:min_lastsync IS NULL OR n.lastsync > :min_lastsync);
-            """, {"start_id": start_id, "directory": directory,
-                  "min_lastsync": min_lastsync})
-
-        # As long as self._cur.arraysize is greater than 1, fetchmany() should
-        # be more efficient than fetchall().
+            SELECT path, mode, inode, mtime, ctime, size, blocks
+            FROM snapshot;
+            """)
         return {
-            path: PathData(directory, lastsync)
+            row[0]: SnapshotData(*row[1:])
             for array in iter(self._cur.fetchmany, [])
-            for path, directory, lastsync in array}
+            for row in array}
+
+    def get_scan_start(self) -> Optional[int]:
+        """Get the time that the last scan started.
+
+        Returns:
+            The time in nanoseconds since the epoch, or None if there is no
+            snapshot or it was created before scan times were recorded.
+        """
+        if not self._check_connection():
+            return None
+
+        try:
+            self._cur.execute("""\
+                SELECT start
+                FROM scan;
+                """)
+        except sqlite3.OperationalError:
+            return None
+        row = self._cur.fetchone()
+        return None if row is None else row[0]
+
+    def update(
+            self, old_stats: Dict[str, SnapshotData],
+            new_stats: Dict[str, SnapshotData], scan_start: int) -> None:
+        """Replace the stats from the last scan with new ones.
+
+        Only rows that have changed are written. If the database doesn't
+        exist, it is created as long as its parent directory exists.
+
+        Args:
+            old_stats: The stats currently in the database, as returned by
+                get_stats().
+            new_stats: The stats from the new scan.
+            scan_start: The time in nanoseconds since the epoch that the new
+                scan started.
+        """
+        if not self._check_connection():
+            if not os.path.isdir(os.path.dirname(self.path)):
+                return
+            self.create()
+
+        rm_vals = [
+            {"path": path} for path in old_stats.keys() - new_stats.keys()]
+        insert_vals = [
+            dict(data._asdict(), path=path)
+            for path, data in new_stats.items()
+            if old_stats.get(path) != data]
+
+        with self._conn:
+            self._cur.executemany("""\
+                DELETE FROM snapshot
+                WHERE path = :path;
+                """, rm_vals)
+            self._cur.executemany("""\
+                INSERT OR REPLACE INTO snapshot (
+                    path, mode, inode, mtime, ctime, size, blocks)
+                VALUES (
+                    :path, :mode, :inode, :mtime, :ctime, :size, :blocks);
+                """, insert_vals)
+            self._cur.execute("""\
+                CREATE TABLE IF NOT EXISTS scan (
+                    start       INT     NOT NULL
+                );
+                """)
+            self._cur.execute("""\
+                DELETE FROM scan;
+                """)
+            self._cur.execute("""\
+                INSERT INTO scan (start)
+                VALUES (?);
+                """, (scan_start,))
+
+    def close(self) -> None:
+        """Close the database connection."""
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+            self._cur = None
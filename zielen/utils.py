@@ -28,10 +28,15 @@ import datetime
 import random
 import string
 import readline
-from typing import List, Tuple, Iterable
+from typing import List, Tuple, Iterable, Optional
 
 from zielen.paths import get_home_dir
 
+# The names of the backends that can be used to watch for file access. This is
+# kept here so that config files can be checked without importing the
+# backends themselves.
+WATCH_BACKENDS = ["auto", "inotify", "fanotify"]
+
 
 def shell_cmd(input_cmd: list) -> subprocess.Popen:
     """Run a shell command and terminate it on exit.
@@ -197,6 +202,132 @@ class DictProperty:
         return type(self)(self._fget, self._fset, fdel, self.__doc__)
 
 
+class PathTrie:
+    """A set of relative file paths that can be queried by ancestry.
+
+    Paths are stored in a tree of dicts keyed by path component, so checking
+    whether a path is under or above any path in the set takes time
+    proportional to the depth of the path rather than to the size of the
+    set. Trailing path separators are ignored.
+
+    Args:
+        paths: The paths to add initially.
+
+    Attributes:
+        _root: The root node of the trie. Each node is a dict of child path
+            components and their nodes.
+        _size: The number of paths in the trie.
+    """
+    # A key which can never be a path component is used to mark the nodes
+    # that correspond to paths in the set.
+    _MEMBER = os.sep
+
+    def __init__(self, paths=()) -> None:
+        self._root = {}
+        self._size = 0
+        for path in paths:
+            self.add(path)
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __contains__(self, path: str) -> bool:
+        node = self._find(path)
+        return node is not None and self._MEMBER in node
+
+    def __iter__(self):
+        stack = [("", self._root)]
+        while stack:
+            path, node = stack.pop()
+            if self._MEMBER in node:
+                yield path
+            for name, child in node.items():
+                if name != self._MEMBER:
+                    stack.append((os.path.join(path, name), child))
+
+    @staticmethod
+    def _split(path: str) -> List[str]:
+        """Split a path into its components."""
+        return [name for name in path.split(os.sep) if name]
+
+    def _find(self, path: str) -> Optional[dict]:
+        """Get the node for a path if it exists in the trie."""
+        node = self._root
+        for name in self._split(path):
+            node = node.get(name)
+            if node is None:
+                return None
+        return node
+
+    def add(self, path: str) -> None:
+        """Add a path to the set.
+
+        Args:
+            path: The relative path to add.
+        """
+        node = self._root
+        for name in self._split(path):
+            node = node.setdefault(name, {})
+        if self._MEMBER not in node:
+            node[self._MEMBER] = True
+            self._size += 1
+
+    def has_ancestor(self, path: str, include_self=True) -> bool:
+        """Check if any path in the set is a parent directory of a path.
+
+        Args:
+            path: The relative path to check.
+            include_self: Count the path itself as one of its ancestors.
+
+        Returns:
+            True if the path is under a path in the set and False otherwise.
+        """
+        names = self._split(path)
+        node = self._root
+        for depth, name in enumerate(names):
+            node = node.get(name)
+            if node is None:
+                return False
+            if self._MEMBER in node and (
+                    include_self or depth < len(names) - 1):
+                return True
+        return False
+
+    def has_descendant(self, path: str, include_self=True) -> bool:
+        """Check if any path in the set is under a path.
+
+        Args:
+            path: The relative path to check.
+            include_self: Count the path itself as one of its descendants.
+
+        Returns:
+            True if a path in the set is under the path and False otherwise.
+        """
+        node = self._find(path)
+        if node is None:
+            return False
+        if include_self:
+            return bool(node)
+        return any(name != self._MEMBER for name in node)
+
+    def roots(self) -> List[str]:
+        """Get the paths in the set which are not under any other path in it.
+
+        Returns:
+            A list of relative paths.
+        """
+        roots = []
+        stack = [("", self._root)]
+        while stack:
+            path, node = stack.pop()
+            if self._MEMBER in node:
+                roots.append(path)
+                continue
+            for name, child in node.items():
+                stack.append((os.path.join(path, name), child))
+        return roots
+
+
 class ProgressBar:
     """An ascii progress bar for the terminal.
 
@@ -0,0 +1,323 @@
+"""Watch directories for files being opened.
+
+Copyright © 2016-2018 Garrett Powell <garrett@gpowell.net>
+
+This file is part of zielen.
+
+zielen is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+zielen is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with zielen.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import os
+import abc
+import errno
+import ctypes
+import struct
+import asyncio
+import logging
+from typing import Callable, Iterable, Optional
+
+import pyinotify
+
+from zielen.utils import WATCH_BACKENDS
+
+# Constants from linux/fanotify.h and linux/fcntl.h.
+FAN_CLASS_NOTIF = 0x00000000
+FAN_CLOEXEC = 0x00000001
+FAN_NONBLOCK = 0x00000002
+FAN_MARK_ADD = 0x00000001
+FAN_MARK_MOUNT = 0x00000010
+FAN_OPEN = 0x00000020
+AT_FDCWD = -100
+
+# The layout of struct fanotify_event_metadata.
+FAN_EVENT_METADATA = struct.Struct("=IBBHQii")
+
+logger = logging.getLogger(__name__)
+
+
+class Watcher(abc.ABC):
+    """Base class for watching directories for files being opened.
+
+    Args:
+        paths: The absolute paths of the directories to watch.
+        callback: A function to call with the absolute path of each file
+            other than a directory that is opened or created in one of the
+            directories.
+        loop: The event loop to read events in.
+        change_callback: A function to call with the absolute path of each
+            file or directory that is created, modified, moved or deleted in
+            one of the directories, or with None if changes may have been
+            missed.
+
+    Attributes:
+        REPORTS_CHANGES: Whether the watcher calls the change callback.
+        paths: The absolute paths of the directories to watch.
+        callback: A function to call with the absolute path of each file
+            other than a directory that is opened or created in one of the
+            directories.
+        loop: The event loop to read events in.
+        change_callback: A function to call with the absolute path of each
+            file or directory that is created, modified, moved or deleted in
+            one of the directories, or with None if changes may have been
+            missed.
+    """
+    REPORTS_CHANGES = False
+
+    def __init__(
+            self, paths: Iterable[str], callback: Callable[[str], None],
+            loop: asyncio.AbstractEventLoop,
+            change_callback=None) -> None:
+        self.paths = [os.path.abspath(path) for path in paths]
+        self.callback = callback
+        self.loop = loop
+        self.change_callback = change_callback
+
+    @abc.abstractmethod
+    def start(self) -> None:
+        """Start watching for events.
+
+        Raises:
+            OSError: The directories couldn't be watched.
+        """
+
+    @abc.abstractmethod
+    def stop(self) -> None:
+        """Stop watching for events."""
+
+
+class InotifyWatcher(Watcher):
+    """Watch directories with inotify.
+
+    A watch is added for every directory in the trees, so the time it takes
+    to start watching and the number of watches used grow with the number of
+    directories.
+
+    Attributes:
+        ACCESS_MASK: The events which count as a file being accessed.
+        CHANGE_MASK: The events which count as a file being changed.
+        _notifier: The pyinotify notifier, if it has been started.
+    """
+    REPORTS_CHANGES = True
+    ACCESS_MASK = pyinotify.IN_OPEN | pyinotify.IN_CREATE
+    CHANGE_MASK = (
+        pyinotify.IN_CREATE | pyinotify.IN_MODIFY | pyinotify.IN_ATTRIB
+        | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_FROM
+        | pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE)
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._notifier = None
+
+    def start(self) -> None:
+        """Start watching for events."""
+        def handle_event(event: pyinotify.Event) -> None:
+            if event.mask & pyinotify.IN_Q_OVERFLOW:
+                if self.change_callback is not None:
+                    self.change_callback(None)
+                return
+            if event.mask & self.ACCESS_MASK and not event.dir:
+                self.callback(event.pathname)
+            if event.mask & self.CHANGE_MASK and self.change_callback:
+                self.change_callback(event.pathname)
+
+        wm = pyinotify.WatchManager()
+        self._notifier = pyinotify.AsyncioNotifier(
+            wm, self.loop, default_proc_fun=handle_event)
+
+        mask = self.ACCESS_MASK
+        if self.change_callback is not None:
+            mask |= self.CHANGE_MASK
+        for watch_path in self.paths:
+            wm.add_watch(watch_path, mask, rec=True, auto_add=True)
+
+    def stop(self) -> None:
+        """Stop watching for events."""
+        if self._notifier is not None:
+            self._notifier.stop()
+            self._notifier = None
+
+
+class FanotifyWatcher(Watcher):
+    """Watch directories with a fanotify mount mark.
+
+    A single mark covers every file on the mount containing each directory,
+    so no per-directory watches are needed. Events outside of the watched
+    directories and events caused by this process are ignored. This requires
+    the CAP_SYS_ADMIN capability. Files are reported when they are opened,
+    which includes when they are created. Changes to files are not
+    reported.
+
+    Attributes:
+        _fd: The fanotify file descriptor, if it has been started.
+        _real_paths: A list of tuples containing the path of each watched
+            directory with symlinks resolved and the path as it was given.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._fd = None
+        self._real_paths = [
+            (os.path.realpath(path), path) for path in self.paths]
+
+    def _get_watched_path(self, real_path: str) -> Optional[str]:
+        """Get the path of a file under the watched directories as given.
+
+        fanotify reports paths with symlinks resolved, so they must be
+        converted back to be relative to the watched directories.
+
+        Args:
+            real_path: The absolute path of the file with symlinks resolved.
+
+        Returns:
+            The path of the file, or None if it's not in a watched directory.
+        """
+        for real_watch_path, watch_path in self._real_paths:
+            if real_path.startswith(real_watch_path + os.sep):
+                return watch_path + real_path[len(real_watch_path):]
+        return None
+
+    @staticmethod
+    def _get_libc() -> ctypes.CDLL:
+        """Get the C library with the signatures of the fanotify functions.
+
+        Raises:
+            OSError: fanotify isn't supported on this platform.
+        """
+        libc = ctypes.CDLL(None, use_errno=True)
+        if not hasattr(libc, "fanotify_init"):
+            raise OSError(errno.ENOSYS, "fanotify is not supported")
+
+        libc.fanotify_init.argtypes = [ctypes.c_uint, ctypes.c_uint]
+        libc.fanotify_init.restype = ctypes.c_int
+        libc.fanotify_mark.argtypes = [
+            ctypes.c_int, ctypes.c_uint, ctypes.c_uint64, ctypes.c_int,
+            ctypes.c_char_p]
+        libc.fanotify_mark.restype = ctypes.c_int
+        return libc
+
+    def start(self) -> None:
+        """Start watching for events.
+
+        Raises:
+            OSError: fanotify isn't supported or there are insufficient
+                permissions to use it.
+        """
+        libc = self._get_libc()
+        fd = libc.fanotify_init(
+            FAN_CLASS_NOTIF | FAN_CLOEXEC | FAN_NONBLOCK,
+            os.O_RDONLY | os.O_CLOEXEC | getattr(os, "O_LARGEFILE", 0))
+        if fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, os.strerror(error))
+
+        try:
+            for watch_path in self.paths:
+                if libc.fanotify_mark(
+                        fd, FAN_MARK_ADD | FAN_MARK_MOUNT, FAN_OPEN,
+                        AT_FDCWD, os.fsencode(watch_path)) < 0:
+                    error = ctypes.get_errno()
+                    raise OSError(error, os.strerror(error), watch_path)
+        except OSError:
+            os.close(fd)
+            raise
+
+        self._fd = fd
+        self.loop.add_reader(self._fd, self._read_events)
+
+    def _read_events(self) -> None:
+        """Read the events that are waiting and pass on the watched ones."""
+        try:
+            data = os.read(self._fd, FAN_EVENT_METADATA.size * 1024)
+        except BlockingIOError:
+            return
+
+        offset = 0
+        while offset + FAN_EVENT_METADATA.size <= len(data):
+            event_len, _, _, _, _, event_fd, pid = (
+                FAN_EVENT_METADATA.unpack_from(data, offset))
+            if event_len < FAN_EVENT_METADATA.size:
+                break
+            offset += event_len
+
+            # The queue overflowed and no file is attached to the event.
+            if event_fd < 0:
+                continue
+
+            try:
+                if pid != os.getpid():
+                    path = self._get_watched_path(os.readlink(
+                        "/proc/self/fd/{0}".format(event_fd)))
+                    if path is not None:
+                        self.callback(path)
+            except OSError:
+                pass
+            finally:
+                os.close(event_fd)
+
+    def stop(self) -> None:
+        """Stop watching for events."""
+        if self._fd is not None:
+            self.loop.remove_reader(self._fd)
+            os.close(self._fd)
+            self._fd = None
+
+
+def start_watcher(
+        backend: str, paths: Iterable[str], callback: Callable[[str], None],
+        loop: asyncio.AbstractEventLoop, change_callback=None) -> Watcher:
+    """Start watching directories with the given backend.
+
+    Args:
+        backend: The name of the backend to use. If "auto", use inotify if
+            there is a change callback, since fanotify doesn't report
+            changes. Otherwise, use fanotify if it is available and inotify
+            otherwise.
+        paths: The absolute paths of the directories to watch.
+        callback: A function to call with the absolute path of each file
+            other than a directory that is opened or created in one of the
+            directories.
+        loop: The event loop to read events in.
+        change_callback: A function to call with the absolute path of each
+            file or directory that is changed in one of the directories, or
+            with None if changes may have been missed. This is only called if
+            the backend supports it.
+
+    Returns:
+        The watcher that was started.
+
+    Raises:
+        ValueError: The backend is not recognized.
+        OSError: The directories couldn't be watched.
+    """
+    if backend not in WATCH_BACKENDS:
+        raise ValueError("unrecognized backend '{0}'".format(backend))
+
+    paths = list(paths)
+    # fanotify isn't used by default if changes need to be reported.
+    use_fanotify = backend == "fanotify" or (
+        backend == "auto" and change_callback is None)
+    if use_fanotify:
+        watcher = FanotifyWatcher(paths, callback, loop, change_callback)
+        try:
+            watcher.start()
+        except OSError as error:
+            if backend == "fanotify":
+                raise
+            logger.debug(
+                "fanotify is unavailable, using inotify instead: {0}".format(
+                    error))
+        else:
+            return watcher
+
+    watcher = InotifyWatcher(paths, callback, loop, change_callback)
+    watcher.start()
+    return watcher